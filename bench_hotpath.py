@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Ingest hot path micro-benchmarks
+Times TrackingConsumer.haversine, parse_timestamp and process_point per
+call, the PointBatch path and process_point per frame, and the flush of a
+frame and the compaction at several session sizes, against a throwaway
+SQLite database.
+Writes the results as JSON (--output) and compares them with the
+stored baselines: any result slower than its baseline by more than
+--tolerance fails the run (exit 1).
+Baselines depend on the machine; after a deliberate change, or on a
+new CI runner, refresh them with --update-baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locatracker.settings')
+os.environ.setdefault('SECRET_KEY', 'bench-hotpath')
+
+# Keep the numbers independent of the configured database
+from django.conf import settings
+DB_DIR = tempfile.mkdtemp(prefix="bench_hotpath_")
+settings.DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(DB_DIR, "bench.sqlite3"),
+    }
+}
+django.setup()
+
+import numpy as np
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.management import call_command
+from django.contrib.auth.models import User
+
+from tracking.batch import PointBatch
+from tracking.consumers import SessionState, TrackingConsumer, fetch_state
+from tracking.ingest import PendingSession, apply_batch, write_pending
+from tracking.models import TrackingSession
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_hotpath_baseline.json")
+
+SESSION_SIZES = [100, 1000, 10000, 100000]
+# A live client frame (MAX_BUFFER_SIZE in script.js) and a larger one
+FRAME_SIZES = [10, 50]
+FLUSH_SIZE = 10
+
+# Points compacted per session size, at most, to find the best run
+COMPACT_POINTS = 20000
+
+START = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def make_points(count, offset=0):
+    # About 35 m apart, one second apart: every point is accepted
+    rng = np.random.default_rng(count + offset)
+    lat = 28.6139 + np.cumsum(rng.normal(0.0003, 0.00002, count))
+    lng = 77.2090 + np.cumsum(rng.normal(0.0001, 0.00002, count))
+
+    return [
+        {
+            "lat": round(float(lat[i]), 6),
+            "lng": round(float(lng[i]), 6),
+            "mode": "bike",
+            "timestamp": (START + timedelta(seconds=offset + i)).isoformat().replace("+00:00", "Z"),
+            "cseq": offset + i + 1,
+        }
+        for i in range(count)
+    ]
+
+
+def empty_state():
+    return SessionState(
+        id=1,
+        total_distance=0,
+        total_time=0,
+        point_count=0,
+        last_lat=None,
+        last_lng=None,
+        last_timestamp=None,
+        client_seq=0
+    )
+
+
+def best_of(run, repeat):
+    """Fastest of repeat runs of run(), in seconds: the least noisy."""
+    run()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+# ---------------- PER CALL ----------------
+
+def bench_calls(results, repeat):
+    consumer = TrackingConsumer()
+    points = make_points(1000)
+    coords = [(p["lat"], p["lng"]) for p in points]
+    pairs = list(zip(coords, coords[1:]))
+    stamps = [p["timestamp"] for p in points]
+
+    def haversine():
+        for (lat1, lng1), (lat2, lng2) in pairs:
+            consumer.haversine(lat1, lng1, lat2, lng2)
+
+    def parse_timestamp():
+        for ts in stamps:
+            consumer.parse_timestamp(ts)
+
+    def process_point():
+        state = empty_state()
+        for p in points:
+            consumer.process_point(state, p["lat"], p["lng"], p["mode"], p["timestamp"])
+
+    # Every point has to make it through all of the checks
+    state = empty_state()
+    for p in points:
+        consumer.process_point(state, p["lat"], p["lng"], p["mode"], p["timestamp"])
+    assert state.point_count == len(points), "benchmark points were filtered out"
+
+    results["haversine"] = best_of(haversine, repeat) / len(pairs)
+    results["parse_timestamp"] = best_of(parse_timestamp, repeat) / len(stamps)
+    results["process_point"] = best_of(process_point, repeat) / len(points)
+
+
+# ---------------- PER FRAME ----------------
+
+def bench_frame(results, repeat, size):
+    consumer = TrackingConsumer()
+    points = make_points(size)
+
+    def one_by_one():
+        state = empty_state()
+        for p in points:
+            consumer.process_point(state, p["lat"], p["lng"], p["mode"], p["timestamp"])
+
+    def vectorized():
+        state = empty_state()
+        batch = PointBatch.from_dicts(points)
+        apply_batch(state, batch, batch.select(state))
+
+    results[f"process_point_frame_{size}"] = best_of(one_by_one, repeat)
+    results[f"batch_frame_{size}"] = best_of(vectorized, repeat)
+
+
+# ---------------- PER SESSION SIZE ----------------
+
+def seed_session(user, size):
+    """A live session that already holds size point rows."""
+    session = TrackingSession.objects.create(user=user)
+    points = make_points(size)
+    batch = PointBatch.from_dicts(points)
+    state = fetch_state(session.id, user)
+
+    for start in range(0, size, 5000):
+        part = batch.take(np.arange(start, min(start + 5000, size)))
+        pending = PendingSession(session.id)
+        pending.add(state, apply_batch(state, part, part.select(state)))
+        write_pending([pending])
+
+    assert state.point_count == size, "seed points were filtered out"
+    return session
+
+
+def bench_session(results, user, size, repeat):
+    session = seed_session(user, size)
+    offset = size
+
+    def flush():
+        nonlocal offset
+        # Built outside the timing; only the write is measured
+        state = fetch_state(session.id, user)
+        batch = PointBatch.from_dicts(make_points(FLUSH_SIZE, offset))
+        pending = PendingSession(session.id)
+        pending.add(state, apply_batch(state, batch, batch.select(state)))
+        offset += FLUSH_SIZE
+
+        start = time.perf_counter()
+        write_pending([pending])
+        return time.perf_counter() - start
+
+    def load_state():
+        fetch_state(session.id, user)
+
+    flush()
+    results[f"flush_{FLUSH_SIZE}@{size}"] = min(flush() for _ in range(repeat * 4))
+    results[f"load_state@{size}"] = best_of(load_state, repeat * 4)
+
+    # Compaction deletes the rows, so every run needs a fresh session;
+    # large ones are packed only once
+    def compact(session):
+        session.refresh_from_db()
+        start = time.perf_counter()
+        assert session.compact()
+        return time.perf_counter() - start
+
+    runs = max(1, min(repeat, COMPACT_POINTS // size))
+    results[f"compact@{size}"] = min(
+        [compact(session)] + [compact(seed_session(user, size)) for _ in range(runs - 1)]
+    )
+
+
+# ---------------- BASELINES ----------------
+
+def compare(results, baseline, tolerance):
+    """Names of the results slower than baseline * (1 + tolerance)."""
+    regressions = []
+
+    print(f"\n   {'':28}{'µs':>12}{'baseline':>12}{'change':>10}")
+    for name, seconds in results.items():
+        us = seconds * 1e6
+        base = baseline.get(name)
+        if base is None:
+            print(f"   {name:28}{us:12.2f}{'-':>12}{'new':>10}")
+            continue
+
+        change = us / base - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = " ❌"
+        print(f"   {name:28}{us:12.2f}{base:12.2f}{change:+10.0%}{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SESSION_SIZES, help="Session sizes in points")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the fastest counts")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed slowdown, 0.3 = 30%%")
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the baseline")
+    args = parser.parse_args()
+
+    print("⏱️  Ingest Hot Path Benchmark")
+    print("=" * 50)
+
+    call_command("migrate", verbosity=0)
+    user = User.objects.create(username="bench_hotpath")
+
+    results = {}
+    bench_calls(results, args.repeat)
+    for size in FRAME_SIZES:
+        bench_frame(results, args.repeat, size)
+    for size in args.sizes:
+        print(f"   Session of {size} points...")
+        bench_session(results, user, size, args.repeat)
+
+    report = {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "machine": platform.machine(),
+        "units": "microseconds",
+        "results": {name: round(seconds * 1e6, 3) for name, seconds in results.items()},
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        compare(results, {}, args.tolerance)
+        print(f"\n   ✅ Baseline written to {args.baseline}")
+        return
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"   ❌ Cannot read baseline {args.baseline}: {e}")
+        sys.exit(1)
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n   ❌ {len(regressions)} results regressed more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+    print(f"\n   ✅ No result regressed more than {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(DB_DIR, ignore_errors=True)
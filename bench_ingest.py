@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Ingest throughput benchmark
+Opens many TrackingConsumer connections in one process, sends batches
+of points and waits until every one is acknowledged as stored.
+Reports how fast the consumers handled the frames and how fast the
+points reached the database.
+Runs without a channel layer (no live viewers) unless --layer memory
+is given, against the configured database.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locatracker.settings')
+django.setup()
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.contrib.auth.models import User
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+import tracking.routing
+from tracking.consumers import TrackingConsumer
+from tracking.dbexecutor import get_db_executor
+from tracking.models import TrackingSession
+
+
+class Handled:
+    count = 0
+    last = None
+
+
+def count_handled(receive):
+    async def counted(self, text_data=None, bytes_data=None):
+        await receive(self, text_data, bytes_data)
+        Handled.count += 1
+        Handled.last = time.perf_counter()
+
+    return counted
+
+
+def frames_for(connection, frames, batch_size):
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+    seq = 0
+
+    for frame in range(frames):
+        locations = []
+        for _ in range(batch_size):
+            seq += 1
+            locations.append({
+                "lat": 28.6 + connection * 0.01 + seq * 0.0003,
+                "lng": 77.2,
+                "mode": "walk",
+                "timestamp": (start + timedelta(seconds=seq)).isoformat(),
+                "cseq": seq,
+            })
+        yield locations
+
+
+async def phone(app, session, connection, args):
+    communicator = WebsocketCommunicator(app, "/ws/tracking/")
+    communicator.scope["user"] = session.user
+    connected, _ = await communicator.connect()
+    assert connected
+
+    last_seq = args.frames * args.batch
+    for locations in frames_for(connection, args.frames, args.batch):
+        await communicator.send_to(text_data=json.dumps({
+            "session_id": session.id,
+            "locations": locations,
+        }))
+
+    # Acks arrive once the points are in the database
+    while True:
+        message = json.loads(await communicator.receive_from(timeout=60))
+        if message.get("type") == "ack" and message["seq"] >= last_seq:
+            break
+
+    await communicator.disconnect()
+
+
+async def run_round(sessions, args):
+    app = URLRouter(tracking.routing.websocket_urlpatterns)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        phone(app, session, i, args)
+        for i, session in enumerate(sessions)
+    ])
+    return Handled.last - start, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=10)
+    parser.add_argument("--layer", choices=["none", "memory"], default="none")
+    parser.add_argument("--workers", type=int, default=settings.DB_EXECUTOR_WORKERS)
+    args = parser.parse_args()
+
+    settings.DB_EXECUTOR_WORKERS = args.workers
+
+    # The in-memory layer's expiry scans would dominate the profile
+    settings.CHANNEL_LAYERS = {}
+    if args.layer == "memory":
+        settings.CHANNEL_LAYERS = {
+            "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        }
+
+    print("🚚 Ingest Throughput Benchmark")
+    print("=" * 50)
+    print(f"   {args.connections} connections x {args.frames} frames x {args.batch} points")
+    print(f"   {args.workers} database executor workers")
+
+    TrackingConsumer.receive = count_handled(TrackingConsumer.receive)
+
+    # One user per phone, so the per-user rate limits apply as in production
+    User.objects.filter(username__startswith="bench_ingest_").delete()
+    User.objects.bulk_create([
+        User(username=f"bench_ingest_{i}")
+        for i in range(args.connections)
+    ])
+    users = User.objects.filter(username__startswith="bench_ingest_").order_by("id")
+    sessions = [TrackingSession.objects.create(user=user) for user in users]
+
+    try:
+        handled, stored = asyncio.run(run_round(sessions, args))
+    finally:
+        total = sum(TrackingSession.objects.filter(
+            id__in=[s.id for s in sessions]
+        ).values_list("point_count", flat=True))
+        User.objects.filter(username__startswith="bench_ingest_").delete()
+
+    frames = args.connections * args.frames
+    print(f"\n   Frames handled: {Handled.count} in {handled:.2f} s")
+    print(f"   Points stored:  {total} in {stored:.2f} s")
+    print(f"   Peak DB queue:  {get_db_executor().stats()['peak_queued']}")
+    print(f"   ➜ {Handled.count / handled:,.0f} messages/s handled, {total / stored:,.0f} points/s stored")
+
+    if Handled.count != frames or total != frames * args.batch:
+        print("   ❌ Not every point was stored")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+WebSocket protocol benchmark
+Compares decoding a batch frame as JSON against the binary protocol,
+from raw frame to filtered points (no database needed)
+"""
+
+import os
+import json
+import time
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locatracker.settings')
+django.setup()
+
+import numpy as np
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from tracking.batch import PointBatch
+from tracking.consumers import SessionState
+from tracking.protocol import COORD_SCALE, MODES, decode_frame, encode_frame
+
+
+BATCH_SIZES = [1, 10, 50, 500]
+ROUNDS = 2000
+
+
+def make_points(count):
+    rng = np.random.default_rng(count)
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+    lat = 28.6139 + np.cumsum(rng.normal(0.0002, 0.0001, count))
+    lng = 77.2090 + np.cumsum(rng.normal(0.0002, 0.0001, count))
+
+    return [
+        {
+            "lat": round(float(lat[i]), 6),
+            "lng": round(float(lng[i]), 6),
+            "mode": "bike",
+            "accuracy": 12.5,
+            "timestamp": (start + timedelta(seconds=i)).isoformat().replace("+00:00", "Z"),
+            "ts_ms": int((start + timedelta(seconds=i)).timestamp() * 1000),
+        }
+        for i in range(count)
+    ]
+
+
+def empty_state():
+    return SessionState(
+        id=1,
+        total_distance=0,
+        total_time=0,
+        point_count=0,
+        last_lat=None,
+        last_lng=None,
+        last_timestamp=None,
+        client_seq=0
+    )
+
+
+def parse_json(frame):
+    data = json.loads(frame)
+    return PointBatch.from_dicts(data["locations"])
+
+
+def parse_binary(frame):
+    _, records = decode_frame(frame)
+    return PointBatch.from_records(records, MODES, COORD_SCALE)
+
+
+def decode_json(frame):
+    return parse_json(frame).select(empty_state())
+
+
+def decode_binary(frame):
+    return parse_binary(frame).select(empty_state())
+
+
+def timed(func, frame, rounds):
+    func(frame)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(frame)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def run():
+    print("📦 WebSocket Protocol Benchmark")
+    print("=" * 50)
+
+    for size in BATCH_SIZES:
+        points = make_points(size)
+        rounds = max(ROUNDS // size, 20)
+
+        json_frame = json.dumps({
+            "session_id": 1,
+            "locations": [
+                {key: p[key] for key in ("lat", "lng", "mode", "accuracy", "timestamp")}
+                for p in points
+            ],
+        })
+        binary_frame = encode_frame(1, points)
+
+        # Both paths must accept the same points
+        assert len(decode_json(json_frame)) == len(decode_binary(binary_frame))
+
+        json_parse = timed(parse_json, json_frame, rounds)
+        binary_parse = timed(parse_binary, binary_frame, rounds)
+        json_us = timed(decode_json, json_frame, rounds)
+        binary_us = timed(decode_binary, binary_frame, rounds)
+
+        print(f"\n{size} points per frame:")
+        print(f"   {'':8}{'bytes':>8}{'parse µs':>12}{'+ filter µs':>14}")
+        print(f"   {'JSON':8}{len(json_frame):8d}{json_parse:12.1f}{json_us:14.1f}")
+        print(f"   {'Binary':8}{len(binary_frame):8d}{binary_parse:12.1f}{binary_us:14.1f}")
+        print(
+            f"   ➜ {len(json_frame) / len(binary_frame):.1f}x smaller, "
+            f"parse {json_parse / binary_parse:.1f}x faster, "
+            f"end to end {json_us / binary_us:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    run()
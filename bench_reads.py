@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Read path benchmark
+Times session_map (page and XHR), my_tracks and the TrackingSession
+admin list and change views against the users and sessions made by
+`manage.py generate_tracks`, on the configured database.
+For each request reports latency, database queries, bytes returned and
+peak Python memory (tracemalloc, on a separate run), and can write them
+as JSON with --output.
+session_map is measured cold (nothing cached) and, for ended sessions,
+warm (served from its response cache). Size is the points of the
+session shown, or the sessions behind the list.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locatracker.settings')
+
+# A private cache, so cold runs can clear it without touching a shared one
+from django.conf import settings
+settings.CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "bench_reads",
+    }
+}
+django.setup()
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import Client
+from django.urls import reverse
+from django.contrib.auth.models import User
+
+from tracking.models import TrackingSession
+
+
+ADMIN_USERNAME = "bench_reads_admin"
+
+# Ended sessions picked by length: shortest, median, 90th percentile, longest
+QUANTILES = [("shortest", 0), ("median", 0.5), ("p90", 0.9), ("longest", 1)]
+
+XHR = {"HTTP_X_REQUESTED_WITH": "XMLHttpRequest"}
+
+
+class Queries:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def fetch(client, url, headers):
+    response = client.get(url, **headers)
+    body = b"".join(response.streaming_content) if response.streaming else response.content
+    return response.status_code, len(body)
+
+
+def measure(client, url, headers, repeat, cold):
+    timings = []
+    queries = Queries()
+
+    for _ in range(repeat):
+        if cold:
+            cache.clear()
+        queries.count = 0
+
+        with connection.execute_wrapper(queries):
+            start = time.perf_counter()
+            status, size = fetch(client, url, headers)
+            timings.append(time.perf_counter() - start)
+
+    # tracemalloc slows everything down, so memory gets its own run
+    if cold:
+        cache.clear()
+    tracemalloc.start()
+    fetch(client, url, headers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = np.array(timings) * 1000
+    return {
+        "status": status,
+        "ms_p50": round(float(np.median(timings)), 2),
+        "ms_max": round(float(timings.max()), 2),
+        "queries": queries.count,
+        "bytes": size,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def pick_sessions(prefix):
+    """(label, session) pairs: ended sessions by length, the longest live one."""
+    sessions = TrackingSession.objects.filter(
+        user__username__startswith=prefix
+    ).defer("track").select_related("user")
+
+    ended = sessions.filter(ended_at__isnull=False).order_by("point_count", "id")
+    count = ended.count()
+    picked = []
+
+    if count:
+        for label, quantile in QUANTILES:
+            picked.append((label, ended[round(quantile * (count - 1))]))
+
+    live = sessions.filter(ended_at__isnull=True).order_by("-point_count").first()
+    if live is not None:
+        picked.append(("live", live))
+
+    return picked
+
+
+def report(results, name, size, result):
+    results.append({"name": name, "size": size, **result})
+
+    flag = "" if result["status"] == 200 else f" ❌ {result['status']}"
+    print(
+        f"   {name:44}{size:>8}{result['ms_p50']:>10.1f}{result['ms_max']:>10.1f}"
+        f"{result['queries']:>6}{result['bytes'] / 1024:>10.1f}{result['peak_kib'] / 1024:>9.1f}{flag}"
+    )
+
+
+def run(args):
+    picked = pick_sessions(args.prefix)
+    if not picked:
+        print(f"   ❌ No {args.prefix}* sessions; run `manage.py generate_tracks` first")
+        sys.exit(1)
+
+    results = []
+    headers = {"HTTP_ACCEPT_ENCODING": "gzip"} if args.gzip else {}
+
+    print(f"\n   {'':44}{'size':>8}{'p50 ms':>10}{'max ms':>10}{'SQL':>6}{'KiB':>10}{'peak MiB':>9}")
+
+    # ---------------- session_map ----------------
+    client = Client()
+    for label, session in picked:
+        client.force_login(session.user)
+        url = reverse("session_map", args=[session.id])
+
+        variants = [
+            ("page", url, headers),
+            ("xhr", url, {**headers, **XHR}),
+            (f"xhr zoom {args.zoom}", f"{url}?zoom={args.zoom}", {**headers, **XHR}),
+        ]
+        for variant, variant_url, variant_headers in variants:
+            report(
+                results,
+                f"session_map {variant} ({label})",
+                session.point_count,
+                measure(client, variant_url, variant_headers, args.repeat, cold=True)
+            )
+
+            # Live sessions are never served from the cache
+            if session.ended_at is not None:
+                fetch(client, variant_url, variant_headers)
+                report(
+                    results,
+                    f"session_map {variant} ({label}, cached)",
+                    session.point_count,
+                    measure(client, variant_url, variant_headers, args.repeat, cold=False)
+                )
+
+    # ---------------- my_tracks ----------------
+    busiest = User.objects.filter(
+        username__startswith=args.prefix
+    ).annotate(
+        sessions=Count("trackingsession"),
+        points=Sum("trackingsession__point_count")
+    ).order_by("-sessions", "id").first()
+    client.force_login(busiest)
+    report(
+        results,
+        f"my_tracks ({busiest.sessions} sessions)",
+        busiest.points,
+        measure(client, reverse("my_tracks"), headers, args.repeat, cold=False)
+    )
+
+    # ---------------- admin ----------------
+    admin, _ = User.objects.get_or_create(
+        username=ADMIN_USERNAME,
+        defaults={"is_staff": True, "is_superuser": True}
+    )
+    client.force_login(admin)
+
+    changelist = reverse("admin:tracking_trackingsession_changelist")
+    listed = TrackingSession.objects.exclude(user__is_superuser=True).count()
+    for name, url in [
+        ("admin list", changelist),
+        ("admin list search", f"{changelist}?q={busiest.username}"),
+        ("admin list last page", f"{changelist}?p={max(listed - 1, 0) // 100 + 1}"),
+    ]:
+        report(results, name, listed, measure(client, url, headers, args.repeat, cold=False))
+
+    for label, session in picked:
+        if label in ("longest", "live"):
+            report(
+                results,
+                f"admin change ({label})",
+                session.point_count,
+                measure(
+                    client,
+                    reverse("admin:tracking_trackingsession_change", args=[session.id]),
+                    headers,
+                    args.repeat,
+                    cold=False
+                )
+            )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--prefix", default="synthetic_", help="Username prefix of the generated users")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed requests per measurement")
+    parser.add_argument("--zoom", type=int, default=14, help="Zoom level of the simplified XHR request")
+    parser.add_argument("--gzip", action="store_true", help="Accept gzip, as browsers do")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+
+    print("📚 Read Path Benchmark")
+    print("=" * 50)
+
+    try:
+        results = run(args)
+    finally:
+        User.objects.filter(username=ADMIN_USERNAME).delete()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    failed = [result["name"] for result in results if result["status"] != 200]
+    if failed:
+        print(f"\n   ❌ {len(failed)} requests failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
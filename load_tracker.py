@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+TrackingConsumer load harness
+Simulates many phones moving around and sending their points through
+WebsocketCommunicator, with an in-memory channel layer and a throwaway
+SQLite database (no testuser or DATABASE_URL needed).
+Each phone sends a batch every --interval seconds and now and then goes
+offline, coming back with a burst of buffered points.
+Reports frames/s, points/s, ack latency percentiles (frame sent until
+its points are stored) and database queries per frame.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import shutil
+import django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locatracker.settings')
+os.environ.setdefault('SECRET_KEY', 'load-harness')
+
+# A throwaway SQLite database and an in-memory channel layer, in place
+# before setup opens anything
+from django.conf import settings
+DB_DIR = tempfile.mkdtemp(prefix="load_tracker_")
+settings.DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(DB_DIR, "load.sqlite3"),
+        "OPTIONS": {"timeout": 20},
+    }
+}
+settings.CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+django.setup()
+
+import numpy as np
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.contrib.auth.models import User
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+
+import tracking.routing
+from tracking.models import TrackingSession
+from tracking.protocol import BINARY_SUBPROTOCOL, encode_frame
+
+
+# Meters per second, and how often each mode is picked
+SPEEDS = {"walk": 1.4, "bike": 5.0, "car": 12.0}
+MODE_WEIGHTS = {"walk": 4, "bike": 4, "car": 2}
+
+METERS_PER_DEGREE = 111320
+
+# Phones start around Pune, within about 20 km of each other
+CENTER = (18.5204, 73.8567)
+
+# As in the web client: larger offline backlogs go over HTTP upload,
+# and only the latest unacked points are kept for a resend
+MAX_BURST = 100
+MAX_UNACKED = 500
+
+
+class Queries:
+    count = 0
+    lock = threading.Lock()
+
+
+def count_query(execute, sql, params, many, context):
+    with Queries.lock:
+        Queries.count += 1
+    return execute(sql, params, many, context)
+
+
+def watch_connection(sender, connection, **kwargs):
+    # Every thread (the database executor's too) has its own connection
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def configure(throttle):
+    if not throttle:
+        off = {"frames": (0, 0), "points": (0, 0)}
+        settings.INGEST_THROTTLE = {"connection": off, "user": off}
+
+    call_command("migrate", verbosity=0)
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode=WAL")
+
+    connection_created.connect(watch_connection)
+
+
+class Phone:
+    """A device moving at its mode's speed, one GPS fix per second."""
+
+    def __init__(self, index, session, rng):
+        self.index = index
+        self.session = session
+        self.rng = rng
+
+        self.mode = rng.choices(list(MODE_WEIGHTS), weights=MODE_WEIGHTS.values())[0]
+        self.lat = CENTER[0] + rng.uniform(-0.2, 0.2)
+        self.lng = CENTER[1] + rng.uniform(-0.2, 0.2)
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.stopped = False
+        self.clock = datetime(2026, 1, 1, tzinfo=dt_timezone.utc) + timedelta(
+            seconds=rng.randint(0, 3600)
+        )
+
+        self.seq = 0
+        self.acked = 0
+        self.offline = []
+        self.unacked = []
+        # (last cseq, sent at) of frames waiting for their ack
+        self.in_flight = []
+        self.resend_at = None
+        self.done = False
+
+    def fix(self):
+        rng = self.rng
+        self.clock += timedelta(seconds=1)
+
+        # Traffic lights, coffee breaks: standing still makes GPS jitter
+        if self.stopped:
+            self.stopped = rng.random() > 0.05
+        else:
+            self.stopped = rng.random() < 0.01
+
+        if not self.stopped:
+            self.heading += rng.gauss(0, 0.2)
+            distance = max(SPEEDS[self.mode] * rng.gauss(1, 0.2), 0)
+            self.lat += distance * math.cos(self.heading) / METERS_PER_DEGREE
+            self.lng += distance * math.sin(self.heading) / (
+                METERS_PER_DEGREE * math.cos(math.radians(self.lat))
+            )
+
+        accuracy = abs(rng.gauss(5, 3)) + 2
+        noise = accuracy / 3 / METERS_PER_DEGREE
+
+        self.seq += 1
+        return {
+            "lat": round(self.lat + rng.gauss(0, noise), 6),
+            "lng": round(self.lng + rng.gauss(0, noise), 6),
+            "mode": self.mode,
+            "accuracy": round(accuracy, 1),
+            "timestamp": self.clock.isoformat().replace("+00:00", "Z"),
+            "ts_ms": int(self.clock.timestamp() * 1000),
+            "cseq": self.seq,
+        }
+
+
+class Stats:
+
+    def __init__(self):
+        self.frames = 0
+        self.points = 0
+        self.bursts = 0
+        self.throttled = 0
+        self.latencies = []
+
+
+def encode(phone, points, binary):
+    if binary:
+        return {"bytes_data": encode_frame(phone.session.id, points)}
+
+    return {"text_data": json.dumps({
+        "session_id": phone.session.id,
+        "locations": [
+            {key: point[key] for key in ("lat", "lng", "mode", "accuracy", "timestamp", "cseq")}
+            for point in points
+        ],
+    })}
+
+
+async def send(communicator, phone, points, stats, args, retry=False):
+    await communicator.send_to(**encode(phone, points, args.binary))
+
+    # A resent frame's latency still counts from its first send
+    if not retry:
+        phone.unacked = (phone.unacked + points)[-MAX_UNACKED:]
+        phone.in_flight.append((points[-1]["cseq"], time.perf_counter()))
+
+    stats.frames += 1
+    stats.points += len(points)
+
+
+async def resend(communicator, phone, stats, args):
+    # Frames sent while throttled were dropped unprocessed
+    phone.resend_at = None
+    if phone.unacked:
+        await send(communicator, phone, phone.unacked, stats, args, retry=True)
+
+
+async def receive(communicator, phone, stats):
+    while not (phone.done and phone.acked >= phone.seq):
+        # receive_from's timeout would cancel the consumer
+        if await communicator.receive_nothing(0.05):
+            continue
+
+        message = json.loads(await communicator.receive_from())
+
+        if message.get("type") == "ack":
+            now = time.perf_counter()
+            phone.acked = max(phone.acked, message["seq"])
+            phone.unacked = [p for p in phone.unacked if p["cseq"] > phone.acked]
+
+            while phone.in_flight and phone.in_flight[0][0] <= phone.acked:
+                stats.latencies.append(now - phone.in_flight.pop(0)[1])
+
+        elif message.get("type") == "throttle":
+            stats.throttled += 1
+            phone.resend_at = time.perf_counter() + message["retry_after"]
+
+
+async def run_phone(app, phone, stats, args):
+    subprotocols = [BINARY_SUBPROTOCOL] if args.binary else None
+    communicator = WebsocketCommunicator(app, "/ws/tracking/", subprotocols=subprotocols)
+    communicator.scope["user"] = phone.session.user
+    connected, _ = await communicator.connect()
+    assert connected
+
+    receiver = asyncio.create_task(receive(communicator, phone, stats))
+    rng = phone.rng
+
+    # Phones don't all report on the same tick
+    await asyncio.sleep(rng.uniform(0, args.interval))
+
+    for _ in range(args.frames):
+        size = rng.randint(1, 2 * args.batch - 1)
+        points = [phone.fix() for _ in range(size)]
+
+        # Like the web client, a throttled phone buffers until the
+        # back-off is over and then resends what is still unacked
+        if phone.resend_at is not None:
+            if phone.resend_at > time.perf_counter():
+                phone.offline += points
+                await asyncio.sleep(args.interval)
+                continue
+            await resend(communicator, phone, stats, args)
+            points, phone.offline = phone.offline + points, []
+
+        elif phone.offline or rng.random() < args.offline:
+            # Offline for a while; the backlog goes up in one burst
+            phone.offline += points
+            if len(phone.offline) < MAX_BURST and rng.random() > 0.1:
+                await asyncio.sleep(args.interval)
+                continue
+            points, phone.offline = phone.offline, []
+            stats.bursts += 1
+
+        await send(communicator, phone, points, stats, args)
+        await asyncio.sleep(args.interval)
+
+    if phone.offline:
+        await send(communicator, phone, phone.offline, stats, args)
+        phone.offline = []
+
+    phone.done = True
+    deadline = time.perf_counter() + args.timeout
+    while not receiver.done() and time.perf_counter() < deadline:
+        if phone.resend_at is not None and phone.resend_at <= time.perf_counter():
+            await resend(communicator, phone, stats, args)
+        await asyncio.sleep(0.05)
+
+    receiver.cancel()
+    await communicator.disconnect()
+
+
+async def run(phones, stats, args):
+    app = URLRouter(tracking.routing.websocket_urlpatterns)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run_phone(app, phone, stats, args) for phone in phones])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--phones", type=int, default=100)
+    parser.add_argument("--frames", type=int, default=30, help="Frames per phone")
+    parser.add_argument("--batch", type=int, default=5, help="Mean points per frame")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between frames (0: flat out)")
+    parser.add_argument("--offline", type=float, default=0.02, help="Chance per frame of going offline")
+    parser.add_argument("--binary", action="store_true", help="Use the binary frame protocol")
+    parser.add_argument("--throttle", action="store_true", help="Keep the configured ingest rate limits")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for the last acks")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    configure(args.throttle)
+
+    print("📱 TrackingConsumer Load Harness")
+    print("=" * 50)
+    print(f"   {args.phones} phones x {args.frames} frames, ~{args.batch} points each, every {args.interval}s")
+    print(f"   {'binary' if args.binary else 'JSON'} frames, throttle {'on' if args.throttle else 'off'}")
+
+    # One user per phone, so per-user limits apply as in production
+    User.objects.bulk_create([User(username=f"load_{i}") for i in range(args.phones)])
+    users = User.objects.filter(username__startswith="load_").order_by("id")
+    sessions = [
+        TrackingSession.objects.create(user=user)
+        for user in users
+    ]
+    for session, user in zip(sessions, users):
+        session.user = user
+
+    rng = random.Random(args.seed)
+    phones = [
+        Phone(i, session, random.Random(rng.random()))
+        for i, session in enumerate(sessions)
+    ]
+    stats = Stats()
+
+    queries_before = Queries.count
+    elapsed = asyncio.run(run(phones, stats, args))
+    queries = Queries.count - queries_before
+
+    stored = sum(TrackingSession.objects.filter(
+        id__in=[s.id for s in sessions]
+    ).values_list("point_count", flat=True))
+    unacked = sum(1 for phone in phones if phone.acked < phone.seq)
+
+    latencies = np.array(stats.latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+
+    print(f"\n   Frames sent:  {stats.frames} ({stats.bursts} offline bursts) in {elapsed:.2f} s")
+    print(f"   Points sent:  {stats.points}, stored {stored} (the rest filtered as jitter)")
+    print(f"   Ack latency:  p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms")
+    print(f"   DB queries:   {queries} ({queries / max(stats.frames, 1):.2f} per frame)")
+    if args.throttle:
+        print(f"   Throttled:    {stats.throttled} times")
+    print(f"   ➜ {stats.frames / elapsed:,.0f} frames/s, {stats.points / elapsed:,.0f} points/s")
+
+    if unacked:
+        print(f"   ❌ {unacked} phones are missing acks")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(DB_DIR, ignore_errors=True)
@@ -8,6 +8,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'locatracker.settings')
 django_asgi_app = get_asgi_application()
 
 import tracking.routing
+from tracking.profiler import start_watcher
+
+# Web workers only: lets `manage.py profile_worker` reach this process
+start_watcher()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
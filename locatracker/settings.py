@@ -168,10 +168,67 @@ CHANNEL_LAYERS = {
     },
 }
 
-ORS_API_KEY = os.getenv('ORS_API_KEY', "eyJvcmciOiI1YjNjZTM1OTc4NTExMTAwMDFjZjYyNDgiLCJpZCI6ImQ5MDQ0MzIwZTY4NTQxNWFiMWUxM2QwYWI3ZjQ1NTMzIiwiaCI6Im11cm11cjY0In0=")
-
-
-
-
+# Shared cache for routes and simplified tracks; per-process without Redis
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL"),
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
+# Write-behind ingest: accepted points are flushed to the database every
+# INGEST_FLUSH_INTERVAL_MS or once INGEST_FLUSH_MAX_POINTS are waiting
+INGEST_FLUSH_INTERVAL_MS = int(os.getenv("INGEST_FLUSH_INTERVAL_MS", 1000))
+INGEST_FLUSH_MAX_POINTS = int(os.getenv("INGEST_FLUSH_MAX_POINTS", 500))
+
+# Threads for the consumers' database work (state loads, ingest flushes);
+# each keeps its own connection, so this is also a per-process ceiling
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 4))
+
+# Ingest token buckets per connection and per user (in one worker):
+# (tokens per second, burst). A rate of 0 turns that bucket off. The
+# point bursts leave room for a reconnecting client's resend.
+INGEST_THROTTLE = {
+    "connection": {
+        "frames": (int(os.getenv("INGEST_CONN_FRAMES_PER_SEC", 5)), 20),
+        "points": (int(os.getenv("INGEST_CONN_POINTS_PER_SEC", 50)), 1000),
+    },
+    "user": {
+        "frames": (int(os.getenv("INGEST_USER_FRAMES_PER_SEC", 10)), 40),
+        "points": (int(os.getenv("INGEST_USER_POINTS_PER_SEC", 100)), 2000),
+    },
+}
 
+ORS_API_KEY = os.getenv('ORS_API_KEY', "eyJvcmciOiI1YjNjZTM1OTc4NTExMTAwMDFjZjYyNDgiLCJpZCI6ImQ5MDQ0MzIwZTY4NTQxNWFiMWUxM2QwYWI3ZjQ1NTMzIiwiaCI6Im11cm11cjY0In0=")
 
+# OpenRouteService proxy (get_route); point ORS_BASE_URL at a stub to test
+ORS_BASE_URL = os.getenv('ORS_BASE_URL', "https://api.openrouteservice.org")
+ORS_TIMEOUT = float(os.getenv('ORS_TIMEOUT', 10))
+ORS_MAX_CONCURRENCY = int(os.getenv('ORS_MAX_CONCURRENCY', 8))
+
+# Route cache: coordinates are snapped to ROUTE_CACHE_GRID degrees
+# (about 22 m) so nearby requests share an entry
+ROUTE_CACHE_TTL = int(os.getenv('ROUTE_CACHE_TTL', 3600))
+ROUTE_CACHE_GRID = float(os.getenv('ROUTE_CACHE_GRID', 0.0002))
+ROUTE_CACHE_LOCAL_SIZE = int(os.getenv('ROUTE_CACHE_LOCAL_SIZE', 128))
+
+# Prometheus metrics at /metrics. With several workers per host, set
+# METRICS_DIR: each worker writes its values there every
+# METRICS_WRITE_INTERVAL seconds and the endpoint adds them up.
+# Scrapers authenticate with METRICS_TOKEN as a bearer token; without
+# one, only staff can read the metrics.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_WRITE_INTERVAL = float(os.getenv('METRICS_WRITE_INTERVAL', 5))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Where web workers pick up `manage.py profile_worker` requests and leave
+# their profiles; off unless set. Anyone who can write there can start a
+# profile, so it is created 0700 and not used if others can get in
+PROFILE_DIR = os.getenv('PROFILE_DIR', '')
@@ -24,6 +24,7 @@ urlpatterns = [
     path('', views.home, name='home'), 
     path('tracking/', include('tracking.urls')),           
     path('accounts/', include('django.contrib.auth.urls')),  
+    path('metrics', views.metrics, name='metrics'),
 ]
 
 
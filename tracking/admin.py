@@ -1,9 +1,13 @@
 from django.contrib import admin
 from django.urls import reverse
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django.utils.safestring import mark_safe
+from .export import export_response
 from .models import TrackingSession
 
+# Keep the change view light for multi-hour sessions
+ADMIN_POINTS_LIMIT = 500
+
 
 @admin.register(TrackingSession)
 class TrackingSessionAdmin(admin.ModelAdmin):
@@ -19,6 +23,8 @@ class TrackingSessionAdmin(admin.ModelAdmin):
         "view_map",
     )
     
+    actions = ("export_gpx", "export_geojson", "export_csv")
+
     search_fields = ("user__username",)
     ordering = ("-started_at",)
 
@@ -29,7 +35,8 @@ class TrackingSessionAdmin(admin.ModelAdmin):
         "ended_at",
         "formatted_distance",
         "formatted_time",
-        "locations",
+        "point_count",
+        "track_points",
     )
     
     fields = (
@@ -39,13 +46,14 @@ class TrackingSessionAdmin(admin.ModelAdmin):
         "ended_at",
         "formatted_distance",
         "formatted_time",
-        "locations",
+        "point_count",
+        "track_points",
     )
 
     
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.exclude(user__is_superuser=True)
+        return qs.exclude(user__is_superuser=True).defer("track")
 
 
     def view_map(self, obj):
@@ -84,3 +92,50 @@ class TrackingSessionAdmin(admin.ModelAdmin):
 
     formatted_time.short_description = "Total Time"
 
+
+    def track_points(self, obj):
+        points = obj.get_track()[:ADMIN_POINTS_LIMIT]
+
+        rows = format_html_join(
+            "\n",
+            "{}. {}, {} ({}) {}",
+            (
+                (p["seq"], p["lat"], p["lng"], p["mode"], p["timestamp"])
+                for p in points
+            )
+        )
+
+        if obj.point_count > ADMIN_POINTS_LIMIT:
+            rows = format_html(
+                "{}\n... {} more points",
+                rows,
+                obj.point_count - ADMIN_POINTS_LIMIT
+            )
+
+        return format_html("<pre>{}</pre>", rows)
+
+    track_points.short_description = "Locations"
+
+
+    # Bulk exports stream gzip-compressed, session after session
+    def export_sessions(self, request, queryset, fmt):
+        return export_response(
+            request,
+            queryset.order_by("id"),
+            fmt,
+            "tracks",
+            gzipped=True
+        )
+
+    @admin.action(description="Export selected sessions as GPX")
+    def export_gpx(self, request, queryset):
+        return self.export_sessions(request, queryset, "gpx")
+
+    @admin.action(description="Export selected sessions as GeoJSON")
+    def export_geojson(self, request, queryset):
+        return self.export_sessions(request, queryset, "geojson")
+
+    @admin.action(description="Export selected sessions as CSV")
+    def export_csv(self, request, queryset):
+        return self.export_sessions(request, queryset, "csv")
+
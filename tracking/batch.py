@@ -0,0 +1,531 @@
+"""Vectorized filtering for batches of GPS points.
+
+Applies the same rules as TrackingConsumer.process_point (duplicate,
+per-mode minimum distance, negative time, time-gap cap) to a whole
+batch at once with NumPy. Batches of fewer than SCALAR_BELOW points go
+through a plain loop instead: there NumPy's per-call overhead costs
+more than the loop.
+"""
+
+import hashlib
+import json
+import math
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+EARTH_RADIUS = 6371000  # meters
+
+# Points closer than this to the previous accepted point are GPS jitter
+MIN_DISTANCE = {
+    "walk": 8,
+    "bike": 12,
+    "car": 25
+}
+DEFAULT_MIN_DISTANCE = 2
+
+# Gaps longer than MAX_TIME_GAP seconds count as CAPPED_TIME_GAP
+MAX_TIME_GAP = 300
+CAPPED_TIME_GAP = 60
+
+# Candidates checked at once against a non-adjacent anchor
+WINDOW = 64
+
+# Below this many points select() loops in Python; about where the two
+# cost the same for a run of accepted points
+SCALAR_BELOW = 48
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def filter_rules():
+    """The rules above, as totals are derived with them."""
+    return {
+        "min_distance": MIN_DISTANCE,
+        "default_min_distance": DEFAULT_MIN_DISTANCE,
+        "max_time_gap": MAX_TIME_GAP,
+        "capped_time_gap": CAPPED_TIME_GAP,
+    }
+
+
+def rules_version():
+    """Short fingerprint of filter_rules(), stored with each session."""
+    rules = json.dumps(filter_rules(), sort_keys=True)
+    return hashlib.sha1(rules.encode()).hexdigest()[:12]
+
+
+class NoAnchor:
+    """Anchor for a batch that starts a session: no previous point."""
+
+    last_lat = None
+    last_lng = None
+    last_timestamp = None
+
+
+NO_ANCHOR = NoAnchor()
+
+
+def haversine_array(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(lat1)
+        * np.cos(lat2)
+        * np.sin(dlng / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(lat1)
+        * math.cos(lat2)
+        * math.sin(dlng / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def valid_coordinates(lat, lng):
+    """Finite and on the globe; anything else would poison the totals."""
+    return (
+        math.isfinite(lat) and math.isfinite(lng)
+        and -90 <= lat <= 90 and -180 <= lng <= 180
+    )
+
+
+def parse_timestamp(ts, now):
+    if not ts:
+        return now
+
+    parsed = parse_datetime(ts)
+
+    if parsed is None:
+        return now
+
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+
+    return parsed
+
+
+def to_epoch_us(dt):
+    return (dt - EPOCH) // ONE_MICROSECOND
+
+
+def thin_indices(length, count):
+    """Indices of at most count of length items, evenly spaced and
+    always including the last."""
+    if count <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    return np.unique(
+        np.linspace(length - 1, 0, count).round().astype(np.intp)
+    )
+
+
+class BatchResult:
+    """Accepted batch indices with their increments, plus rejection counts."""
+
+    __slots__ = ("indices", "distance", "time", "rejected")
+
+    def __init__(self, indices, distance, time, rejected):
+        self.indices = indices
+        self.distance = distance
+        self.time = time
+        self.rejected = rejected
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class PointBatch:
+    """Column arrays for a batch of incoming points."""
+
+    __slots__ = ("lat", "lng", "ts_us", "timestamps", "modes", "mode_codes", "seqs")
+
+    def __init__(self, lat, lng, timestamps, modes, seqs=None):
+        mode_names = list(dict.fromkeys(modes))
+        codes = {mode: i for i, mode in enumerate(mode_names)}
+
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.timestamps = timestamps
+        self.ts_us = np.fromiter(
+            (to_epoch_us(ts) for ts in timestamps),
+            dtype=np.int64,
+            count=len(timestamps)
+        )
+        self.modes = mode_names
+        self.mode_codes = np.fromiter(
+            (codes[mode] for mode in modes),
+            dtype=np.intp,
+            count=len(modes)
+        )
+        # Client sequence numbers, when every point has one
+        self.seqs = None if seqs is None else np.asarray(seqs, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_records(cls, records, modes, scale):
+        """Build a batch from a binary frame's record array.
+
+        Timestamps stay epoch-ms integers; datetimes are only made for
+        the points that get accepted. Records with an unknown mode code
+        or coordinates off the globe are dropped.
+        """
+        lat = records["lat"] / scale
+        lng = records["lng"] / scale
+        keep = (
+            (records["mode"] < len(modes))
+            & (np.abs(lat) <= 90)
+            & (np.abs(lng) <= 180)
+        )
+        records = records[keep]
+
+        batch = cls.__new__(cls)
+        batch.lat = lat[keep]
+        batch.lng = lng[keep]
+        batch.ts_us = records["ts_ms"].astype(np.int64) * 1000
+        batch.timestamps = None
+        batch.modes = list(modes)
+        batch.mode_codes = records["mode"].astype(np.intp)
+        batch.seqs = (
+            records["seq"].astype(np.int64)
+            if "seq" in records.dtype.names else None
+        )
+        return batch
+
+    @classmethod
+    def from_columns(cls, lat, lng, ts_us, modes):
+        """Build a batch from plain columns (epoch-µs timestamps)."""
+        mode_names = list(dict.fromkeys(modes))
+        codes = {mode: i for i, mode in enumerate(mode_names)}
+
+        batch = cls.__new__(cls)
+        batch.lat = np.asarray(lat, dtype=np.float64)
+        batch.lng = np.asarray(lng, dtype=np.float64)
+        batch.ts_us = np.asarray(ts_us, dtype=np.int64)
+        batch.timestamps = None
+        batch.modes = mode_names
+        batch.mode_codes = np.fromiter(
+            (codes[mode] for mode in modes),
+            dtype=np.intp,
+            count=len(modes)
+        )
+        batch.seqs = None
+        return batch
+
+    def unseen(self, high_water):
+        """The points with a client seq above high_water.
+
+        Replayed frames are dropped without looking at each point.
+        """
+        if self.seqs is None or not len(self.seqs) or self.seqs[0] > high_water:
+            return self
+
+        if self.seqs[-1] <= high_water:
+            return self.take(np.empty(0, dtype=np.intp))
+
+        return self.take(np.flatnonzero(self.seqs > high_water))
+
+    def thin(self, count):
+        """At most count points, evenly spaced, always keeping the last
+        (so the client's high-water mark still moves to its end)."""
+        if count >= len(self):
+            return self
+
+        return self.take(thin_indices(len(self), count))
+
+    def take(self, indices):
+        batch = PointBatch.__new__(PointBatch)
+        batch.lat = self.lat[indices]
+        batch.lng = self.lng[indices]
+        batch.ts_us = self.ts_us[indices]
+        batch.timestamps = (
+            None if self.timestamps is None
+            else [self.timestamps[i] for i in indices.tolist()]
+        )
+        batch.modes = self.modes
+        batch.mode_codes = self.mode_codes[indices]
+        batch.seqs = None if self.seqs is None else self.seqs[indices]
+        return batch
+
+    def timestamp(self, i):
+        if self.timestamps is not None:
+            return self.timestamps[i]
+
+        return EPOCH + timedelta(microseconds=int(self.ts_us[i]))
+
+    @classmethod
+    def from_dicts(cls, points):
+        """Build a batch from client dicts, dropping unparseable points,
+        ones off the globe (or NaN) and ones with a mode the filters
+        don't know."""
+        now = timezone.now()
+
+        lat = []
+        lng = []
+        timestamps = []
+        modes = []
+        seqs = []
+
+        for loc in points:
+            try:
+                point_lat = float(loc.get("lat"))
+                point_lng = float(loc.get("lng"))
+                if not valid_coordinates(point_lat, point_lng):
+                    continue
+                timestamp = parse_timestamp(loc.get("timestamp"), now)
+                mode = loc.get("mode", "bike")
+                if mode not in MIN_DISTANCE:
+                    continue
+                seq = loc.get("cseq")
+                if seq is not None:
+                    seq = int(seq)
+            except (AttributeError, TypeError, ValueError):
+                continue
+
+            lat.append(point_lat)
+            lng.append(point_lng)
+            timestamps.append(timestamp)
+            modes.append(mode)
+            seqs.append(seq)
+
+        if None in seqs:
+            seqs = None
+
+        return cls(lat, lng, timestamps, modes, seqs)
+
+    def min_distance(self, thresholds=None):
+        thresholds = MIN_DISTANCE if thresholds is None else thresholds
+
+        table = np.array(
+            [thresholds.get(mode, DEFAULT_MIN_DISTANCE) for mode in self.modes],
+            dtype=np.float64
+        )
+        return table[self.mode_codes]
+
+    def select(self, anchor, thresholds=None,
+               max_time_gap=MAX_TIME_GAP, capped_time_gap=CAPPED_TIME_GAP):
+        """Pick the points process_point would accept, in order.
+
+        anchor is anything with last_lat/last_lng/last_timestamp (a
+        TrackingSession or SessionState). It is not modified.
+        """
+        n = len(self)
+        lat, lng, ts = self.lat, self.lng, self.ts_us
+        min_distance = self.min_distance(thresholds)
+
+        if n < SCALAR_BELOW:
+            return self.select_scalar(anchor, min_distance, max_time_gap, capped_time_gap)
+
+        rejected = {"duplicate": 0, "min_distance": 0, "negative_time": 0}
+
+        if n == 0:
+            return BatchResult(
+                np.empty(0, dtype=np.intp),
+                np.empty(0),
+                np.empty(0),
+                rejected
+            )
+
+        # Every point checked against the raw point just before it. This
+        # is exact whenever that predecessor was itself accepted.
+        next_distance = np.zeros(n)
+        next_distance[1:] = haversine_array(lat[:-1], lng[:-1], lat[1:], lng[1:])
+        next_duplicate = np.zeros(n, dtype=bool)
+        next_duplicate[1:] = (lat[1:] == lat[:-1]) & (lng[1:] == lng[:-1])
+        next_dt = np.zeros(n, dtype=np.int64)
+        next_dt[1:] = ts[1:] - ts[:-1]
+
+        next_ok = (
+            ~next_duplicate
+            & (next_distance >= min_distance)
+            & (next_dt >= 0)
+        )
+        breaks = (np.flatnonzero(~next_ok[1:]) + 1).tolist()
+
+        # Every point checked against the raw point two before it, which
+        # settles the common case of a single rejected point in a run.
+        skip_distance = np.zeros(n)
+        skip_distance[2:] = haversine_array(lat[:-2], lng[:-2], lat[2:], lng[2:])
+        skip_dt = np.zeros(n, dtype=np.int64)
+        skip_dt[2:] = ts[2:] - ts[:-2]
+        skip_ok = np.zeros(n, dtype=bool)
+        skip_ok[2:] = (
+            ~((lat[2:] == lat[:-2]) & (lng[2:] == lng[:-2]))
+            & (skip_distance[2:] >= min_distance[2:])
+            & (skip_dt[2:] >= 0)
+        )
+
+        anchor_lat = anchor.last_lat
+        anchor_lng = anchor.last_lng
+        anchor_ts = (
+            to_epoch_us(anchor.last_timestamp)
+            if anchor.last_timestamp else None
+        )
+        anchor_index = None
+        anchor_raw = None
+
+        accepted = np.zeros(n, dtype=bool)
+        distance_out = np.zeros(n)
+        dt_out = np.zeros(n, dtype=np.int64)
+
+        i = 0
+        while i < n:
+            if anchor_index is not None and anchor_index == i - 1:
+                # Consecutive run: accept up to the next break
+                b = bisect_left(breaks, i)
+                j = breaks[b] if b < len(breaks) else n
+
+                if j > i:
+                    accepted[i:j] = True
+                    distance_out[i:j] = next_distance[i:j]
+                    dt_out[i:j] = next_dt[i:j]
+                    anchor_index = j - 1
+                    i = j
+                    continue
+
+                if next_duplicate[i]:
+                    rejected["duplicate"] += 1
+                elif next_distance[i] < min_distance[i]:
+                    rejected["min_distance"] += 1
+                else:
+                    rejected["negative_time"] += 1
+
+                anchor_lat = lat[i - 1]
+                anchor_lng = lng[i - 1]
+                anchor_ts = int(ts[i - 1])
+                anchor_raw = i - 1
+                anchor_index = None
+                i += 1
+                continue
+
+            if anchor_raw is not None and anchor_raw == i - 2 and skip_ok[i]:
+                accepted[i] = True
+                distance_out[i] = skip_distance[i]
+                dt_out[i] = skip_dt[i]
+                anchor_index = i
+                i += 1
+                continue
+
+            # Anchor is further back: test a window of candidates against it
+            stop = min(n, i + WINDOW)
+
+            if anchor_lat is not None and anchor_lng is not None:
+                duplicate = (lat[i:stop] == anchor_lat) & (lng[i:stop] == anchor_lng)
+                distance = haversine_array(
+                    anchor_lat, anchor_lng, lat[i:stop], lng[i:stop]
+                )
+                too_close = distance < min_distance[i:stop]
+            else:
+                duplicate = np.zeros(stop - i, dtype=bool)
+                distance = np.zeros(stop - i)
+                too_close = duplicate
+
+            if anchor_ts is not None:
+                dt = ts[i:stop] - anchor_ts
+                backwards = dt < 0
+            else:
+                dt = np.zeros(stop - i, dtype=np.int64)
+                backwards = np.zeros(stop - i, dtype=bool)
+
+            ok = ~duplicate & ~too_close & ~backwards
+            hits = np.flatnonzero(ok)
+            k = int(hits[0]) if len(hits) else stop - i
+
+            too_close = too_close[:k] & ~duplicate[:k]
+            rejected["duplicate"] += int(np.count_nonzero(duplicate[:k]))
+            rejected["min_distance"] += int(np.count_nonzero(too_close))
+            rejected["negative_time"] += int(np.count_nonzero(
+                backwards[:k] & ~duplicate[:k] & ~too_close
+            ))
+
+            if k == stop - i:
+                i = stop
+                continue
+
+            accepted[i + k] = True
+            distance_out[i + k] = distance[k]
+            dt_out[i + k] = dt[k]
+            anchor_index = i + k
+            i = i + k + 1
+
+        indices = np.flatnonzero(accepted)
+        time = dt_out[indices] / 10 ** 6
+        time[time > max_time_gap] = capped_time_gap
+
+        return BatchResult(indices, distance_out[indices], time, rejected)
+
+    def select_scalar(self, anchor, min_distance, max_time_gap, capped_time_gap):
+        """select() for small batches, one point at a time."""
+        rejected = {"duplicate": 0, "min_distance": 0, "negative_time": 0}
+
+        last_lat = anchor.last_lat
+        last_lng = anchor.last_lng
+        last_ts = (
+            to_epoch_us(anchor.last_timestamp)
+            if anchor.last_timestamp else None
+        )
+
+        indices = []
+        distances = []
+        times = []
+
+        for i, (lat, lng, ts, limit) in enumerate(zip(
+            self.lat.tolist(),
+            self.lng.tolist(),
+            self.ts_us.tolist(),
+            min_distance.tolist()
+        )):
+            if lat == last_lat and lng == last_lng:
+                rejected["duplicate"] += 1
+                continue
+
+            distance = 0.0
+            if last_lat is not None and last_lng is not None:
+                distance = haversine(last_lat, last_lng, lat, lng)
+                if distance < limit:
+                    rejected["min_distance"] += 1
+                    continue
+
+            dt = 0
+            if last_ts is not None:
+                dt = ts - last_ts
+                if dt < 0:
+                    rejected["negative_time"] += 1
+                    continue
+
+            indices.append(i)
+            distances.append(distance)
+            times.append(dt)
+            last_lat, last_lng, last_ts = lat, lng, ts
+
+        time = np.array(times, dtype=np.int64) / 10 ** 6
+        time[time > max_time_gap] = capped_time_gap
+
+        return BatchResult(
+            np.array(indices, dtype=np.intp),
+            np.array(distances, dtype=np.float64),
+            time,
+            rejected
+        )
@@ -0,0 +1,351 @@
+"""Packed columnar encoding for a session's points.
+
+Layout (little-endian)::
+
+    header      magic, version, count, base timestamp and the last point
+    modes       u8 count, then u8 length + utf-8 name per mode
+    columns     u8 count, then (tag, dtype, offset) per column
+    body        zlib-compressed column arrays, count items each
+
+Coordinates are fixed-point (1e-7 degrees) and delta-encoded, timestamps
+are epoch milliseconds delta-encoded from the header's base, and modes
+are indexes into the mode table. The header alone is enough for
+len() and tail(); the body is only inflated when points are read.
+
+Packing is lossy: coordinates are rounded to 1e-7 degrees (about 1 cm),
+timestamps to the millisecond, and distance and time increments are
+stored as float32 (about 7 significant digits). Session totals are kept
+on the session, not summed back from the packed increments.
+"""
+
+import struct
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+
+
+MAGIC = b"LTRK"
+VERSION = 1
+
+COORD_SCALE = 10 ** 7
+
+HEADER = struct.Struct("<4sBIqiiqB")
+COLUMN = struct.Struct("<4s2sI")
+
+# Compressed bytes fed to, and inflated bytes taken from, zlib per step
+# when a body is streamed
+INFLATE_INPUT = 64 * 1024
+INFLATE_OUTPUT = 1024 * 1024
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+# tag -> dtype of the stored column
+COLUMNS = {
+    b"dlat": "i4",
+    b"dlng": "i4",
+    b"dtms": "i8",
+    b"mode": "u1",
+    b"dist": "f4",
+    b"time": "f4",
+}
+
+
+def encode_track(lat, lng, ts_ms, modes, distance, time):
+    """Pack parallel point columns into bytes.
+
+    modes is a list of mode names, one per point; the other arguments
+    are numeric sequences of the same length. Raises ValueError for
+    anything the layout cannot hold.
+    """
+    count = len(lat)
+
+    lat_e7 = np.rint(np.asarray(lat, dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    lng_e7 = np.rint(np.asarray(lng, dtype=np.float64) * COORD_SCALE).astype(np.int64)
+    ts_ms = np.asarray(ts_ms, dtype=np.int64)
+
+    mode_names = list(dict.fromkeys(modes))
+    if len(mode_names) > 255:
+        raise ValueError("Too many distinct modes to pack")
+
+    encoded_names = [name.encode() for name in mode_names]
+    if any(len(name) > 255 for name in encoded_names):
+        raise ValueError("Mode name too long to pack")
+
+    codes = {mode: i for i, mode in enumerate(mode_names)}
+
+    base_ts = int(ts_ms[0]) if count else 0
+
+    columns = {
+        b"dlat": np.diff(lat_e7, prepend=0),
+        b"dlng": np.diff(lng_e7, prepend=0),
+        b"dtms": np.diff(ts_ms, prepend=base_ts),
+        b"mode": np.fromiter((codes[m] for m in modes), dtype=np.int64, count=count),
+        b"dist": np.asarray(distance, dtype=np.float64),
+        b"time": np.asarray(time, dtype=np.float64),
+    }
+
+    parts = []
+    directory = [struct.pack("<B", len(columns))]
+    offset = 0
+
+    for tag, values in columns.items():
+        dtype = COLUMNS[tag]
+        packed = values.astype("<" + dtype)
+
+        if dtype[0] in "iu" and not np.array_equal(packed, values):
+            raise ValueError(f"Column {tag.decode()} does not fit {dtype}")
+
+        data = packed.tobytes()
+        directory.append(COLUMN.pack(tag, dtype.encode(), offset))
+        parts.append(data)
+        offset += len(data)
+
+    if count:
+        last = (
+            int(lat_e7[-1]),
+            int(lng_e7[-1]),
+            int(ts_ms[-1]),
+            codes[modes[-1]],
+        )
+    else:
+        last = (0, 0, 0, 0)
+
+    header = HEADER.pack(MAGIC, VERSION, count, base_ts, *last)
+
+    mode_table = [struct.pack("<B", len(mode_names))]
+    for name in encoded_names:
+        mode_table.append(struct.pack("<B", len(name)) + name)
+
+    return b"".join([
+        header,
+        *mode_table,
+        *directory,
+        zlib.compress(b"".join(parts), 6),
+    ])
+
+
+class ColumnStream:
+    """One column of a packed body, inflated only as far as it is read.
+
+    Every column stream runs its own decompressor over the body, so
+    reading a track chunk by chunk keeps just a chunk of each column in
+    memory (at the cost of inflating the columns before it to skip them).
+    """
+
+    def __init__(self, compressed, dtype, offset):
+        self.dtype = np.dtype(dtype)
+        self.compressed = compressed
+        self.consumed = 0
+        self.inflater = zlib.decompressobj()
+        self.buffer = bytearray()
+
+        while offset:
+            self.fill(min(offset, INFLATE_OUTPUT))
+            skipped = min(offset, len(self.buffer))
+            del self.buffer[:skipped]
+            offset -= skipped
+
+    def fill(self, size):
+        while len(self.buffer) < size:
+            data = self.inflater.unconsumed_tail
+            if not data:
+                data = self.compressed[self.consumed:self.consumed + INFLATE_INPUT]
+                self.consumed += len(data)
+                if not data:
+                    raise ValueError("Packed track body is truncated")
+
+            self.buffer += self.inflater.decompress(data, INFLATE_OUTPUT)
+
+    def read(self, count):
+        size = count * self.dtype.itemsize
+        self.fill(size)
+
+        values = np.frombuffer(bytes(self.buffer[:size]), dtype=self.dtype)
+        del self.buffer[:size]
+        return values
+
+
+def ms_to_datetime(ms):
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+class PackedTrack:
+    """Read-only, lazily decoded view of an encoded track.
+
+    Indexing is by position (seq - 1). Integers return one point dict,
+    slices return a list of them.
+    """
+
+    def __init__(self, data):
+        data = memoryview(data)
+
+        (
+            magic, version, self.count, self.base_ts,
+            self._last_lat, self._last_lng, self._last_ts, self._last_mode
+        ) = HEADER.unpack_from(data, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a packed track")
+
+        pos = HEADER.size
+
+        (mode_count,) = struct.unpack_from("<B", data, pos)
+        pos += 1
+        self.modes = []
+        for _ in range(mode_count):
+            (length,) = struct.unpack_from("<B", data, pos)
+            pos += 1
+            self.modes.append(bytes(data[pos:pos + length]).decode())
+            pos += length
+
+        (column_count,) = struct.unpack_from("<B", data, pos)
+        pos += 1
+        self._directory = {}
+        for _ in range(column_count):
+            tag, dtype, offset = COLUMN.unpack_from(data, pos)
+            self._directory[tag] = ("<" + dtype.decode(), offset)
+            pos += COLUMN.size
+
+        self._compressed = data[pos:]
+        self._body = None
+        self._cache = {}
+
+    def __len__(self):
+        return self.count
+
+    def tail(self):
+        """Last point without inflating the body."""
+        if not self.count:
+            return None
+
+        return {
+            "seq": self.count,
+            "lat": self._last_lat / COORD_SCALE,
+            "lng": self._last_lng / COORD_SCALE,
+            "mode": self.modes[self._last_mode],
+            "timestamp": ms_to_datetime(self._last_ts),
+        }
+
+    def column(self, tag):
+        if self._body is None:
+            self._body = zlib.decompress(self._compressed)
+
+        dtype, offset = self._directory[tag]
+        return np.frombuffer(self._body, dtype=dtype, count=self.count, offset=offset)
+
+    def _decoded(self, name):
+        values = self._cache.get(name)
+        if values is not None:
+            return values
+
+        if name == "lat":
+            values = np.cumsum(self.column(b"dlat"), dtype=np.int64) / COORD_SCALE
+        elif name == "lng":
+            values = np.cumsum(self.column(b"dlng"), dtype=np.int64) / COORD_SCALE
+        elif name == "ts_ms":
+            values = self.base_ts + np.cumsum(self.column(b"dtms"), dtype=np.int64)
+
+        self._cache[name] = values
+        return values
+
+    def columns(self, start=0, stop=None):
+        """Decoded column arrays for positions [start, stop)."""
+        window = slice(start, stop)
+
+        return {
+            "lat": self._decoded("lat")[window],
+            "lng": self._decoded("lng")[window],
+            "ts_ms": self._decoded("ts_ms")[window],
+            "mode": self.column(b"mode")[window],
+            "distance_increment": self.column(b"dist")[window],
+            "time_increment": self.column(b"time")[window],
+        }
+
+    def iter_columns(self, chunk_size):
+        """(start, columns) for every chunk_size points, streaming the
+        body instead of inflating it whole."""
+        streams = {
+            tag: ColumnStream(self._compressed, dtype, offset)
+            for tag, (dtype, offset) in self._directory.items()
+        }
+
+        # Running sums carried over from the previous chunk
+        lat = lng = 0
+        ts = self.base_ts
+
+        for start in range(0, self.count, chunk_size):
+            count = min(chunk_size, self.count - start)
+            raw = {tag: stream.read(count) for tag, stream in streams.items()}
+
+            lat_e7 = lat + np.cumsum(raw[b"dlat"], dtype=np.int64)
+            lng_e7 = lng + np.cumsum(raw[b"dlng"], dtype=np.int64)
+            ts_ms = ts + np.cumsum(raw[b"dtms"], dtype=np.int64)
+            lat, lng, ts = int(lat_e7[-1]), int(lng_e7[-1]), int(ts_ms[-1])
+
+            yield start, {
+                "lat": lat_e7 / COORD_SCALE,
+                "lng": lng_e7 / COORD_SCALE,
+                "ts_ms": ts_ms,
+                "mode": raw[b"mode"],
+                "distance_increment": raw[b"dist"],
+                "time_increment": raw[b"time"],
+            }
+
+    def iter_points(self, chunk_size):
+        """Point dicts, chunk_size at a time, in bounded memory."""
+        for start, columns in self.iter_columns(chunk_size):
+            stop = start + len(columns["lat"])
+            yield self._build(range(start + 1, stop + 1), columns)
+
+    def points(self, start=0, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.count)
+        return self._build(range(start + 1, stop + 1), self.columns(start, stop))
+
+    def points_at(self, indices):
+        """Point dicts at the given positions (an integer array)."""
+        columns = {
+            name: values[indices]
+            for name, values in self.columns().items()
+        }
+        return self._build((indices + 1).tolist(), columns)
+
+    def _build(self, seqs, columns):
+        modes = self.modes
+
+        return [
+            {
+                "seq": seq,
+                "lat": lat,
+                "lng": lng,
+                "mode": modes[mode],
+                "timestamp": ms_to_datetime(ts),
+                "distance_increment": distance,
+                "time_increment": time,
+            }
+            for seq, lat, lng, mode, ts, distance, time in zip(
+                seqs,
+                columns["lat"].tolist(),
+                columns["lng"].tolist(),
+                columns["mode"].tolist(),
+                columns["ts_ms"].tolist(),
+                columns["distance_increment"].tolist(),
+                columns["time_increment"].tolist(),
+            )
+        ]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise ValueError("Packed tracks only support contiguous slices")
+            return self.points(key.start, key.stop)
+
+        index = key + self.count if key < 0 else key
+        if not 0 <= index < self.count:
+            raise IndexError("Point index out of range")
+
+        return self.points(index, index + 1)[0]
+
+    def __iter__(self):
+        for start in range(0, self.count, 2000):
+            yield from self.points(start, start + 2000)
@@ -227,12 +227,165 @@
 import json
 import math
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import TrackingSession
+from channels.consumer import get_handler_name
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from .models import TrackingSession, TrackingPoint
+from .batch import (
+    PointBatch,
+    thin_indices,
+    valid_coordinates,
+    MIN_DISTANCE,
+    DEFAULT_MIN_DISTANCE,
+    MAX_TIME_GAP,
+    CAPPED_TIME_GAP,
+)
+from .dbexecutor import get_db_executor
+from .ingest import apply_batch, get_ingest_buffer
+from .metrics import (
+    FRAMES_RECEIVED,
+    POINTS_ACCEPTED,
+    POINTS_FILTERED,
+    POINTS_RECEIVED,
+    WS_CONNECTIONS,
+)
+from .throttle import IngestThrottle, counters as throttle_counters
+from .protocol import (
+    BINARY_SUBPROTOCOL,
+    COORD_SCALE,
+    MODES,
+    FrameError,
+    decode_frame,
+)
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.contrib.auth.models import User
 
+
+# Closed with this when buffered points were dropped; the client
+# reconnects and resends everything it has no ack for
+DROPPED_CLOSE_CODE = 4001
+
+
+# JSON frames with fewer points go through process_point one by one:
+# below about this size that costs less than building a PointBatch
+# (see bench_hotpath.py). Live clients send 10 at a time.
+SCALAR_FRAME_BELOW = 100
+
+
+def session_group_name(session_id):
+    return f"tracking_session_{session_id}"
+
+
+def viewer_group_name(session_id):
+    return f"tracking_view_{session_id}"
+
+
+def notify_session_stopped(session_id):
+    """Tell consumers holding this session's tail to reload it, and
+    viewers watching it that the trip is over."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    try:
+        async_to_sync(channel_layer.group_send)(
+            session_group_name(session_id),
+            {"type": "session.reload", "session_id": session_id}
+        )
+        async_to_sync(channel_layer.group_send)(
+            viewer_group_name(session_id),
+            {"type": "session.ended", "session_id": session_id}
+        )
+    except Exception as e:
+        print("Session stop notify error:", e)
+
+
+def notify_session_changed(state, points):
+    """Points were stored outside the WebSocket (e.g. an upload): have
+    consumers reload the tail and show the points to viewers."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    try:
+        async_to_sync(channel_layer.group_send)(
+            session_group_name(state.id),
+            {"type": "session.reload", "session_id": state.id}
+        )
+        if points:
+            async_to_sync(channel_layer.group_send)(
+                viewer_group_name(state.id),
+                points_message(points, state)
+            )
+    except Exception as e:
+        print("Session change notify error:", e)
+
+
+def points_message(points, state):
+    return {
+        "type": "track.points",
+        "seq": state.point_count,
+        "total_distance": state.total_distance,
+        "total_time": state.total_time,
+        "locations": [serialize_point(point) for point in points],
+    }
+
+
+def serialize_point(point):
+    return {
+        "seq": point.seq,
+        "lat": point.lat,
+        "lng": point.lng,
+        "mode": point.mode,
+        "timestamp": point.timestamp.isoformat(),
+        "distance_increment": point.distance_increment,
+        "time_increment": point.time_increment,
+    }
+
+
+class SessionState:
+    """Tail of a session kept in memory for the lifetime of a connection.
+
+    Holds just enough to run process_point without reloading the
+    session row on every frame.
+    """
+
+    FIELDS = (
+        "id",
+        "total_distance",
+        "total_time",
+        "point_count",
+        "last_lat",
+        "last_lng",
+        "last_timestamp",
+        "client_seq",
+    )
+
+    # stale: the stored tail moved on without this connection (its
+    # points were renumbered on flush); reload before the next frame.
+    # dropped: points taken from this tail were never stored.
+    __slots__ = FIELDS + ("stale", "dropped")
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values[field])
+        self.stale = False
+        self.dropped = False
+
+
+def fetch_state(session_id, user):
+    values = TrackingSession.objects.filter(
+        id=session_id,
+        user=user
+    ).values(*SessionState.FIELDS).first()
+
+    if values is None:
+        return None
+
+    return SessionState(**values)
+
+
 class TrackingConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
@@ -243,9 +396,40 @@ class TrackingConsumer(AsyncWebsocketConsumer):
             return
 
         self.user = user
-        await self.accept()
+        self.state = None
+        self.buffer = get_ingest_buffer()
+        self.throttle = IngestThrottle(user.id)
+        self.throttle_sent = 0
+
+        # Clients that offer the binary protocol send packed batches
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get("subprotocols", [])
+        if self.binary:
+            await self.accept(subprotocol=BINARY_SUBPROTOCOL)
+        else:
+            await self.accept()
+
+        self.protocol = "binary" if self.binary else "json"
+        WS_CONNECTIONS.inc(self.protocol)
+
+    async def dispatch(self, message):
+        # Channels checks the database connection before every handler,
+        # a hop through the one thread-sensitive thread for each frame.
+        # Queries here run on the database executor, which does that
+        # check around each call itself.
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError(f"No handler for message type {message['type']}")
+
+        await handler(message)
 
     async def disconnect(self, close_code):
+        if getattr(self, "state", None) is not None:
+            await self.buffer.flush_session(self.state.id)
+
+        await self.forget_state()
+
+        if getattr(self, "protocol", None) is not None:
+            WS_CONNECTIONS.dec(self.protocol)
         print("WebSocket Closed")
 
 
@@ -265,40 +449,138 @@ class TrackingConsumer(AsyncWebsocketConsumer):
         return parsed
 
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        FRAMES_RECEIVED.inc("json" if bytes_data is None else "binary")
+
+        # Checked before parsing: a flood costs as little as possible
+        retry_after = self.throttle.frame()
+        if retry_after is not None:
+            await self.send_throttle(retry_after)
+            return
+
+        if bytes_data is not None:
+            await self.receive_frame(bytes_data)
+            return
+
         try:
             data = json.loads(text_data)
             session_id = data.get("session_id")
 
-            session = await self.get_session(session_id)
-            if not session:
+            state = await self.get_state(session_id)
+            if not state:
                 return
 
             if "locations" in data:
-                await self.save_location_batch(session, data["locations"])
+                await self.save_location_batch(state, data["locations"])
             else:
                 await self.save_location(
-                    session,
+                    state,
                     data.get("lat"),
                     data.get("lng"),
                     data.get("mode", "bike"),
-                    data.get("timestamp")
+                    data.get("timestamp"),
+                    data.get("cseq")
                 )
 
         except Exception as e:
+            # The cached tail may be ahead of the database now
+            self.reset_state()
             print("WebSocket receive error:", e)
 
 
-    @database_sync_to_async
-    def get_session(self, session_id):
+    async def receive_frame(self, bytes_data):
+        if not self.binary:
+            print("Binary frame on a JSON connection ignored")
+            return
+
+        try:
+            session_id, records = decode_frame(bytes_data)
+        except FrameError as e:
+            print("Bad binary frame:", e)
+            return
+
         try:
-            return TrackingSession.objects.get(
-                id=session_id,
-                user=self.user
+            state = await self.get_state(session_id)
+            if not state:
+                return
+
+            POINTS_RECEIVED.inc(amount=len(records))
+            await self.save_batch(
+                state,
+                PointBatch.from_records(records, MODES, COORD_SCALE)
             )
-        except TrackingSession.DoesNotExist:
+
+        except Exception as e:
+            self.reset_state()
+            print("WebSocket receive error:", e)
+
+
+    # ---------------- SESSION STATE ----------------
+
+    async def get_state(self, session_id):
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
+            return None
+
+        if self.state is not None and self.state.dropped:
+            # The client_seq in memory covers points that are not
+            # stored, so nothing more is taken on this connection. On
+            # reconnect the tail (and client_seq) comes from the
+            # database and the client resends its unacked points.
+            await self.close(code=DROPPED_CLOSE_CODE)
+            return None
+
+        if self.state is not None and self.state.id == session_id and not self.state.stale:
+            return self.state
+
+        await self.forget_state()
+
+        # Buffered points must land before the tail is read back
+        await self.buffer.flush_session(session_id)
+
+        state = await self.load_state(session_id)
+        if state is None:
             return None
 
+        if self.channel_layer is not None:
+            await self.channel_layer.group_add(
+                session_group_name(session_id),
+                self.channel_name
+            )
+
+        self.state = state
+        return state
+
+    async def forget_state(self):
+        state = getattr(self, "state", None)
+        self.state = None
+
+        if state is not None and self.channel_layer is not None:
+            await self.channel_layer.group_discard(
+                session_group_name(state.id),
+                self.channel_name
+            )
+
+    async def session_reload(self, event):
+        # Sent by stop_tracking and uploads; reload the tail on the next frame
+        await self.buffer.flush_session(event["session_id"])
+
+        if self.state is not None and self.state.id == event["session_id"]:
+            self.reset_state()
+
+    def reset_state(self):
+        # Reload the tail on the next frame; a dropped one is kept, so
+        # that frame closes the connection instead
+        if self.state is not None and not self.state.dropped:
+            self.state = None
+
+    async def load_state(self, session_id):
+        # On the database executor: loads for many connections run at once
+        return await get_db_executor().run(
+            fetch_state, session_id, self.user
+        )
+
 
 
     def haversine(self, lat1, lng1, lat2, lng2):
@@ -327,13 +609,24 @@ class TrackingConsumer(AsyncWebsocketConsumer):
             lat = float(lat)
             lng = float(lng)
         except:
-            return False
+            POINTS_FILTERED.inc("invalid")
+            return None
+
+        if not valid_coordinates(lat, lng):
+            POINTS_FILTERED.inc("invalid")
+            return None
+
+        # Stored as-is, so only modes the filters know
+        if not isinstance(mode, str) or mode not in MIN_DISTANCE:
+            POINTS_FILTERED.inc("invalid")
+            return None
 
         timestamp = self.parse_timestamp(timestamp)
 
         # Ignore exact duplicate
         if session.last_lat == lat and session.last_lng == lng:
-            return False
+            POINTS_FILTERED.inc("duplicate")
+            return None
 
         distance_increment = 0
         time_increment = 0
@@ -347,14 +640,11 @@ class TrackingConsumer(AsyncWebsocketConsumer):
                 lng
             )
 
-            min_distance = {
-                "walk": 8,
-                "bike": 12,
-                "car": 25
-            }.get(mode, 2)
+            min_distance = MIN_DISTANCE.get(mode, DEFAULT_MIN_DISTANCE)
 
             if distance_increment < min_distance:
-                return False
+                POINTS_FILTERED.inc("min_distance")
+                return None
 
         # Time
         if session.last_timestamp:
@@ -363,62 +653,284 @@ class TrackingConsumer(AsyncWebsocketConsumer):
             ).total_seconds()
 
             if time_increment < 0:
-                return False
+                POINTS_FILTERED.inc("negative_time")
+                return None
 
             # Cap unrealistic time jumps
-            if time_increment > 300:
-                time_increment = 60
+            if time_increment > MAX_TIME_GAP:
+                time_increment = CAPPED_TIME_GAP
 
         session.total_distance += distance_increment
         session.total_time += time_increment
-
-        locations = session.locations or []
-        locations.append({
-            "lat": lat,
-            "lng": lng,
-            "mode": mode,
-            "timestamp": str(timestamp),
-            "distance_increment": distance_increment,
-            "time_increment": time_increment
-        })
-        session.locations = locations
+        session.point_count += 1
+
+        point = TrackingPoint.build(
+            session.id,
+            session.point_count,
+            lat,
+            lng,
+            mode,
+            timestamp,
+            distance_increment,
+            time_increment
+        )
 
         session.last_lat = lat
         session.last_lng = lng
         session.last_timestamp = timestamp
 
-        return True
+        return point
+
 
+    # Accepted points go to the write-behind buffer, which appends them
+    # as new rows and bumps the session totals in one transaction.
 
-    @database_sync_to_async
-    def save_location(self, session, lat, lng, mode="bike", timestamp=None):
-        updated = self.process_point(
-            session, lat, lng, mode, timestamp
+    async def save_location(self, state, lat, lng, mode="bike", timestamp=None, cseq=None):
+        POINTS_RECEIVED.inc()
+
+        if cseq is not None:
+            cseq = int(cseq)
+            if cseq <= state.client_seq:
+                POINTS_FILTERED.inc("replayed")
+                await self.buffer.when_written(state, self.send_ack)
+                return
+
+        if not self.throttle.points(1):
+            POINTS_FILTERED.inc("throttled")
+            await self.send_throttle(self.throttle.retry_after())
+            return
+
+        point = self.process_point(
+            state, lat, lng, mode, timestamp
         )
+        if point:
+            POINTS_ACCEPTED.inc()
+
+        if cseq is not None:
+            state.client_seq = cseq
+
+        if point or cseq is not None:
+            self.buffer.add(state, [point] if point else [])
+
+        if point:
+            await self.publish_points(state, [point])
+
+        if cseq is not None:
+            await self.buffer.when_written(state, self.send_ack)
+
+
+    async def save_location_batch(self, state, points):
+        POINTS_RECEIVED.inc(amount=len(points))
+
+        if len(points) < SCALAR_FRAME_BELOW:
+            await self.save_points(state, points)
+            return
+
+        batch = PointBatch.from_dicts(points)
+        POINTS_FILTERED.inc("invalid", amount=len(points) - len(batch))
+        await self.save_batch(state, batch)
+
+
+    async def save_batch(self, state, batch):
+        # Points the client already sent (a retry or replay) cost nothing
+        seen = state.client_seq
+        fresh = batch.unseen(seen)
+        POINTS_FILTERED.inc("replayed", amount=len(batch) - len(fresh))
+
+        # Over the point limit: keep what there are tokens for
+        granted = await self.grant_points(len(fresh))
+        if granted < len(fresh):
+            thinned = fresh.thin(granted)
+            POINTS_FILTERED.inc("throttled", amount=len(fresh) - len(thinned))
+            if not granted:
+                return
+            fresh = thinned
+
+        result = fresh.select(state)
+        accepted = apply_batch(state, fresh, result)
+
+        POINTS_ACCEPTED.inc(amount=len(accepted))
+        for reason, count in result.rejected.items():
+            POINTS_FILTERED.inc(reason, amount=count)
 
-        if updated:
-            session.save()
+        await self.store_points(state, accepted, seen, batch.seqs is not None)
 
 
-    @database_sync_to_async
-    def save_location_batch(self, session, points):
-        updated = False
+    async def save_points(self, state, points):
+        """save_batch for a small frame of client dicts, one point at a
+        time with process_point."""
+        entries = []
+        sequenced = True
 
         for loc in points:
             try:
-                result = self.process_point(
-                    session,
-                    loc.get("lat"),
-                    loc.get("lng"),
-                    loc.get("mode", "bike"),
-                    loc.get("timestamp")
-                )
+                cseq = loc.get("cseq")
+                if cseq is not None:
+                    cseq = int(cseq)
+            except (AttributeError, TypeError, ValueError):
+                POINTS_FILTERED.inc("invalid")
+                continue
 
-                if result:
-                    updated = True
+            if cseq is None:
+                sequenced = False
+            entries.append((loc, cseq))
+
+        # Points the client already sent (a retry or replay) cost nothing
+        seen = state.client_seq
+        fresh = entries
+        if sequenced:
+            fresh = [entry for entry in entries if entry[1] > seen]
+            POINTS_FILTERED.inc("replayed", amount=len(entries) - len(fresh))
+
+        # Over the point limit: keep what there are tokens for
+        granted = await self.grant_points(len(fresh))
+        if granted < len(fresh):
+            thinned = [fresh[i] for i in thin_indices(len(fresh), granted).tolist()]
+            POINTS_FILTERED.inc("throttled", amount=len(fresh) - len(thinned))
+            if not granted:
+                return
+            fresh = thinned
+
+        accepted = []
+        for loc, cseq in fresh:
+            point = self.process_point(
+                state,
+                loc.get("lat"),
+                loc.get("lng"),
+                loc.get("mode", "bike"),
+                loc.get("timestamp")
+            )
+            if point:
+                accepted.append(point)
 
-            except:
-                continue
+            # Rejected points count as seen too
+            if sequenced:
+                state.client_seq = max(state.client_seq, cseq)
+
+        POINTS_ACCEPTED.inc(amount=len(accepted))
+
+        await self.store_points(state, accepted, seen, sequenced)
+
+
+    async def grant_points(self, count):
+        """How many of count points the point limit lets in; tells the
+        client when that is fewer."""
+        granted = self.throttle.points(count)
+
+        if not granted and count:
+            await self.send_throttle(self.throttle.retry_after())
+        elif granted < count:
+            await self.send_throttle(0, coalesced=count - granted)
+
+        return granted
+
+
+    async def store_points(self, state, accepted, seen, sequenced):
+        if accepted or state.client_seq > seen:
+            self.buffer.add(state, accepted)
+
+        await self.publish_points(state, accepted)
+
+        if sequenced:
+            await self.buffer.when_written(state, self.send_ack)
+
+
+    async def send_ack(self, session_id, client_seq):
+        # Everything up to client_seq is in the database; the client can
+        # drop it from its retry buffer
+        await self.send(text_data=json.dumps({
+            "type": "ack",
+            "session_id": session_id,
+            "seq": client_seq,
+        }))
+
+
+    async def send_throttle(self, retry_after, coalesced=0):
+        # Once per back-off window; every batch that was thinned
+        if retry_after:
+            if self.throttle_sent == self.throttle.blocked_until:
+                return
+            self.throttle_sent = self.throttle.blocked_until
+
+        throttle_counters["messages_sent"] += 1
+        await self.send(text_data=json.dumps({
+            "type": "throttle",
+            "retry_after": round(retry_after, 3),
+            "coalesced": coalesced,
+        }))
+
+
+    # ---------------- LIVE VIEWERS ----------------
+
+    async def publish_points(self, state, points):
+        # Viewers get points as soon as they are accepted, before the
+        # buffer writes them; a page that missed some catches up over HTTP
+        if not points or self.channel_layer is None:
+            return
+
+        try:
+            await self.channel_layer.group_send(
+                viewer_group_name(state.id),
+                points_message(points, state)
+            )
+        except Exception as e:
+            print("Viewer publish error:", e)
+
+
+class TrackingViewerConsumer(AsyncWebsocketConsumer):
+    """Read-only feed of one session's new points for the map page.
+
+    Joins the session's viewer group; nothing here touches the database
+    after the permission check on connect.
+    """
+
+    async def connect(self):
+        user = self.scope["user"]
+        self.group_name = None
+
+        if not user.is_authenticated or self.channel_layer is None:
+            await self.close()
+            return
+
+        session_id = int(self.scope["url_route"]["kwargs"]["session_id"])
+
+        if not await self.can_view(user, session_id):
+            await self.close()
+            return
+
+        self.group_name = viewer_group_name(session_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if self.group_name is not None:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # Viewers only listen
+        pass
+
+    async def can_view(self, user, session_id):
+        owner_id = await TrackingSession.objects.filter(
+            id=session_id
+        ).values_list("user_id", flat=True).afirst()
+
+        if owner_id is None:
+            return False
+
+        return user.is_superuser or owner_id == user.id
+
+    async def track_points(self, event):
+        await self.send(text_data=json.dumps({
+            "type": "points",
+            "seq": event["seq"],
+            "total_distance": event["total_distance"],
+            "total_time": event["total_time"],
+            "locations": event["locations"],
+        }))
 
-        if updated:
-            session.save()
\ No newline at end of file
+    async def session_ended(self, event):
+        await self.send(text_data=json.dumps({"type": "ended"}))
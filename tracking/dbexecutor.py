@@ -0,0 +1,92 @@
+"""Bounded thread pool for the consumers' database work.
+
+database_sync_to_async (and Django's async ORM methods, which wrap the
+sync ORM the same way) runs thread-sensitive calls one at a time on a
+single thread per process. State loads and ingest flushes don't share
+any thread-local state, so they run here instead: up to
+DB_EXECUTOR_WORKERS at once, each worker keeping its own connection.
+Calls beyond that wait in the pool's queue; the depth is in stats().
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class DatabaseExecutor:
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="tracking-db"
+        )
+
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.started = 0
+        self.finished = 0
+        self.peak_queued = 0
+
+    def call(self, func):
+        with self._lock:
+            self.started += 1
+
+        # Same connection handling as database_sync_to_async
+        close_old_connections()
+        try:
+            return func()
+        finally:
+            close_old_connections()
+            with self._lock:
+                self.finished += 1
+
+    def dropped(self, future):
+        # Cancelled while still queued: call never ran
+        if future.cancelled():
+            with self._lock:
+                self.started += 1
+                self.finished += 1
+
+    async def run(self, func, *args, **kwargs):
+        with self._lock:
+            self.submitted += 1
+            # Calls that can't start until a worker frees up
+            self.peak_queued = max(
+                self.peak_queued,
+                self.submitted - self.finished - self.workers
+            )
+
+        future = self.pool.submit(self.call, functools.partial(func, *args, **kwargs))
+        future.add_done_callback(self.dropped)
+
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self.submitted - self.started,
+                "running": self.started - self.finished,
+                "completed": self.finished,
+                "peak_queued": self.peak_queued,
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = DatabaseExecutor(settings.DB_EXECUTOR_WORKERS)
+
+    return _executor
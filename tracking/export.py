@@ -0,0 +1,196 @@
+"""Streaming track export as GPX, GeoJSON or CSV.
+
+Sessions are written point chunk by point chunk straight into the
+response: packed tracks are inflated as they are read and point rows
+come through a chunked iterator (a server-side cursor on PostgreSQL),
+so memory stays flat however long the tracks are. Output can be
+gzip-compressed on the fly.
+"""
+
+import csv
+import json
+import zlib
+from xml.sax.saxutils import escape
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+# Sessions fetched per query for multi-session exports; their tracks are
+# still read one session at a time
+SESSION_CHUNK_SIZE = 100
+
+CSV_COLUMNS = (
+    "session_id",
+    "seq",
+    "lat",
+    "lng",
+    "timestamp",
+    "mode",
+    "distance_increment",
+    "time_increment",
+)
+
+
+def iso(timestamp):
+    return timestamp.isoformat().replace("+00:00", "Z")
+
+
+def iter_sessions(sessions):
+    """Sessions with their track blob loaded one at a time."""
+    if hasattr(sessions, "iterator"):
+        sessions = sessions.select_related("user").defer("track").iterator(
+            chunk_size=SESSION_CHUNK_SIZE
+        )
+
+    for session in sessions:
+        yield session
+        # Let the blob go before the next session's is read
+        session.__dict__.pop("track", None)
+
+
+def gpx_parts(sessions):
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx version="1.1" creator="LocaTracker" '
+        'xmlns="http://www.topografix.com/GPX/1/1">\n'
+    )
+
+    for session in iter_sessions(sessions):
+        name = escape(f"{session.user.username} - Session {session.id}")
+        yield f"<trk><name>{name}</name><type>{escape(session.mode)}</type><trkseg>\n"
+
+        for chunk in session.get_track().iter_chunks(EXPORT_CHUNK_SIZE):
+            yield "".join(
+                f'<trkpt lat="{p["lat"]:.7f}" lon="{p["lng"]:.7f}">'
+                f'<time>{iso(p["timestamp"])}</time>'
+                f'<type>{escape(p["mode"])}</type></trkpt>\n'
+                for p in chunk
+            )
+
+        yield "</trkseg></trk>\n"
+
+    yield "</gpx>\n"
+
+
+def geojson_parts(sessions):
+    """A FeatureCollection with one Point feature per point."""
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separator = ""
+
+    for session in iter_sessions(sessions):
+        for chunk in session.get_track().iter_chunks(EXPORT_CHUNK_SIZE):
+            features = ",\n".join(
+                json.dumps({
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [p["lng"], p["lat"]]},
+                    "properties": {
+                        "session_id": session.id,
+                        "seq": p["seq"],
+                        "timestamp": iso(p["timestamp"]),
+                        "mode": p["mode"],
+                        "distance_increment": round(p["distance_increment"], 3),
+                        "time_increment": round(p["time_increment"], 3),
+                    },
+                })
+                for p in chunk
+            )
+            yield separator + features
+            separator = ",\n"
+
+    yield "\n]}\n"
+
+
+class Echo:
+    """File-like object for csv.writer that hands back each row."""
+
+    def write(self, value):
+        return value
+
+
+def csv_parts(sessions):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+
+    for session in iter_sessions(sessions):
+        for chunk in session.get_track().iter_chunks(EXPORT_CHUNK_SIZE):
+            yield "".join(
+                writer.writerow((
+                    session.id,
+                    p["seq"],
+                    p["lat"],
+                    p["lng"],
+                    iso(p["timestamp"]),
+                    p["mode"],
+                    round(p["distance_increment"], 3),
+                    round(p["time_increment"], 3),
+                ))
+                for p in chunk
+            )
+
+
+# format -> (file extension, content type, writer)
+FORMATS = {
+    "gpx": ("gpx", "application/gpx+xml", gpx_parts),
+    "geojson": ("geojson", "application/geo+json", geojson_parts),
+    "csv": ("csv", "text/csv", csv_parts),
+}
+
+
+def encode_parts(parts):
+    for part in parts:
+        yield part.encode()
+
+
+def gzip_parts(parts, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for part in parts:
+        data = compressor.compress(part.encode())
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+async def pull(parts):
+    """Serve a sync generator over ASGI one part at a time.
+
+    Django reads a sync iterator into a list before streaming it from
+    ASGI. This steps it on the request's thread instead, so the cursor
+    stays on one connection and only a part is held at once.
+    """
+    step = sync_to_async(next, thread_sensitive=True)
+    done = object()
+
+    try:
+        while True:
+            part = await step(parts, done)
+            if part is done:
+                return
+            yield part
+    finally:
+        await sync_to_async(parts.close, thread_sensitive=True)()
+
+
+def export_response(request, sessions, fmt, filename, gzipped=False):
+    """StreamingHttpResponse with sessions' points in fmt (a FORMATS key)."""
+    extension, content_type, writer = FORMATS[fmt]
+    filename = f"{filename}.{extension}"
+
+    if gzipped:
+        parts = gzip_parts(writer(sessions))
+        content_type = "application/gzip"
+        filename += ".gz"
+    else:
+        parts = encode_parts(writer(sessions))
+
+    if isinstance(request, ASGIRequest):
+        parts = pull(parts)
+
+    response = StreamingHttpResponse(parts, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,460 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, DataError, IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .dbexecutor import get_db_executor
+from .metrics import FLUSH_SECONDS
+from .models import TrackingSession, TrackingPoint
+
+
+logger = logging.getLogger(__name__)
+
+
+class PendingSession:
+    """Accepted points for one session that are not in the database yet."""
+
+    __slots__ = (
+        "session_id",
+        "points",
+        "distance",
+        "time",
+        "last_lat",
+        "last_lng",
+        "last_timestamp",
+        "client_seq",
+        "listeners",
+        "states",
+        "renumbered",
+    )
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.points = []
+        self.distance = 0
+        self.time = 0
+        self.last_lat = None
+        self.last_lng = None
+        self.last_timestamp = None
+        self.client_seq = 0
+        # Called with (session_id, client_seq) once this batch is written
+        self.listeners = []
+        # Connections' tails the points were taken from
+        self.states = []
+        self.renumbered = False
+
+    def add(self, state, points):
+        self.points.extend(points)
+
+        for point in points:
+            self.distance += point.distance_increment
+            self.time += point.time_increment
+
+        self.last_lat = state.last_lat
+        self.last_lng = state.last_lng
+        self.last_timestamp = state.last_timestamp
+        self.client_seq = state.client_seq
+
+        if not any(known is state for known in self.states):
+            self.states.append(state)
+
+    def listen(self, listener):
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def merge(self, newer):
+        # Put a failed batch back in front of what arrived since
+        self.points.extend(newer.points)
+        self.distance += newer.distance
+        self.time += newer.time
+        self.last_lat = newer.last_lat
+        self.last_lng = newer.last_lng
+        self.last_timestamp = newer.last_timestamp
+        self.client_seq = newer.client_seq
+        for listener in newer.listeners:
+            self.listen(listener)
+        for state in newer.states:
+            if not any(known is state for known in self.states):
+                self.states.append(state)
+
+
+def apply_batch(state, batch, result):
+    """Turn a PointBatch selection into TrackingPoints and advance state."""
+    indices = result.indices
+    modes = batch.modes
+    points = []
+
+    for lat, lng, mode_code, timestamp_index, distance, time_increment in zip(
+        batch.lat[indices].tolist(),
+        batch.lng[indices].tolist(),
+        batch.mode_codes[indices].tolist(),
+        indices.tolist(),
+        result.distance.tolist(),
+        result.time.tolist()
+    ):
+        state.total_distance += distance
+        state.total_time += time_increment
+        state.point_count += 1
+
+        points.append(TrackingPoint.build(
+            state.id,
+            state.point_count,
+            lat,
+            lng,
+            modes[mode_code],
+            batch.timestamp(timestamp_index),
+            distance,
+            time_increment
+        ))
+
+    if points:
+        last = points[-1]
+        state.last_lat = last.lat
+        state.last_lng = last.lng
+        state.last_timestamp = last.timestamp
+
+    # Rejected points count as seen too
+    if batch.seqs is not None and len(batch.seqs):
+        state.client_seq = max(state.client_seq, int(batch.seqs.max()))
+
+    return points
+
+
+def write_session(batch):
+    """Append one session's pending points and move its totals.
+
+    Totals are applied as increments so a flush that lands after
+    stop_tracking adds to the final numbers instead of overwriting them.
+    Returns False, writing nothing, if the session is gone.
+    """
+    updated = TrackingSession.objects.filter(id=batch.session_id).update(
+        total_distance=F("total_distance") + batch.distance,
+        total_time=F("total_time") + batch.time,
+        point_count=F("point_count") + len(batch.points),
+        last_lat=batch.last_lat,
+        last_lng=batch.last_lng,
+        last_timestamp=batch.last_timestamp,
+        client_seq=Greatest("client_seq", batch.client_seq)
+    )
+
+    if not updated:
+        return False
+
+    TrackingPoint.objects.bulk_create(batch.points)
+    return True
+
+
+def renumber(batch):
+    """Move batch's points after the session's stored tail.
+
+    The points' increments stay as they were measured from the tail the
+    connection had; only their seqs change.
+    """
+    point_count = TrackingSession.objects.filter(
+        id=batch.session_id
+    ).values_list("point_count", flat=True).first()
+
+    if point_count is None:
+        return False
+
+    for seq, point in enumerate(batch.points, point_count + 1):
+        point.seq = seq
+
+    return True
+
+
+def write_pending(batches):
+    """Persist several sessions' pending points in one transaction.
+
+    Each session is written in its own savepoint, so one that fails
+    leaves the others' points in. A session whose tail was stale (its
+    seqs are taken) is renumbered after the stored tail and written
+    again. Returns {session_id: reason} for the sessions that could not
+    be written; their points are not retried.
+    """
+    dropped = {}
+
+    with transaction.atomic():
+        for batch in batches:
+            try:
+                with transaction.atomic():
+                    if write_session(batch):
+                        continue
+                dropped[batch.session_id] = "session is gone"
+                continue
+            except DataError as e:
+                dropped[batch.session_id] = e
+                continue
+            except IntegrityError:
+                pass
+
+            # Someone else appended to the session since its tail was read
+            try:
+                if not renumber(batch):
+                    dropped[batch.session_id] = "session is gone"
+                    continue
+
+                with transaction.atomic():
+                    write_session(batch)
+                batch.renumbered = True
+            except (DataError, IntegrityError) as e:
+                dropped[batch.session_id] = e
+
+    return dropped
+
+
+class IngestBuffer:
+    """Write-behind buffer for accepted points, one per event loop.
+
+    Points are grouped per session and flushed together every
+    flush_interval seconds, or as soon as max_points are waiting.
+    """
+
+    def __init__(self, flush_interval, max_points):
+        self.flush_interval = flush_interval
+        self.max_points = max_points
+
+        self.loop = asyncio.get_running_loop()
+        self.pending = {}
+        self.size = 0
+
+        # Batches being written, by session, and when each write is done.
+        # A session is in at most one write at a time; single-session
+        # flushes (connect, disconnect, reload) don't wait for a round
+        # writing other sessions.
+        self.writing = {}
+        self.written = {}
+
+        # One full round at a time, so a round picks up everything that
+        # arrived while the previous one was writing
+        self._round = asyncio.Lock()
+        self._scheduler = None
+        self._flushes = set()
+
+    def add(self, state, points):
+        # points may be empty when only the client high-water mark moved
+        batch = self.pending.get(state.id)
+        if batch is None:
+            batch = self.pending[state.id] = PendingSession(state.id)
+
+        batch.add(state, points)
+        self.size += len(points)
+
+        if self.size >= self.max_points:
+            task = self.loop.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        else:
+            self._schedule()
+
+    def _schedule(self):
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = self.loop.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self, session_ids=None):
+        if session_ids is None:
+            async with self._round:
+                # Sessions already being written go in the next round
+                await self.write(list(self.pending))
+        else:
+            # Their earlier points must land before these
+            await self.wait_written(session_ids)
+            await self.write(session_ids)
+
+    async def write(self, session_ids):
+        batches = [
+            self.pending.pop(session_id)
+            for session_id in session_ids
+            if session_id in self.pending and session_id not in self.writing
+        ]
+
+        if not batches:
+            return
+
+        self.size -= sum(len(batch.points) for batch in batches)
+
+        done = self.loop.create_future()
+        for batch in batches:
+            self.writing[batch.session_id] = batch
+            self.written[batch.session_id] = done
+
+        start = time.perf_counter()
+        result = "ok"
+        dropped = {}
+        try:
+            dropped = await get_db_executor().run(write_pending, batches)
+        except (DataError, IntegrityError) as e:
+            # Failed at commit: retrying would fail the same way
+            result = "dropped"
+            dropped = {batch.session_id: e for batch in batches}
+        except DatabaseError as e:
+            # The database or the connection, not the points
+            result = "retry"
+            logger.warning("Ingest flush failed, will retry: %s", e)
+            self.requeue(batches)
+            return
+        finally:
+            if result == "ok" and dropped:
+                result = "dropped"
+            FLUSH_SECONDS.observe(time.perf_counter() - start, result)
+            for batch in batches:
+                del self.writing[batch.session_id]
+                del self.written[batch.session_id]
+            done.set_result(None)
+
+        # Before anything else runs: no frame may be added, or acked,
+        # on top of points that are gone
+        for batch in batches:
+            if batch.session_id in dropped:
+                self.drop(batch, dropped[batch.session_id])
+
+        for batch in batches:
+            if batch.session_id in dropped:
+                continue
+
+            if batch.renumbered:
+                # The connections' tails are behind the database
+                for state in batch.states:
+                    state.stale = True
+
+            for listener in batch.listeners:
+                await notify(listener, batch.session_id, batch.client_seq)
+
+    async def wait_written(self, session_ids):
+        while True:
+            writes = {
+                self.written[session_id]
+                for session_id in session_ids
+                if session_id in self.written
+            }
+            if not writes:
+                return
+
+            await asyncio.wait(writes)
+
+    def drop(self, batch, reason):
+        """Forget a session's points that could not be written.
+
+        Its newer pending points go too: acking them would tell the
+        client the dropped ones are stored (acks are a high-water mark).
+        The connections are marked dropped and start over from what
+        the database has, and the client resends what was not acked.
+        """
+        states = list(batch.states)
+        count = len(batch.points)
+
+        newer = self.pending.pop(batch.session_id, None)
+        if newer is not None:
+            self.size -= len(newer.points)
+            count += len(newer.points)
+            states += newer.states
+
+        for state in states:
+            state.dropped = True
+
+        logger.error(
+            "Ingest flush dropped %d points of session %s: %s",
+            count, batch.session_id, reason
+        )
+
+    def requeue(self, batches):
+        for batch in batches:
+            newer = self.pending.get(batch.session_id)
+            if newer is not None:
+                batch.merge(newer)
+
+            self.pending[batch.session_id] = batch
+
+        self.size = sum(len(batch.points) for batch in self.pending.values())
+        self._schedule()
+
+    async def flush_session(self, session_id):
+        await self.flush([session_id])
+
+    async def when_written(self, state, listener):
+        """Call listener(session_id, client_seq) once state's points are
+        in the database: after the next flush, or now if none are pending.
+        Never called for points that were dropped."""
+        if state.dropped:
+            return
+
+        batch = self.pending.get(state.id) or self.writing.get(state.id)
+
+        if batch is not None:
+            batch.listen(listener)
+        else:
+            await notify(listener, state.id, state.client_seq)
+
+
+async def notify(listener, session_id, client_seq):
+    try:
+        await listener(session_id, client_seq)
+    except Exception as e:
+        logger.warning("Ingest listener error: %s", e)
+
+
+_buffer = None
+
+
+def get_ingest_buffer():
+    global _buffer
+
+    loop = asyncio.get_running_loop()
+    if _buffer is None or _buffer.loop is not loop:
+        _buffer = IngestBuffer(
+            flush_interval=settings.INGEST_FLUSH_INTERVAL_MS / 1000,
+            max_points=settings.INGEST_FLUSH_MAX_POINTS
+        )
+
+    return _buffer
+
+
+def get_ingest_stats():
+    """Points and sessions waiting in (and being written from) this
+    process's buffer."""
+    buffer = _buffer
+    if buffer is None:
+        return {"pending_points": 0, "pending_sessions": 0, "writing_sessions": 0}
+
+    return {
+        "pending_points": buffer.size,
+        "pending_sessions": len(buffer.pending),
+        "writing_sessions": len(buffer.writing),
+    }
+
+
+def flush_session_now(session_id, timeout=5):
+    """Flush a session's buffered points from sync code (e.g. a view).
+
+    Only reaches the buffer of this process; consumers in other worker
+    processes flush when they receive session.reload.
+    """
+    buffer = _buffer
+    if buffer is None or not buffer.loop.is_running():
+        return
+
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+
+    if running is buffer.loop:
+        return
+
+    future = asyncio.run_coroutine_threadsafe(
+        buffer.flush_session(session_id), buffer.loop
+    )
+
+    try:
+        future.result(timeout)
+    except Exception as e:
+        logger.warning("Ingest flush on stop failed: %s", e)
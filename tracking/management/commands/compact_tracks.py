@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from tracking.models import TrackingSession
+
+
+class Command(BaseCommand):
+    help = 'Pack point rows of ended sessions into the compact track column'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many sessions would be compacted'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        # Ended sessions that still have point rows
+        session_ids = TrackingSession.objects.filter(
+            ended_at__isnull=False,
+            points__isnull=False
+        ).values_list('id', flat=True).distinct().order_by('id')
+
+        if dry_run:
+            self.stdout.write(
+                f'Dry run: Would compact {session_ids.count()} sessions'
+            )
+            return
+
+        compacted = 0
+        for session_id in session_ids.iterator():
+            session = TrackingSession.objects.get(id=session_id)
+            if session.compact():
+                compacted += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully compacted {compacted} sessions')
+        )
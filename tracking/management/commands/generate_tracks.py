@@ -0,0 +1,313 @@
+import math
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+
+import django
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from tracking.batch import MIN_DISTANCE, NO_ANCHOR, PointBatch, to_epoch_us
+from tracking.management.commands.import_tracks import store_track
+from tracking.models import DailyStats, TrackingSession
+
+
+MODES = sorted(MIN_DISTANCE)
+
+# Meters per second, and how often each mode is picked for a leg
+SPEEDS = {'walk': 1.4, 'bike': 5.0, 'car': 12.0}
+MODE_WEIGHTS = {'walk': 4, 'bike': 4, 'car': 2}
+
+METERS_PER_DEGREE = 111320
+
+# Users live around one of these, within about 20 km
+CITIES = [
+    (18.5204, 73.8567),
+    (19.0760, 72.8777),
+    (28.6139, 77.2090),
+    (12.9716, 77.5946),
+]
+
+# Shortest session; lengths are skewed towards short ones, with a long
+# tail up to --max-points
+MIN_POINTS = 50
+
+
+def leg_modes(rng, count):
+    """Mode per point: one to three legs, e.g. walk to the car and drive."""
+    legs = int(rng.integers(1, 4))
+    weights = np.array([MODE_WEIGHTS[mode] for mode in MODES], dtype=np.float64)
+    picks = rng.choice(len(MODES), size=legs, p=weights / weights.sum())
+
+    bounds = np.sort(rng.integers(0, count, size=legs - 1))
+    codes = np.empty(count, dtype=np.int64)
+    for pick, first, last in zip(picks, np.r_[0, bounds], np.r_[bounds, count]):
+        codes[first:last] = pick
+
+    return codes
+
+
+def synthetic_track(rng, start_us, count, home):
+    """Raw points of one trip; about count of them pass the filters."""
+    codes = leg_modes(rng, count)
+    speed = np.array([SPEEDS[mode] for mode in MODES])[codes]
+    min_distance = np.array([MIN_DISTANCE[mode] for mode in MODES])[codes]
+
+    # Phones report about every second, but only fixes far enough from
+    # the last one are kept; send just those, with some stops and gaps
+    interval = np.ceil(1.5 * min_distance / speed)
+    gaps = rng.random(count) < 0.002
+    interval[gaps] += rng.integers(30, 900, gaps.sum())
+    step = speed * interval * rng.lognormal(0, 0.15, count)
+    step[rng.random(count) < 0.01] = 0
+
+    heading = rng.uniform(0, 2 * math.pi) + np.cumsum(rng.normal(0, 0.15, count))
+    lat = home[0] + np.cumsum(step * np.cos(heading)) / METERS_PER_DEGREE
+    lng = home[1] + np.cumsum(step * np.sin(heading)) / (
+        METERS_PER_DEGREE * math.cos(math.radians(home[0]))
+    )
+
+    noise = rng.normal(0, 3 / METERS_PER_DEGREE, (2, count))
+    ts_us = start_us + (np.cumsum(interval) * 10 ** 6).astype(np.int64)
+
+    return PointBatch.from_columns(
+        np.round(lat + noise[0], 6),
+        np.round(lng + noise[1], 6),
+        ts_us,
+        [MODES[code] for code in codes.tolist()]
+    )
+
+
+def generate_user(seed, index, sessions, max_points, days, until_us, live):
+    """All sessions of one synthetic user (runs in a worker process).
+
+    Everything is drawn from (seed, index), so a user comes out the
+    same whichever worker generates it.
+    """
+    rng = np.random.default_rng([seed, index])
+
+    city = CITIES[int(rng.integers(len(CITIES)))]
+    home = (city[0] + rng.uniform(-0.2, 0.2), city[1] + rng.uniform(-0.2, 0.2))
+
+    count = int(rng.integers(1, 2 * sessions))
+    starts = np.sort(until_us - (rng.uniform(0, days, count) * 86400 * 10 ** 6).astype(np.int64))
+    is_live = rng.random() < live
+
+    tracks = []
+    for number, start_us in enumerate(starts.tolist()):
+        points = int(MIN_POINTS * (max_points / MIN_POINTS) ** (rng.random() ** 2))
+        points = min(max(points, MIN_POINTS), max_points)
+
+        batch = synthetic_track(rng, start_us, points, home)
+        result = batch.select(NO_ANCHOR)
+        indices = result.indices
+
+        tracks.append({
+            'name': f'{index}-{number}',
+            'live': is_live and number == count - 1,
+            'lat': batch.lat[indices],
+            'lng': batch.lng[indices],
+            'ts_us': batch.ts_us[indices],
+            'modes': batch.modes,
+            'mode_codes': batch.mode_codes[indices],
+            'distance': result.distance,
+            'time': result.time,
+        })
+
+    return index, tracks
+
+
+class Command(BaseCommand):
+    help = 'Generate synthetic users and sessions, deterministically from a seed, for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=1000,
+            help='Users to create (default: 1000)'
+        )
+        parser.add_argument(
+            '--sessions',
+            type=int,
+            default=5,
+            help='Average sessions per user (default: 5)'
+        )
+        parser.add_argument(
+            '--max-points',
+            type=int,
+            default=100000,
+            help='Points in the longest sessions (default: 100000)'
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=90,
+            help='Sessions are spread over this many days before --until (default: 90)'
+        )
+        parser.add_argument(
+            '--until',
+            type=date.fromisoformat,
+            default=None,
+            help='Last day of the generated history, YYYY-MM-DD (default: today)'
+        )
+        parser.add_argument(
+            '--live',
+            type=float,
+            default=0.05,
+            help='Share of users whose last session is still live (default: 0.05)'
+        )
+        parser.add_argument(
+            '--rows',
+            action='store_true',
+            help='Keep ended sessions\' points as rows instead of packing them'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=1,
+            help='Same seed, --until and sizes give the same data (default: 1)'
+        )
+        parser.add_argument(
+            '--prefix',
+            default='synthetic_',
+            help='Username prefix of the generated users (default: synthetic_)'
+        )
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            help='Delete the users with --prefix, and their sessions, first'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processes generating users in parallel (default: CPU count)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Points per bulk insert (default: 5000)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Generate the tracks without writing anything'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        prefix = options['prefix']
+        workers = max(options['workers'], 1)
+        batch_size = max(options['batch_size'], 1)
+        max_points = max(options['max_points'], MIN_POINTS)
+        sessions = max(options['sessions'], 1)
+
+        existing = User.objects.filter(username__startswith=prefix)
+        if options['delete']:
+            if not dry_run:
+                deleted, _ = existing.delete()
+                self.stdout.write(f'Deleted {deleted} objects of earlier {prefix}* users')
+        elif existing.exists() and not dry_run:
+            raise CommandError(f'There are {prefix}* users already; use --delete or another --prefix')
+
+        until = options['until'] or timezone.localdate()
+        until_us = to_epoch_us(
+            timezone.make_aware(datetime.combine(until + timedelta(days=1), datetime.min.time()))
+        )
+
+        # One password hash for everyone: hashing dominates otherwise
+        password = make_password(None)
+
+        totals = Counter()
+        start = time.perf_counter()
+
+        # Forked workers must not share this process's connection
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            pending = iter(range(options['users']))
+            running = deque()
+
+            def submit():
+                for index in pending:
+                    running.append(pool.submit(
+                        generate_user,
+                        options['seed'],
+                        index,
+                        sessions,
+                        max_points,
+                        max(options['days'], 1),
+                        until_us,
+                        options['live']
+                    ))
+                    if len(running) >= workers * 2:
+                        break
+
+            submit()
+
+            # Users are written in index order, so ids come out the
+            # same on every run
+            while running:
+                index, tracks = running.popleft().result()
+                self.store_user(f'{prefix}{index:05d}', password, tracks, batch_size, options, totals)
+                submit()
+
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{prefix}{index:05d}: {len(tracks)} sessions')
+
+        elapsed = time.perf_counter() - start
+        rate = totals['points'] / elapsed if elapsed else 0
+
+        if dry_run:
+            self.stdout.write(
+                f'Dry run: Would create {options["users"]} users with {totals["sessions"]} sessions '
+                f'({totals["live"]} live) and {totals["points"]} points'
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Successfully created {options["users"]} users with {totals["sessions"]} sessions '
+                    f'({totals["live"]} live) and {totals["points"]} points'
+                )
+            )
+
+        self.stdout.write(
+            f'Longest session: {totals["longest"]} points; '
+            f'{totals["points"]} points in {elapsed:.2f} s ({rate:,.0f} points/sec)'
+        )
+
+    def store_user(self, username, password, tracks, batch_size, options, totals):
+        tracks = [track for track in tracks if len(track['lat'])]
+
+        for track in tracks:
+            totals['sessions'] += 1
+            totals['live'] += track['live']
+            totals['points'] += len(track['lat'])
+            totals['longest'] = max(totals['longest'], len(track['lat']))
+
+        if options['dry_run']:
+            return
+
+        user = User.objects.create(username=username, password=password)
+
+        for track in tracks:
+            if not track['live']:
+                session = store_track(user, track, batch_size, packed=not options['rows'])
+                DailyStats.add_session(session)
+                continue
+
+            # Still being recorded: rows, not ended, totals not finalized
+            with transaction.atomic():
+                session = store_track(user, track, batch_size)
+                TrackingSession.objects.filter(id=session.id).update(
+                    ended_at=None,
+                    total_time=float(track['time'].sum())
+                )
@@ -0,0 +1,431 @@
+import csv
+import gzip
+import os
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import timedelta
+
+import django
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tracking.batch import (
+    EPOCH, MIN_DISTANCE, NO_ANCHOR, PointBatch, parse_timestamp, to_epoch_us
+)
+from tracking.codec import encode_track
+from tracking.models import DailyStats, TrackingPoint, TrackingSession, stopped_total_time
+
+
+EXTENSIONS = ('.gpx', '.csv', '.gpx.gz', '.csv.gz')
+
+# Activity types other trackers write, by the mode they map to
+MODE_ALIASES = {
+    'walking': 'walk',
+    'hiking': 'walk',
+    'running': 'walk',
+    'cycling': 'bike',
+    'biking': 'bike',
+    'driving': 'car',
+}
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_time(value):
+    """Epoch µs from an ISO time or epoch seconds/milliseconds, else None."""
+    value = (value or '').strip()
+    if not value:
+        return None
+
+    try:
+        number = float(value)
+    except ValueError:
+        try:
+            parsed = parse_timestamp(value, None)
+        except ValueError:
+            return None
+        return None if parsed is None else to_epoch_us(parsed)
+
+    # Epoch milliseconds are 13 digits until the year 2286
+    if number > 1e11:
+        number /= 1000
+    return int(number * 10 ** 6)
+
+
+def read_mode(value, default):
+    """Activity types this tracker doesn't know fall back to default."""
+    value = (value or '').strip().lower()
+    value = MODE_ALIASES.get(value, value)
+    return value if value in MIN_DISTANCE else default
+
+
+class Track:
+    """Raw points of one track while its file is read."""
+
+    def __init__(self, name, mode):
+        self.name = name
+        self.mode = mode
+        self.lat = []
+        self.lng = []
+        self.ts_us = []
+        self.modes = []
+        self.skipped = 0
+
+    def add(self, lat, lng, ts, mode):
+        try:
+            lat = float(lat)
+            lng = float(lng)
+        except (TypeError, ValueError):
+            self.skipped += 1
+            return
+
+        if ts is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            self.skipped += 1
+            return
+
+        self.lat.append(lat)
+        self.lng.append(lng)
+        self.ts_us.append(ts)
+        self.modes.append(mode)
+
+
+def gpx_tracks(path, default_mode):
+    """One Track per <trk> (segments joined) or <rte>."""
+    track = None
+    point = None
+
+    with open_text(path) as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            tag = elem.tag.rsplit('}', 1)[-1]
+
+            if event == 'start':
+                if tag in ('trk', 'rte'):
+                    track = Track(None, default_mode)
+                elif tag in ('trkpt', 'rtept'):
+                    point = {'time': None, 'type': None}
+                continue
+
+            text = (elem.text or '').strip()
+
+            if point is not None and tag in ('time', 'type'):
+                point[tag] = text
+            elif track is not None and tag == 'name' and point is None:
+                track.name = text
+            elif track is not None and tag == 'type' and point is None:
+                track.mode = read_mode(text, default_mode)
+            elif tag in ('trkpt', 'rtept') and track is not None:
+                track.add(
+                    elem.get('lat'),
+                    elem.get('lon'),
+                    read_time(point['time']),
+                    read_mode(point['type'], track.mode)
+                )
+                point = None
+                elem.clear()
+            elif tag in ('trk', 'rte') and track is not None:
+                yield track
+                track = None
+                elem.clear()
+
+
+def csv_tracks(path, default_mode):
+    """One Track per session_id column value, or one for the whole file."""
+    tracks = {}
+
+    with open_text(path) as f:
+        reader = csv.DictReader(f)
+        fields = set(reader.fieldnames or ())
+
+        lng_field = 'lng' if 'lng' in fields else 'lon'
+        time_field = 'timestamp' if 'timestamp' in fields else 'time'
+        if not {'lat', lng_field, time_field} <= fields:
+            raise ValueError('CSV header needs lat, lng (or lon) and timestamp (or time)')
+
+        for row in reader:
+            key = row.get('session_id') or None
+            track = tracks.get(key)
+            if track is None:
+                track = tracks[key] = Track(key, default_mode)
+
+            track.add(
+                row['lat'],
+                row[lng_field],
+                read_time(row[time_field]),
+                read_mode(row.get('mode'), default_mode)
+            )
+
+    return list(tracks.values())
+
+
+def parse_file(path, default_mode):
+    """Read and filter every track in a file (runs in a worker process).
+
+    Returns the accepted points' columns per track, with the same
+    increments process_point would have stored for them.
+    """
+    name = os.path.basename(path)
+
+    try:
+        if name.lower().endswith(('.gpx', '.gpx.gz')):
+            tracks = gpx_tracks(path, default_mode)
+        else:
+            tracks = csv_tracks(path, default_mode)
+
+        parsed = []
+        for track in tracks:
+            batch = PointBatch.from_columns(track.lat, track.lng, track.ts_us, track.modes)
+            result = batch.select(NO_ANCHOR)
+            indices = result.indices
+
+            parsed.append({
+                'name': track.name or name,
+                'read': len(batch) + track.skipped,
+                'skipped': track.skipped,
+                'rejected': result.rejected,
+                'lat': batch.lat[indices],
+                'lng': batch.lng[indices],
+                'ts_us': batch.ts_us[indices],
+                'modes': batch.modes,
+                'mode_codes': batch.mode_codes[indices],
+                'distance': result.distance,
+                'time': result.time,
+            })
+
+    except (OSError, UnicodeDecodeError, ValueError, ET.ParseError) as e:
+        return path, None, str(e)
+
+    return path, parsed, None
+
+
+def find_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif os.path.exists(path):
+            yield path
+        else:
+            raise CommandError(f'No such file or directory: {path}')
+
+
+def store_track(user, track, batch_size, packed=False):
+    """Create the ended session and its points in one transaction.
+
+    With packed, the points go straight into the track column, as
+    compaction would leave them, instead of into point rows.
+    """
+    count = len(track['lat'])
+    modes = track['modes']
+    codes = track['mode_codes']
+    start = EPOCH + timedelta(microseconds=int(track['ts_us'][0]))
+    end = EPOCH + timedelta(microseconds=int(track['ts_us'][-1]))
+
+    data = None
+    if packed:
+        data = encode_track(
+            track['lat'],
+            track['lng'],
+            track['ts_us'] // 1000,
+            [modes[code] for code in codes.tolist()],
+            track['distance'],
+            track['time']
+        )
+
+    with transaction.atomic():
+        session = TrackingSession.objects.create(
+            user=user,
+            ended_at=end,
+            mode=modes[np.bincount(codes).argmax()],
+            total_distance=float(track['distance'].sum()),
+            # Finalized like a stopped session: ended at its last point
+            total_time=stopped_total_time(float(track['time'].sum()), start, end, end),
+            point_count=count,
+            last_lat=float(track['lat'][-1]),
+            last_lng=float(track['lng'][-1]),
+            last_timestamp=end,
+            track=data
+        )
+        # started_at is auto_now_add, so it can only be set afterwards
+        TrackingSession.objects.filter(id=session.id).update(started_at=start)
+        session.started_at = start
+
+        if packed:
+            return session
+
+        for offset in range(0, count, batch_size):
+            chunk = slice(offset, offset + batch_size)
+
+            TrackingPoint.objects.bulk_create([
+                TrackingPoint(
+                    session_id=session.id,
+                    seq=seq,
+                    lat=lat,
+                    lng=lng,
+                    mode=modes[code],
+                    timestamp=EPOCH + timedelta(microseconds=ts),
+                    distance_increment=distance,
+                    time_increment=time_increment
+                )
+                for seq, lat, lng, code, ts, distance, time_increment in zip(
+                    range(offset + 1, offset + batch_size + 1),
+                    track['lat'][chunk].tolist(),
+                    track['lng'][chunk].tolist(),
+                    codes[chunk].tolist(),
+                    track['ts_us'][chunk].tolist(),
+                    track['distance'][chunk].tolist(),
+                    track['time'][chunk].tolist()
+                )
+            ])
+
+    return session
+
+
+class Command(BaseCommand):
+    help = 'Import GPX/CSV tracks from other trackers as ended sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='GPX/CSV files (optionally .gz) or directories of them'
+        )
+        parser.add_argument(
+            '--user',
+            required=True,
+            help='Username the imported sessions belong to'
+        )
+        parser.add_argument(
+            '--mode',
+            default='bike',
+            choices=sorted(MIN_DISTANCE),
+            help='Mode for points without a known activity type (default: bike)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processes parsing files in parallel (default: CPU count)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Points per bulk insert (default: 5000)'
+        )
+        parser.add_argument(
+            '--compact',
+            action='store_true',
+            help='Pack each imported session into the track column, as stop_tracking does'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Parse and filter the files without writing anything'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        workers = max(options['workers'], 1)
+        batch_size = max(options['batch_size'], 1)
+
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f'No user named {options["user"]}')
+
+        files = list(find_files(options['paths']))
+        if not files:
+            raise CommandError('No .gpx or .csv files found')
+
+        totals = Counter()
+        rejected = Counter()
+        start = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            remaining = iter(files)
+            running = set()
+
+            while True:
+                # Keep the workers busy without parsed files piling up
+                # faster than they are written
+                for path in remaining:
+                    running.add(pool.submit(parse_file, path, options['mode']))
+                    if len(running) >= workers * 2:
+                        break
+
+                if not running:
+                    break
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    path, tracks, error = future.result()
+
+                    if error is not None:
+                        totals['failed'] += 1
+                        self.stderr.write(self.style.WARNING(f'Skipped {path}: {error}'))
+                        continue
+
+                    totals['files'] += 1
+
+                    for track in tracks:
+                        accepted = len(track['lat'])
+                        totals['read'] += track['read']
+                        totals['skipped'] += track['skipped']
+                        rejected.update(track['rejected'])
+
+                        if not accepted:
+                            totals['empty'] += 1
+                            continue
+
+                        totals['sessions'] += 1
+                        totals['points'] += accepted
+
+                        if not dry_run:
+                            session = store_track(user, track, batch_size, options['compact'])
+                            DailyStats.add_session(session)
+
+                        if options['verbosity'] > 1:
+                            self.stdout.write(
+                                f'{path}: {track["name"]} - {accepted} of {track["read"]} points'
+                            )
+
+        elapsed = time.perf_counter() - start
+        rate = totals['points'] / elapsed if elapsed else 0
+
+        self.stdout.write(
+            f'Read {totals["read"]} points from {totals["files"]} files '
+            f'({totals["skipped"]} unreadable, '
+            f'{rejected["duplicate"]} duplicate, '
+            f'{rejected["min_distance"]} too close, '
+            f'{rejected["negative_time"]} out of order)'
+        )
+        if totals['failed']:
+            self.stdout.write(f'Files that could not be read: {totals["failed"]}')
+        if totals['empty']:
+            self.stdout.write(f'Tracks with no usable points: {totals["empty"]}')
+
+        if dry_run:
+            self.stdout.write(
+                f'Dry run: Would import {totals["sessions"]} sessions '
+                f'with {totals["points"]} points for {user.username}'
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Successfully imported {totals["sessions"]} sessions '
+                    f'with {totals["points"]} points for {user.username}'
+                )
+            )
+
+        self.stdout.write(f'{totals["points"]} points in {elapsed:.2f} s ({rate:,.0f} points/sec)')
@@ -0,0 +1,201 @@
+import json
+import os
+import shutil
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from tracking.profiler import (
+    MAX_SECONDS,
+    POLL_INTERVAL,
+    private_dir,
+    worker_path,
+    workers,
+    write_json,
+)
+
+
+# Workers not seen for this long are gone (or hung)
+STALE_AFTER = 10 * POLL_INTERVAL
+
+TOP_FRAMES = 15
+
+# Innermost frames of a thread that is waiting, not working
+IDLE_FRAMES = (
+    'EpollSelector.select',
+    'KqueueSelector.select',
+    'SelectSelector.select',
+    'Condition.wait',
+    '_worker',
+)
+
+
+class Command(BaseCommand):
+    help = 'Profile a running web worker for a while and save its stacks for a flamegraph'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'pid',
+            nargs='?',
+            type=int,
+            help='Worker process id (default: the only running worker)'
+        )
+        parser.add_argument(
+            '--list',
+            action='store_true',
+            help='List the running workers and exit'
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            default=10,
+            help=f'How long to sample (default: 10, at most {MAX_SECONDS})'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=10,
+            help='Milliseconds between samples (default: 10)'
+        )
+        parser.add_argument(
+            '--output',
+            help='Collapsed stacks file (default: profile-<pid>-<time>.folded); '
+                 'step timings go next to it as .json'
+        )
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=30,
+            help='Seconds to wait for the worker beyond --seconds (default: 30)'
+        )
+
+    def handle(self, *args, **options):
+        if not settings.PROFILE_DIR:
+            raise CommandError('PROFILE_DIR is not set')
+
+        try:
+            private_dir()
+        except OSError as e:
+            raise CommandError(str(e))
+
+        running = self.running_workers()
+
+        if options['list']:
+            if not running:
+                self.stdout.write('No running workers')
+            for pid, age in sorted(running.items()):
+                self.stdout.write(f'{pid}  (seen {age:.0f} s ago)')
+            return
+
+        pid = options['pid']
+        if pid is None:
+            if len(running) != 1:
+                raise CommandError(
+                    f'{len(running)} workers are running; pick one of: '
+                    f'{", ".join(str(p) for p in sorted(running)) or "none"}'
+                )
+            pid = next(iter(running))
+        elif pid not in running:
+            raise CommandError(f'No running worker with pid {pid}')
+
+        seconds = min(max(options['seconds'], 0.1), MAX_SECONDS)
+        request_id = int(time.time() * 1000)
+        request = worker_path(pid, '.request')
+
+        write_json(request, {
+            'id': request_id,
+            'seconds': seconds,
+            'interval_ms': options['interval'],
+        })
+        self.stdout.write(f'Profiling worker {pid} for {seconds:g} s...')
+
+        base = worker_path(f'{pid}-{request_id}', '')
+        report = self.wait_for(f'{base}.json', seconds + 2 * POLL_INTERVAL + options['timeout'])
+
+        if report is None:
+            if os.path.exists(request):
+                os.remove(request)
+            raise CommandError(f'Worker {pid} did not answer; is it busy or gone?')
+
+        output = options['output'] or f'profile-{pid}-{request_id}.folded'
+        shutil.move(f'{base}.folded', output)
+        shutil.move(f'{base}.json', os.path.splitext(output)[0] + '.json')
+
+        self.show(report, output)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully saved {report["samples"]} samples to {output}'
+            )
+        )
+
+    def running_workers(self):
+        running = {}
+
+        for pid, age in workers().items():
+            if age <= STALE_AFTER:
+                running[pid] = age
+                continue
+
+            # Left behind by a worker that exited
+            try:
+                os.remove(worker_path(pid, '.worker'))
+            except FileNotFoundError:
+                pass
+
+        return running
+
+    def wait_for(self, path, timeout):
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                time.sleep(0.2)
+
+        return None
+
+    def show(self, report, folded_path):
+        steps = report['steps']
+        receive_ms = steps.get('receive', {}).get('total_ms') or 0
+
+        self.stdout.write(
+            f'\n{report["samples"]} samples in {report["seconds"]} s; '
+            f'{steps.get("receive", {}).get("calls", 0)} frames received'
+        )
+
+        if steps:
+            self.stdout.write(
+                f'\n{"step":32}{"calls":>9}{"mean µs":>11}{"max ms":>10}{"total ms":>11}{"of receive":>12}'
+            )
+            for label, step in sorted(steps.items(), key=lambda item: -item[1]['total_ms']):
+                share = f'{step["total_ms"] / receive_ms:.0%}' if receive_ms else '-'
+                self.stdout.write(
+                    f'{label:32}{step["calls"]:>9}{step["mean_us"]:>11.1f}'
+                    f'{step["max_ms"]:>10.2f}{step["total_ms"]:>11.1f}{share:>12}'
+                )
+
+        # Self time: the innermost frame of each sampled stack
+        leaves = Counter()
+        idle = 0
+        total = 0
+        with open(folded_path) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                leaf = stack.rsplit(';', 1)[-1]
+                total += int(count)
+
+                if leaf.split(' (', 1)[0] in IDLE_FRAMES:
+                    idle += int(count)
+                else:
+                    leaves[leaf] += int(count)
+
+        if total:
+            self.stdout.write(f'\nBusiest frames ({idle / total:.0%} of thread samples were idle):')
+            for frame, count in leaves.most_common(TOP_FRAMES):
+                self.stdout.write(f'{count / total:>6.1%}  {frame}')
+        self.stdout.write('')
@@ -0,0 +1,336 @@
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
+from operator import itemgetter
+
+import django
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from tracking.batch import NO_ANCHOR, PointBatch, filter_rules, rules_version, to_epoch_us
+from tracking.codec import PackedTrack
+from tracking.models import TrackingPoint, TrackingSession, stopped_total_time
+
+
+# Point rows read per round trip while a chunk is scanned
+ROW_CHUNK_SIZE = 5000
+
+
+def session_batch(track, rows):
+    """All of a session's stored points as one PointBatch."""
+    lat = []
+    lng = []
+    ts_us = []
+    modes = []
+    packed_count = 0
+
+    if track:
+        packed = PackedTrack(track)
+        packed_count = len(packed)
+        columns = packed.columns()
+        lat.append(columns['lat'])
+        lng.append(columns['lng'])
+        ts_us.append(columns['ts_ms'] * 1000)
+        modes += [packed.modes[code] for code in columns['mode'].tolist()]
+
+    # Rows flushed after compaction come after the packed points
+    rows = [row for row in rows if row[1] > packed_count]
+    lat.append(np.array([row[2] for row in rows], dtype=np.float64))
+    lng.append(np.array([row[3] for row in rows], dtype=np.float64))
+    ts_us.append(np.array([to_epoch_us(row[4]) for row in rows], dtype=np.int64))
+    modes += [row[5] for row in rows]
+
+    return PointBatch.from_columns(
+        np.concatenate(lat),
+        np.concatenate(lng),
+        np.concatenate(ts_us),
+        modes
+    )
+
+
+def outdated(everything=False):
+    """Ended sessions to recompute: those derived with other rules."""
+    sessions = TrackingSession.objects.filter(ended_at__isnull=False)
+    if everything:
+        return sessions
+
+    return sessions.exclude(rules_version=rules_version())
+
+
+def recompute_chunk(first_id, last_id, everything):
+    """Totals of the sessions to recompute with ids in [first_id,
+    last_id] (runs in a worker process).
+
+    Each session's stored points are filtered again with the current
+    rules and the kept increments summed, then total_time is finalized
+    the way stop_tracking does it.
+    """
+    sessions = outdated(everything).filter(
+        id__gte=first_id,
+        id__lte=last_id
+    ).order_by('id').values_list(
+        'id', 'track', 'total_distance', 'total_time', 'started_at', 'ended_at'
+    )
+
+    rows = TrackingPoint.objects.filter(
+        session_id__gte=first_id,
+        session_id__lte=last_id,
+        session__ended_at__isnull=False
+    ).order_by('session_id', 'seq').values_list(
+        'session_id', 'seq', 'lat', 'lng', 'timestamp', 'mode'
+    ).iterator(chunk_size=ROW_CHUNK_SIZE)
+
+    groups = groupby(rows, key=itemgetter(0))
+    group = next(groups, None)
+    results = []
+
+    for session_id, track, distance, total_time, started_at, ended_at in sessions:
+        while group is not None and group[0] < session_id:
+            group = next(groups, None)
+
+        session_rows = []
+        if group is not None and group[0] == session_id:
+            session_rows = list(group[1])
+            group = next(groups, None)
+
+        batch = session_batch(track, session_rows)
+        result = batch.select(NO_ANCHOR)
+
+        last_timestamp = None
+        if len(result):
+            last_timestamp = batch.timestamp(int(result.indices[-1]))
+
+        results.append((
+            session_id,
+            distance,
+            total_time,
+            float(result.distance.sum()),
+            stopped_total_time(
+                float(result.time.sum()),
+                started_at,
+                last_timestamp,
+                ended_at
+            ),
+            len(batch),
+            len(result),
+        ))
+
+    return results
+
+
+def chunk_ranges(first_id, chunk_size, everything):
+    """(first, last) session id of every chunk_size sessions after first_id."""
+    while True:
+        ids = list(
+            outdated(everything).filter(
+                id__gt=first_id
+            ).order_by('id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return
+
+        yield ids[0], ids[-1]
+        first_id = ids[-1]
+
+
+def changed(old, new):
+    return not math.isclose(old, new, rel_tol=1e-9, abs_tol=1e-3)
+
+
+class Command(BaseCommand):
+    help = 'Re-derive total_distance/total_time of ended sessions from their points'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processes recomputing chunks in parallel (default: CPU count)'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=200,
+            help='Sessions per chunk (default: 200)'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default='recompute_totals.checkpoint',
+            help='File recording the last finished session id (default: recompute_totals.checkpoint)'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Continue after the session id in the checkpoint file'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Also recompute sessions already derived with the current rules; '
+                 'packed tracks are stored at 1e-7 degrees, so expect small differences'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report the sessions whose totals would change without saving'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        everything = options['all']
+        workers = max(options['workers'], 1)
+        chunk_size = max(options['chunk_size'], 1)
+        checkpoint = options['checkpoint']
+
+        first_id = 0
+        if options['resume']:
+            first_id = self.read_checkpoint(checkpoint)
+            self.stdout.write(f'Resuming after session {first_id}')
+
+        totals = {
+            'sessions': 0,
+            'changed': 0,
+            'skipped': 0,
+            'points': 0,
+            'filtered': 0,
+            'distance': 0.0,
+            'time': 0.0,
+        }
+        start = time.perf_counter()
+
+        if not everything:
+            current = TrackingSession.objects.filter(
+                ended_at__isnull=False,
+                rules_version=rules_version()
+            ).count()
+            self.stdout.write(f'{current} sessions already derived with the current rules, left alone')
+
+        ranges = chunk_ranges(first_id, chunk_size, everything)
+        first_chunks = list(islice(ranges, workers * 2))
+
+        # Forked workers open their own connections instead of sharing
+        # this process's. django.setup is for spawned ones.
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            running = deque(
+                (last, pool.submit(recompute_chunk, first, last, everything))
+                for first, last in first_chunks
+            )
+
+            # Chunks are finished in id order, so the checkpoint never
+            # skips one that is still running
+            while running:
+                last, future = running.popleft()
+                self.apply(future.result(), totals, dry_run, options['verbosity'])
+
+                if not dry_run:
+                    self.write_checkpoint(checkpoint, last)
+
+                for first, next_last in islice(ranges, 1):
+                    running.append((next_last, pool.submit(recompute_chunk, first, next_last, everything)))
+
+        if not dry_run and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+        elapsed = time.perf_counter() - start
+        rate = totals['sessions'] / elapsed if elapsed else 0
+
+        self.stdout.write(
+            f'Scanned {totals["sessions"]} sessions, {totals["points"]} points '
+            f'({totals["filtered"]} now filtered out)'
+        )
+        self.stdout.write(
+            f'Distance change: {totals["distance"] / 1000:+.2f} km, '
+            f'time change: {totals["time"] / 3600:+.2f} h'
+        )
+        if totals['skipped']:
+            self.stdout.write(f'Sessions changed while running, left alone: {totals["skipped"]}')
+
+        if dry_run:
+            self.stdout.write(
+                f'Dry run: Would update totals of {totals["changed"]} sessions'
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Successfully updated totals of {totals["changed"]} sessions'
+                )
+            )
+
+        self.stdout.write(f'{totals["sessions"]} sessions in {elapsed:.2f} s ({rate:,.0f} sessions/sec)')
+
+    def apply(self, results, totals, dry_run, verbosity):
+        updates = []
+        unchanged = []
+
+        for session_id, old_distance, old_time, distance, total_time, points, kept in results:
+            totals['sessions'] += 1
+            totals['points'] += points
+            totals['filtered'] += points - kept
+
+            if not (changed(old_distance, distance) or changed(old_time, total_time)):
+                unchanged.append(session_id)
+                continue
+
+            totals['changed'] += 1
+            totals['distance'] += distance - old_distance
+            totals['time'] += total_time - old_time
+            updates.append((session_id, old_distance, old_time, distance, total_time))
+
+            if dry_run or verbosity > 1:
+                self.stdout.write(
+                    f'Session {session_id}: '
+                    f'distance {old_distance:.1f} -> {distance:.1f} m, '
+                    f'time {old_time:.0f} -> {total_time:.0f} s'
+                )
+
+        if dry_run:
+            return
+
+        version = rules_version()
+
+        with transaction.atomic():
+            TrackingSession.objects.filter(id__in=unchanged).update(rules_version=version)
+
+            for session_id, old_distance, old_time, distance, total_time in updates:
+                # A late flush may have moved the totals since they were read
+                updated = TrackingSession.objects.filter(
+                    id=session_id,
+                    total_distance=old_distance,
+                    total_time=old_time
+                ).update(
+                    total_distance=distance,
+                    total_time=total_time,
+                    rules_version=version
+                )
+
+                if not updated:
+                    totals['changed'] -= 1
+                    totals['skipped'] += 1
+
+    def read_checkpoint(self, path):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read checkpoint {path}: {e}')
+
+        if state.get('rules') != json.loads(json.dumps(filter_rules())):
+            raise CommandError(
+                'Checkpoint was written with different filtering rules; '
+                'run again without --resume'
+            )
+
+        return state['last_id']
+
+    def write_checkpoint(self, path, last_id):
+        temp = f'{path}.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'last_id': last_id, 'rules': filter_rules()}, f)
+        os.replace(temp, path)
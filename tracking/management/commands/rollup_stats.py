@@ -0,0 +1,88 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from tracking.models import DailyStats, TrackingSession, session_rollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-day stats rollups from ended sessions (e.g. after recompute_totals)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='Only rebuild this username\'s rows'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many rows would be written without writing them'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        users = User.objects.order_by('id')
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                raise CommandError(f'No user named {options["user"]}')
+
+        total_rows = 0
+        total_sessions = 0
+
+        for user_id in users.values_list('id', flat=True).iterator():
+            rows, sessions = self.rebuild(user_id, dry_run)
+            total_rows += rows
+            total_sessions += sessions
+
+        if dry_run:
+            self.stdout.write(
+                f'Dry run: Would write {total_rows} daily stats rows '
+                f'from {total_sessions} sessions'
+            )
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Successfully rebuilt {total_rows} daily stats rows '
+                    f'from {total_sessions} sessions'
+                )
+            )
+
+    def rebuild(self, user_id, dry_run):
+        """Replace one user's rows; returns (rows, sessions)."""
+        rollup = {}
+        session_ids = TrackingSession.objects.filter(
+            user_id=user_id,
+            ended_at__isnull=False
+        ).order_by('id').values_list('id', flat=True)
+
+        sessions = 0
+        # One session (and its track) in memory at a time
+        for session_id in session_ids.iterator():
+            session = TrackingSession.objects.get(id=session_id)
+            sessions += 1
+
+            for key, (distance, time, count) in session_rollup(session).items():
+                totals = rollup.setdefault(key, [0.0, 0.0, 0])
+                totals[0] += distance
+                totals[1] += time
+                totals[2] += count
+
+        if dry_run:
+            return len(rollup), sessions
+
+        with transaction.atomic():
+            DailyStats.objects.filter(user_id=user_id).delete()
+            DailyStats.objects.bulk_create([
+                DailyStats(
+                    user_id=user_id,
+                    day=day,
+                    mode=mode,
+                    distance=distance,
+                    time=time,
+                    session_count=count
+                )
+                for (day, mode), (distance, time, count) in rollup.items()
+            ], batch_size=1000)
+
+        return len(rollup), sessions
@@ -0,0 +1,108 @@
+"""HTTP caching for session_map.
+
+Once a session has ended and its last flush has landed, its map never
+changes. Its responses get a strong ETag (session id, point count,
+ended_at and totals), a long private Cache-Control, and their gzipped
+body is kept in the shared cache, so a repeat view is a 304 or a single
+cache read instead of loading and serializing the whole track.
+
+Live sessions get an ETag too, but are revalidated on every request.
+"""
+
+import gzip
+import hashlib
+import re
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.text import compress_string
+
+
+# Fields session_etag needs, read without loading the track
+SUMMARY_FIELDS = (
+    "user_id",
+    "point_count",
+    "ended_at",
+    "total_distance",
+    "total_time",
+    "last_lat",
+)
+
+# Flushes from other workers can still land this long after stop
+SETTLE_TIME = timedelta(seconds=60)
+
+# Browser cache lifetime of a settled session's responses
+MAX_AGE = 60 * 60 * 24 * 7
+
+CACHE_TIMEOUT = 60 * 60 * 24
+
+ACCEPTS_GZIP = re.compile(r"\bgzip\b")
+
+
+def is_settled(ended_at):
+    return ended_at is not None and timezone.now() - ended_at > SETTLE_TIME
+
+
+def session_etag(session_id, summary, variant):
+    """Strong ETag for one representation (variant) of a session's map.
+
+    Totals are part of it because recompute_totals can change them
+    after the session has ended.
+    """
+    ended_at = summary["ended_at"]
+    ended = int(ended_at.timestamp() * 1000) if ended_at else "live"
+
+    digest = hashlib.blake2b(
+        repr((summary["total_distance"], summary["total_time"], variant)).encode(),
+        digest_size=6
+    ).hexdigest()
+
+    return f'"{session_id}-{summary["point_count"]}-{ended}-{digest}"'
+
+
+def cache_key(etag):
+    return "session_map:" + etag.strip('"')
+
+
+def cached_response(request, etag):
+    """The settled session's cached response, or None."""
+    entry = cache.get(cache_key(etag))
+    if entry is None:
+        return None
+
+    content_type, body = entry
+    return compressed_response(request, body, content_type)
+
+
+def cache_response(request, etag, response):
+    """Store a settled session's response and answer with its gzipped copy."""
+    content_type = response["Content-Type"]
+    body = compress_string(response.content)
+
+    cache.set(cache_key(etag), (content_type, body), CACHE_TIMEOUT)
+    return compressed_response(request, body, content_type)
+
+
+def compressed_response(request, body, content_type):
+    if ACCEPTS_GZIP.search(request.headers.get("Accept-Encoding", "")):
+        response = HttpResponse(body, content_type=content_type)
+        response["Content-Encoding"] = "gzip"
+        return response
+
+    return HttpResponse(gzip.decompress(body), content_type=content_type)
+
+
+def set_cache_headers(response, etag, settled):
+    response["ETag"] = etag
+
+    if settled:
+        patch_cache_control(response, private=True, max_age=MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+
+    # The same URL serves the page and the AJAX JSON
+    patch_vary_headers(response, ("X-Requested-With", "Accept-Encoding"))
+    return response
@@ -0,0 +1,318 @@
+"""Prometheus metrics for the ingest and read paths.
+
+Every process counts in memory. With METRICS_DIR set (several workers
+on one host), each process also writes its values to
+METRICS_DIR/<pid>.json every METRICS_WRITE_INTERVAL seconds and when
+it exits, and /metrics adds up the files of the processes that are
+still running; files of dead ones are removed. A worker that goes away
+takes its counts with it, which Prometheus sees as a counter reset.
+
+Without METRICS_DIR, /metrics shows the process that serves it.
+"""
+
+import atexit
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+
+
+# Seconds; from a fast single-row flush up to a stalled database
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+_registry = {}
+_writer = None
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+        _registry[name] = self
+
+    def snapshot(self):
+        with _lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not amount:
+            return
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        _ensure_writer()
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        _ensure_writer()
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Per label set: a count per bucket (not cumulative), sum, count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+
+        with _lock:
+            values = self.values.get(labels)
+            if values is None:
+                values = self.values[labels] = [0] * (len(self.buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+        _ensure_writer()
+
+    def snapshot(self):
+        with _lock:
+            return [[list(key), list(value)] for key, value in self.values.items()]
+
+
+# ---------------- INGEST ----------------
+
+WS_CONNECTIONS = Gauge(
+    "locatracker_ws_connections",
+    "Open tracking WebSocket connections.",
+    ["protocol"]
+)
+FRAMES_RECEIVED = Counter(
+    "locatracker_frames_received_total",
+    "Frames received on tracking WebSockets, throttled ones included.",
+    ["protocol"]
+)
+POINTS_RECEIVED = Counter(
+    "locatracker_points_received_total",
+    "Points received from clients."
+)
+POINTS_ACCEPTED = Counter(
+    "locatracker_points_accepted_total",
+    "Points that passed the filters and were queued for storing."
+)
+POINTS_FILTERED = Counter(
+    "locatracker_points_filtered_total",
+    "Points dropped, by reason.",
+    ["reason"]
+)
+FLUSH_SECONDS = Histogram(
+    "locatracker_ingest_flush_seconds",
+    "Time to write one round of buffered points, queueing included.",
+    ["result"]
+)
+
+# ---------------- READ PATH ----------------
+
+SESSION_MAP_SECONDS = Histogram(
+    "locatracker_session_map_seconds",
+    "session_map response time, by how it was answered.",
+    ["variant", "result"]
+)
+ROUTE_CACHE_LOOKUPS = Counter(
+    "locatracker_route_cache_lookups_total",
+    "Route cache lookups, by where they were answered.",
+    ["result"]
+)
+ORS_SECONDS = Histogram(
+    "locatracker_ors_request_seconds",
+    "OpenRouteService directions calls, by HTTP status.",
+    ["status"]
+)
+
+
+# ---------------- PER-PROCESS FILES ----------------
+
+def _ensure_writer():
+    global _writer
+
+    if _writer is not None or not settings.METRICS_DIR:
+        return
+
+    with _lock:
+        if _writer is not None:
+            return
+        _writer = threading.Thread(target=_write_forever, name="metrics-writer", daemon=True)
+        _writer.start()
+
+    atexit.register(write_snapshot)
+
+
+def _write_forever():
+    while True:
+        time.sleep(settings.METRICS_WRITE_INTERVAL)
+        write_snapshot()
+
+
+def snapshot():
+    return {name: metric.snapshot() for name, metric in _registry.items()}
+
+
+def write_snapshot():
+    directory = settings.METRICS_DIR
+    pid = os.getpid()
+    path = os.path.join(directory, f"{pid}.json")
+    temp = f"{path}.tmp"
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(temp, "w") as f:
+            json.dump(snapshot(), f)
+        os.replace(temp, path)
+    except OSError as e:
+        print("Metrics write error:", e)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def other_snapshots():
+    """Snapshots of this host's other running workers."""
+    directory = settings.METRICS_DIR
+    if not directory:
+        return
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        if ext != ".json" or not stem.isdigit():
+            continue
+
+        pid = int(stem)
+        path = os.path.join(directory, name)
+
+        if pid == os.getpid():
+            continue
+
+        if not is_running(pid):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+
+        try:
+            with open(path) as f:
+                yield json.load(f)
+        except (OSError, ValueError) as e:
+            print("Metrics read error:", e)
+
+
+def _after_fork():
+    # A forked child starts from zero, without the parent's writer
+    global _lock, _writer
+    _lock = threading.Lock()
+    _writer = None
+    for metric in _registry.values():
+        metric.values = {}
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+# ---------------- EXPOSITION ----------------
+
+def merge(snapshots):
+    """Add up the values of several processes' snapshots."""
+    merged = {name: {} for name in _registry}
+
+    for data in snapshots:
+        for name, values in data.items():
+            if name not in merged:
+                continue
+
+            totals = merged[name]
+            for labels, value in values:
+                key = tuple(labels)
+                if isinstance(value, list):
+                    current = totals.get(key)
+                    totals[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+    return merged
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def number(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render():
+    """All metrics of this host's workers in the Prometheus text format."""
+    merged = merge([snapshot(), *other_snapshots()])
+    lines = []
+
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+
+        for labels, value in sorted(merged[name].items()):
+            if metric.kind != "histogram":
+                lines.append(f"{name}{label_text(metric.labels, labels)} {number(value)}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, math.inf), value):
+                cumulative += count
+                le = label_text(metric.labels, labels, [("le", number(bound))])
+                lines.append(f"{name}_bucket{le} {cumulative}")
+
+            lines.append(f"{name}_sum{label_text(metric.labels, labels)} {number(value[-2])}")
+            lines.append(f"{name}_count{label_text(metric.labels, labels)} {number(value[-1])}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,36 @@
+# Generated by Django 6.0.2 on 2026-10-17 01:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackingsession',
+            name='point_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='TrackingPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('lat', models.FloatField()),
+                ('lng', models.FloatField()),
+                ('mode', models.CharField(default='bike', max_length=20)),
+                ('timestamp', models.DateTimeField()),
+                ('distance_increment', models.FloatField(default=0)),
+                ('time_increment', models.FloatField(default=0)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='points', to='tracking.trackingsession')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('session', 'seq'), name='unique_session_point_seq')],
+            },
+        ),
+    ]
@@ -0,0 +1,87 @@
+from django.db import migrations
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+BATCH_SIZE = 2000
+
+
+def parse_timestamp(ts, default):
+    parsed = parse_datetime(ts) if ts else None
+
+    if parsed is None:
+        return default
+
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+
+    return parsed
+
+
+def locations_to_points(apps, schema_editor):
+    TrackingSession = apps.get_model("tracking", "TrackingSession")
+    TrackingPoint = apps.get_model("tracking", "TrackingPoint")
+
+    sessions = TrackingSession.objects.exclude(locations=[]).only(
+        "id", "started_at", "locations"
+    )
+
+    for session in sessions.iterator(chunk_size=100):
+        points = []
+
+        for seq, loc in enumerate(session.locations or [], start=1):
+            points.append(TrackingPoint(
+                session_id=session.id,
+                seq=seq,
+                lat=loc.get("lat"),
+                lng=loc.get("lng"),
+                mode=loc.get("mode", "bike"),
+                timestamp=parse_timestamp(
+                    loc.get("timestamp"), session.started_at
+                ),
+                distance_increment=loc.get("distance_increment", 0),
+                time_increment=loc.get("time_increment", 0)
+            ))
+
+        TrackingPoint.objects.bulk_create(points, batch_size=BATCH_SIZE)
+        TrackingSession.objects.filter(id=session.id).update(
+            point_count=len(points)
+        )
+
+
+def points_to_locations(apps, schema_editor):
+    TrackingSession = apps.get_model("tracking", "TrackingSession")
+    TrackingPoint = apps.get_model("tracking", "TrackingPoint")
+
+    sessions = TrackingSession.objects.filter(point_count__gt=0).only("id")
+
+    for session in sessions.iterator(chunk_size=100):
+        points = TrackingPoint.objects.filter(
+            session_id=session.id
+        ).order_by("seq")
+
+        session.locations = [
+            {
+                "lat": p.lat,
+                "lng": p.lng,
+                "mode": p.mode,
+                "timestamp": str(p.timestamp),
+                "distance_increment": p.distance_increment,
+                "time_increment": p.time_increment
+            }
+            for p in points.iterator(chunk_size=BATCH_SIZE)
+        ]
+        session.save(update_fields=["locations"])
+
+    TrackingPoint.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0002_trackingpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(locations_to_points, points_to_locations),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0.2 on 2026-10-17 01:51
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0003_backfill_trackingpoints'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='trackingsession',
+            name='locations',
+        ),
+    ]
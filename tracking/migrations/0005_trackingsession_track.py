@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 01:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0004_remove_trackingsession_locations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackingsession',
+            name='track',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
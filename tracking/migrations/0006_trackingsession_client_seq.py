@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0005_trackingsession_track'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trackingsession',
+            name='client_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
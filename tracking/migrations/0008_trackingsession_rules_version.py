@@ -0,0 +1,26 @@
+# Generated by Django 6.0.2 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+import tracking.batch
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracking', '0007_dailystats'),
+    ]
+
+    operations = [
+        # Sessions so far were all filtered with these rules
+        migrations.AddField(
+            model_name='trackingsession',
+            name='rules_version',
+            field=models.CharField(default='8dbc55a1e071', editable=False, max_length=12),
+        ),
+        migrations.AlterField(
+            model_name='trackingsession',
+            name='rules_version',
+            field=models.CharField(default=tracking.batch.rules_version, editable=False, max_length=12),
+        ),
+    ]
@@ -1,7 +1,48 @@
-from django.db import models
+import logging
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from .batch import rules_version
+from .codec import EPOCH, PackedTrack, encode_track
+
+
+logger = logging.getLogger(__name__)
+
+
+POINT_FIELDS = (
+    "seq",
+    "lat",
+    "lng",
+    "mode",
+    "timestamp",
+    "distance_increment",
+    "time_increment",
+)
+
+
+def stopped_total_time(total_time, started_at, last_timestamp, ended_at):
+    """A session's total_time as stop_tracking finalizes it at ended_at."""
+    # Calculate total session duration (from start to stop)
+    if started_at:
+        total_session_time = (ended_at - started_at).total_seconds()
+        # Only update total_time if it's less than session duration
+        # (handles cases where tracking was paused/stopped)
+        if total_session_time > total_time:
+            total_time = total_session_time
+
+    # Ensure final time calculation from last location
+    if last_timestamp and last_timestamp < ended_at:
+        final_gap = (ended_at - last_timestamp).total_seconds()
+        # Only add if it's a reasonable gap (less than 10 minutes)
+        if final_gap > 0 and final_gap < 600:
+            total_time += final_gap
+
+    return total_time
+
 
 class TrackingSession(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -11,14 +52,298 @@ class TrackingSession(models.Model):
 
     mode = models.CharField(max_length=20, default="bike")
 
-    locations = models.JSONField(default=list)
-
     total_distance = models.FloatField(default=0)  
     total_time = models.FloatField(default=0)      
 
+    # Number of points, also the seq of the latest point
+    point_count = models.PositiveIntegerField(default=0)
+
+    # Highest client sequence number seen; replays at or below it are dropped
+    client_seq = models.PositiveBigIntegerField(default=0)
+
+    # Filtering rules the totals were derived with (tracking.batch);
+    # recompute_totals leaves sessions on the current ones alone
+    rules_version = models.CharField(max_length=12, default=rules_version, editable=False)
+
+    # Points of ended sessions, packed by tracking.codec
+    track = models.BinaryField(null=True, blank=True, editable=False)
+
     last_lat = models.FloatField(null=True, blank=True)
     last_lng = models.FloatField(null=True, blank=True)
     last_timestamp = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.user.username} - Session {self.id}"
+
+    def get_track(self):
+        return SessionTrack(self)
+
+    def compact(self):
+        """Pack the session's point rows into track and delete the rows.
+
+        Rows appended later (e.g. a flush that lands after stop) stay as
+        rows and are picked up by the next compaction.
+        """
+        columns = {field: [] for field in POINT_FIELDS}
+
+        for chunk in self.get_track().iter_chunks():
+            for point in chunk:
+                for field in POINT_FIELDS:
+                    columns[field].append(point[field])
+
+        if not columns["seq"]:
+            return False
+
+        try:
+            data = encode_track(
+                columns["lat"],
+                columns["lng"],
+                [(ts - EPOCH) // timedelta(milliseconds=1) for ts in columns["timestamp"]],
+                columns["mode"],
+                columns["distance_increment"],
+                columns["time_increment"]
+            )
+        except ValueError as e:
+            logger.warning("Track compaction of session %s skipped: %s", self.id, e)
+            return False
+
+        with transaction.atomic():
+            TrackingSession.objects.filter(id=self.id).update(track=data)
+            self.points.filter(seq__lte=columns["seq"][-1]).delete()
+
+        self.track = data
+        return True
+
+
+class TrackingPoint(models.Model):
+    """One accepted GPS fix. Rows are only ever appended, never rewritten."""
+
+    session = models.ForeignKey(
+        TrackingSession,
+        on_delete=models.CASCADE,
+        related_name="points"
+    )
+    seq = models.PositiveIntegerField()
+
+    lat = models.FloatField()
+    lng = models.FloatField()
+    mode = models.CharField(max_length=20, default="bike")
+    timestamp = models.DateTimeField()
+
+    distance_increment = models.FloatField(default=0)
+    time_increment = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["session", "seq"],
+                name="unique_session_point_seq"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Session {self.session_id} - Point {self.seq}"
+
+    @classmethod
+    def build(cls, session_id, seq, lat, lng, mode, timestamp,
+              distance_increment, time_increment):
+        """An unsaved point for the ingest path.
+
+        Positional arguments, in field order, skip the keyword handling
+        in Model.__init__, which halves the cost per point.
+        """
+        return cls(
+            None,
+            session_id,
+            seq,
+            lat,
+            lng,
+            mode,
+            timestamp,
+            distance_increment,
+            time_increment
+        )
+
+
+class DailyStats(models.Model):
+    """Per user, day and mode totals of ended sessions.
+
+    Rows are incremented when a session stops (see add_session) and can
+    be rebuilt from the sessions with the rollup_stats command.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="daily_stats")
+    day = models.DateField()
+    mode = models.CharField(max_length=20)
+
+    distance = models.FloatField(default=0)
+    time = models.FloatField(default=0)
+    # Sessions started on this day, counted under their first point's mode
+    session_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "day", "mode"],
+                name="unique_user_day_mode"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.day} - {self.mode}"
+
+    @classmethod
+    def add_session(cls, session):
+        """Add an ended session's totals to its user's rows."""
+        rollup = session_rollup(session)
+
+        with transaction.atomic():
+            for (day, mode), (distance, time, sessions) in rollup.items():
+                row = cls.objects.filter(
+                    user_id=session.user_id,
+                    day=day,
+                    mode=mode
+                )
+                totals = {
+                    "distance": F("distance") + distance,
+                    "time": F("time") + time,
+                    "session_count": F("session_count") + sessions,
+                }
+
+                if row.update(**totals):
+                    continue
+
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(
+                            user_id=session.user_id,
+                            day=day,
+                            mode=mode,
+                            distance=distance,
+                            time=time,
+                            session_count=sessions
+                        )
+                except IntegrityError:
+                    # Another session of the same day created the row
+                    # first; add to it instead
+                    row.update(**totals)
+
+
+def session_rollup(session):
+    """{(day, mode): [distance, time, sessions]} for one session.
+
+    Point increments are split by the local day of their timestamp and
+    their mode. Whatever the session totals hold beyond the increments
+    (stop_tracking's time adjustment, recompute_totals) goes to the day
+    and mode of the last point; the session itself counts where it
+    started.
+    """
+    rollup = {}
+    key = None
+    day_start = day_end = None
+
+    for chunk in session.get_track().iter_chunks():
+        for point in chunk:
+            timestamp = point["timestamp"]
+
+            # localdate only when a point crosses midnight
+            if day_start is None or not day_start <= timestamp < day_end:
+                day = timezone.localdate(timestamp)
+                day_start = local_midnight(day)
+                day_end = local_midnight(day + timedelta(days=1))
+
+            key = (day, point["mode"])
+            totals = rollup.get(key)
+            if totals is None:
+                totals = rollup[key] = [0.0, 0.0, 0]
+                if len(rollup) == 1:
+                    totals[2] = 1
+
+            totals[0] += point["distance_increment"]
+            totals[1] += point["time_increment"]
+
+    if key is None:
+        key = (timezone.localdate(session.started_at), session.mode)
+        rollup[key] = [0.0, 0.0, 1]
+
+    distance = sum(totals[0] for totals in rollup.values())
+    time = sum(totals[1] for totals in rollup.values())
+    rollup[key][0] += session.total_distance - distance
+    rollup[key][1] += session.total_time - time
+
+    return rollup
+
+
+def local_midnight(day):
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+
+class SessionTrack:
+    """All points of a session as dicts, in seq order.
+
+    Ended sessions keep their points packed in TrackingSession.track;
+    live sessions (and anything flushed after compaction) are rows.
+    Slicing is by position, i.e. seq - 1.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.packed = PackedTrack(session.track) if session.track else None
+        self.packed_count = len(self.packed) if self.packed else 0
+
+    def __len__(self):
+        return max(self.session.point_count, self.packed_count)
+
+    def rows(self):
+        return self.session.points.filter(
+            seq__gt=self.packed_count
+        ).order_by("seq")
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            index = key + len(self) if key < 0 else key
+            points = self[index:index + 1] if index >= 0 else []
+            if not points:
+                raise IndexError("Point index out of range")
+            return points[0]
+
+        start, stop, _ = key.indices(len(self))
+        points = []
+
+        if self.packed and start < self.packed_count:
+            points += self.packed.points(start, min(stop, self.packed_count))
+
+        if stop > self.packed_count:
+            points += self.rows().filter(
+                seq__gt=max(start, self.packed_count),
+                seq__lte=stop
+            ).values(*POINT_FIELDS)
+
+        return points
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self, chunk_size=2000):
+        # The packed body is inflated as it is read, so memory stays at
+        # about a chunk however long the track is
+        if self.packed:
+            yield from self.packed.iter_points(chunk_size)
+
+        chunk = []
+        for point in self.rows().values(*POINT_FIELDS).iterator(chunk_size=chunk_size):
+            chunk.append(point)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def tail(self):
+        row = self.rows().values(*POINT_FIELDS).last()
+        if row is not None:
+            return row
+
+        return self.packed.tail() if self.packed else None
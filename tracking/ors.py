@@ -0,0 +1,115 @@
+"""Async client for the OpenRouteService directions API.
+
+One pooled httpx client per event loop, a cap on concurrent upstream
+calls, and single-flight: concurrent requests for the same route share
+one upstream call instead of each making their own.
+"""
+
+import asyncio
+import time
+
+import httpx
+from django.conf import settings
+
+from .metrics import ORS_SECONDS
+
+
+PROFILES = {
+    "driving-car",
+    "driving-hgv",
+    "cycling-regular",
+    "cycling-road",
+    "cycling-mountain",
+    "cycling-electric",
+    "foot-walking",
+    "foot-hiking",
+    "wheelchair",
+}
+
+
+class RouteError(Exception):
+    """Upstream answered, but not with a route."""
+
+    def __init__(self, status):
+        super().__init__(f"Routing service returned {status}")
+        self.status = status
+
+
+class OrsClient:
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+
+        self.client = httpx.AsyncClient(
+            base_url=settings.ORS_BASE_URL,
+            timeout=settings.ORS_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.ORS_MAX_CONCURRENCY,
+                max_keepalive_connections=settings.ORS_MAX_CONCURRENCY
+            ),
+            headers={"Authorization": settings.ORS_API_KEY}
+        )
+        self.semaphore = asyncio.Semaphore(settings.ORS_MAX_CONCURRENCY)
+        self.inflight = {}
+
+    async def directions(self, key, profile, coordinates, store=None):
+        """Route GeoJSON for coordinates, coalesced on key.
+
+        store(key, data) is awaited once per upstream call, e.g. to
+        cache the result, however many requests were waiting on it.
+        """
+        task = self.inflight.get(key)
+
+        if task is None:
+            task = self.loop.create_task(
+                self.fetch(key, profile, coordinates, store)
+            )
+            self.inflight[key] = task
+            task.add_done_callback(lambda done: self.finished(key, done))
+
+        # A waiter going away must not cancel the call the others share
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        self.inflight.pop(key, None)
+
+        # Mark the error as seen in case every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def fetch(self, key, profile, coordinates, store=None):
+        async with self.semaphore:
+            # Timed once a slot is free: upstream latency, not our queue
+            start = time.perf_counter()
+            status = "error"
+            try:
+                response = await self.client.post(
+                    f"/v2/directions/{profile}/geojson",
+                    json={"coordinates": coordinates}
+                )
+                status = str(response.status_code)
+            finally:
+                ORS_SECONDS.observe(time.perf_counter() - start, status)
+
+        if response.status_code != 200:
+            raise RouteError(response.status_code)
+
+        data = response.json()
+
+        if store is not None:
+            await store(key, data)
+
+        return data
+
+
+_client = None
+
+
+def get_ors_client():
+    global _client
+
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.loop is not loop:
+        _client = OrsClient()
+
+    return _client
@@ -0,0 +1,330 @@
+"""On-demand sampling profiler for running web workers.
+
+Each worker runs a watcher thread (started from asgi.py) that marks
+the worker alive in PROFILE_DIR/<pid>.worker and looks for a request
+in PROFILE_DIR/<pid>.request, which `manage.py profile_worker` writes.
+On a request the watcher samples every thread's stack with
+sys._current_frames() for the requested time and, meanwhile, times the
+steps of TrackingConsumer.receive by wrapping them. Nothing is wrapped
+or sampled between requests.
+
+Results go to PROFILE_DIR/<pid>-<id>.folded (collapsed stacks, one
+"frame;frame;... count" per line, for flamegraph.pl or speedscope) and
+PROFILE_DIR/<pid>-<id>.json (step timings).
+
+The sampler needs the GIL to look, so a thread is mostly caught where
+it lets go of it (waiting on I/O or the event loop); short bursts of
+pure Python work are under-sampled, which the step timings make up for.
+"""
+
+import functools
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# Steps of a frame's way through TrackingConsumer, timed while
+# profiling: (module, attribute, label). Times are wall clock, so
+# async steps include what ran on the event loop while they waited.
+STEPS = [
+    ("tracking.consumers", "TrackingConsumer.receive", "receive"),
+    ("tracking.consumers", "TrackingConsumer.receive_frame", "receive_frame"),
+    ("tracking.consumers", "decode_frame", "decode_frame"),
+    ("tracking.consumers", "TrackingConsumer.get_state", "get_state"),
+    ("tracking.consumers", "TrackingConsumer.save_location", "save_location"),
+    ("tracking.consumers", "TrackingConsumer.process_point", "process_point"),
+    ("tracking.consumers", "TrackingConsumer.parse_timestamp", "process_point.parse_timestamp"),
+    ("tracking.consumers", "TrackingConsumer.save_batch", "save_batch"),
+    ("tracking.batch", "PointBatch.from_dicts", "PointBatch.from_dicts"),
+    ("tracking.batch", "parse_timestamp", "from_dicts.parse_timestamp"),
+    ("tracking.batch", "PointBatch.from_records", "PointBatch.from_records"),
+    ("tracking.batch", "PointBatch.select", "PointBatch.select"),
+    ("tracking.consumers", "apply_batch", "apply_batch"),
+    ("tracking.ingest", "IngestBuffer.add", "buffer.add"),
+    ("tracking.ingest", "IngestBuffer.when_written", "buffer.when_written"),
+    ("tracking.consumers", "TrackingConsumer.publish_points", "publish_points"),
+    ("tracking.consumers", "TrackingConsumer.send_ack", "send_ack"),
+    ("tracking.dbexecutor", "DatabaseExecutor.run", "db_executor.run"),
+]
+
+# How often an idle watcher looks for a request, in seconds
+POLL_INTERVAL = 1
+
+MAX_SECONDS = 300
+
+_watcher = None
+
+
+def private_dir():
+    """Create PROFILE_DIR if needed; refuse it unless only we can use it."""
+    path = settings.PROFILE_DIR
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must be owned by this user with mode 0700")
+
+    return path
+
+
+def worker_path(pid, suffix):
+    return os.path.join(settings.PROFILE_DIR, f"{pid}{suffix}")
+
+
+def write_json(path, data):
+    temp = f"{path}.tmp"
+    with open(temp, "w") as f:
+        json.dump(data, f)
+    os.replace(temp, path)
+
+
+# ---------------- STEP TIMINGS ----------------
+
+class StepTimes:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+
+    def record(self, label, seconds):
+        with self.lock:
+            step = self.steps.get(label)
+            if step is None:
+                step = self.steps[label] = [0, 0.0, 0.0]
+            step[0] += 1
+            step[1] += seconds
+            step[2] = max(step[2], seconds)
+
+    def report(self):
+        with self.lock:
+            return {
+                label: {
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_us": round(total / calls * 10 ** 6, 1),
+                    "max_ms": round(longest * 1000, 3),
+                }
+                for label, (calls, total, longest) in self.steps.items()
+            }
+
+
+def timed(func, label, times):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                times.record(label, time.perf_counter() - start)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times.record(label, time.perf_counter() - start)
+
+    return wrapper
+
+
+def wrap_steps(times):
+    """Wrap every step; returns what unwrap_steps needs to undo it."""
+    originals = []
+
+    for module_name, path, label in STEPS:
+        owner = importlib.import_module(module_name)
+        *parents, attribute = path.split(".")
+        for parent in parents:
+            owner = getattr(owner, parent)
+
+        original = inspect.getattr_static(owner, attribute)
+        if isinstance(original, classmethod):
+            replacement = classmethod(timed(original.__func__, label, times))
+        else:
+            replacement = timed(original, label, times)
+
+        setattr(owner, attribute, replacement)
+        originals.append((owner, attribute, original))
+
+    return originals
+
+
+def unwrap_steps(originals):
+    for owner, attribute, original in reversed(originals):
+        setattr(owner, attribute, original)
+
+
+# ---------------- SAMPLING ----------------
+
+def frame_label(code):
+    filename = code.co_filename
+    base_dir = str(settings.BASE_DIR) + os.sep
+
+    if filename.startswith(base_dir):
+        filename = filename[len(base_dir):]
+    elif "site-packages" + os.sep in filename:
+        filename = filename.rsplit("site-packages" + os.sep, 1)[-1]
+    else:
+        filename = os.path.basename(filename)
+
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+
+
+def sample(stacks, own_ident):
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+    for ident, frame in sys._current_frames().items():
+        if ident == own_ident:
+            continue
+
+        labels = []
+        while frame is not None:
+            labels.append(frame_label(frame.f_code))
+            frame = frame.f_back
+
+        labels.append(names.get(ident, f"thread-{ident}"))
+        stacks[";".join(reversed(labels))] += 1
+
+
+def profile(seconds, interval):
+    """Sample this process for seconds; (collapsed stacks, step report)."""
+    stacks = Counter()
+    times = StepTimes()
+    own_ident = threading.get_ident()
+
+    originals = wrap_steps(times)
+    start = time.perf_counter()
+    samples = 0
+
+    try:
+        deadline = start + seconds
+        while time.perf_counter() < deadline:
+            sample(stacks, own_ident)
+            samples += 1
+            time.sleep(interval)
+    finally:
+        unwrap_steps(originals)
+
+    elapsed = time.perf_counter() - start
+    folded = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    return folded, {
+        "pid": os.getpid(),
+        "seconds": round(elapsed, 3),
+        "interval_ms": interval * 1000,
+        "samples": samples,
+        "steps": times.report(),
+    }
+
+
+# ---------------- WATCHER ----------------
+
+def handle_request(path):
+    pid = os.getpid()
+
+    try:
+        with open(path) as f:
+            request = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Profile request error: %s", e)
+        request = None
+    finally:
+        os.remove(path)
+
+    if request is None:
+        return
+
+    seconds = min(max(float(request.get("seconds", 10)), 0.1), MAX_SECONDS)
+    interval = max(float(request.get("interval_ms", 10)), 1) / 1000
+    request_id = request.get("id", int(time.time()))
+
+    logger.info("Profiling worker %s for %s s", pid, seconds)
+    folded, report = profile(seconds, interval)
+
+    base = worker_path(f"{pid}-{request_id}", "")
+    with open(f"{base}.folded.tmp", "w") as f:
+        f.write(folded)
+    os.replace(f"{base}.folded.tmp", f"{base}.folded")
+
+    # Written last: its presence means the profile is complete
+    write_json(f"{base}.json", report)
+
+
+def watch():
+    pid = os.getpid()
+    alive = worker_path(pid, ".worker")
+    request = worker_path(pid, ".request")
+
+    while True:
+        try:
+            private_dir()
+            write_json(alive, {"pid": pid, "seen": time.time()})
+
+            if os.path.exists(request):
+                handle_request(request)
+        except Exception as e:
+            logger.exception("Profile watcher error: %s", e)
+
+        time.sleep(POLL_INTERVAL)
+
+
+def start_watcher():
+    """Let profile_worker reach this process (web workers only)."""
+    global _watcher
+
+    if _watcher is not None or not settings.PROFILE_DIR:
+        return
+
+    try:
+        private_dir()
+    except OSError as e:
+        logger.warning("Profile watcher not started: %s", e)
+        return
+
+    _watcher = threading.Thread(target=watch, name="profile-watcher", daemon=True)
+    _watcher.start()
+
+
+def _after_fork():
+    global _watcher
+    _watcher = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def workers():
+    """{pid: seconds since last seen} of the workers in PROFILE_DIR."""
+    found = {}
+    now = time.time()
+
+    try:
+        names = os.listdir(settings.PROFILE_DIR)
+    except FileNotFoundError:
+        return found
+
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        if ext != ".worker" or not stem.isdigit():
+            continue
+
+        try:
+            with open(os.path.join(settings.PROFILE_DIR, name)) as f:
+                found[int(stem)] = now - json.load(f)["seen"]
+        except (OSError, ValueError, KeyError):
+            continue
+
+    return found
@@ -0,0 +1,97 @@
+"""Binary frames for TrackingConsumer.
+
+Clients that offer the BINARY_SUBPROTOCOL WebSocket subprotocol on
+connect may send batches as binary frames instead of JSON::
+
+    header   u8 version, u8 flags, u16 count, u32 session_id
+    record   i32 lat, i32 lng (micro-degrees), i64 epoch-ms,
+             u8 mode, u8 reserved, u16 accuracy (meters), 20 bytes each
+
+With FLAG_SEQ set, each record also carries the client's u32 sequence
+number after the timestamp (24 bytes each). All little-endian.
+Records are read in place with np.frombuffer, so a frame is decoded
+without copying or per-point parsing.
+"""
+
+import struct
+
+import numpy as np
+
+
+BINARY_SUBPROTOCOL = "locatracker.bin.v1"
+
+VERSION = 1
+
+HEADER = struct.Struct("<BBHI")
+
+RECORD = np.dtype([
+    ("lat", "<i4"),
+    ("lng", "<i4"),
+    ("ts_ms", "<i8"),
+    ("mode", "u1"),
+    ("reserved", "u1"),
+    ("accuracy", "<u2"),
+])
+
+RECORD_SEQ = np.dtype([
+    ("lat", "<i4"),
+    ("lng", "<i4"),
+    ("ts_ms", "<i8"),
+    ("seq", "<u4"),
+    ("mode", "u1"),
+    ("reserved", "u1"),
+    ("accuracy", "<u2"),
+])
+
+FLAG_SEQ = 0x01
+
+COORD_SCALE = 10 ** 6
+
+# Mode byte -> mode name; codes are part of the protocol, only append
+MODES = ("walk", "bike", "car")
+
+
+class FrameError(ValueError):
+    pass
+
+
+def decode_frame(data):
+    """Session id and a read-only record array for one binary frame."""
+    data = memoryview(data)
+
+    if len(data) < HEADER.size:
+        raise FrameError("Frame too short")
+
+    version, flags, count, session_id = HEADER.unpack_from(data, 0)
+
+    if version != VERSION:
+        raise FrameError(f"Unsupported frame version {version}")
+
+    dtype = RECORD_SEQ if flags & FLAG_SEQ else RECORD
+
+    if len(data) != HEADER.size + count * dtype.itemsize:
+        raise FrameError("Frame length does not match record count")
+
+    records = np.frombuffer(data, dtype=dtype, count=count, offset=HEADER.size)
+    return session_id, records
+
+
+def encode_frame(session_id, points):
+    """Binary frame for point dicts with lat, lng, ts_ms, mode, accuracy
+    and, optionally, cseq."""
+    with_seq = bool(points) and all("cseq" in point for point in points)
+
+    records = np.zeros(len(points), dtype=RECORD_SEQ if with_seq else RECORD)
+    codes = {mode: i for i, mode in enumerate(MODES)}
+
+    for record, point in zip(records, points):
+        record["lat"] = round(point["lat"] * COORD_SCALE)
+        record["lng"] = round(point["lng"] * COORD_SCALE)
+        record["ts_ms"] = point["ts_ms"]
+        record["mode"] = codes[point.get("mode", "bike")]
+        record["accuracy"] = min(round(point.get("accuracy") or 0), 0xFFFF)
+        if with_seq:
+            record["seq"] = point["cseq"]
+
+    flags = FLAG_SEQ if with_seq else 0
+    return HEADER.pack(VERSION, flags, len(points), session_id) + records.tobytes()
@@ -0,0 +1,127 @@
+"""Route cache for the ORS proxy.
+
+Two levels: a small per-process LRU in front, and the Django cache
+(Redis in production) shared by every worker and kept across restarts.
+Both expire entries after ROUTE_CACHE_TTL seconds.
+
+Coordinates are snapped to a grid of ROUTE_CACHE_GRID degrees before
+they are used as a key, and the snapped coordinates are what is sent
+upstream, so nearby requests share one cached route.
+"""
+
+import math
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import ROUTE_CACHE_LOOKUPS
+
+
+def snap(coordinates, grid):
+    """[[lng, lat], ...] rounded to the grid, plus the grid cells.
+
+    Raises ValueError for coordinates that are not finite numbers.
+    """
+    points = [(float(lng), float(lat)) for lng, lat in coordinates]
+    if not all(math.isfinite(lng) and math.isfinite(lat) for lng, lat in points):
+        raise ValueError("Coordinates must be finite")
+
+    cells = [
+        (round(lng / grid), round(lat / grid))
+        for lng, lat in points
+    ]
+    snapped = [[round(x * grid, 7), round(y * grid, 7)] for x, y in cells]
+
+    return snapped, cells
+
+
+def route_key(profile, cells):
+    points = ":".join(f"{x},{y}" for x, y in cells)
+    return f"route:{profile}:{points}"
+
+
+class RouteCache:
+
+    def __init__(self, ttl, local_size, alias="default"):
+        self.ttl = ttl
+        self.local_size = local_size
+        self.alias = alias
+
+        self.local = OrderedDict()
+        self.stats = {
+            "local_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def remember(self, key, data, expires):
+        self.local[key] = (expires, data)
+        self.local.move_to_end(key)
+
+        if len(self.local) > self.local_size:
+            self.local.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            expires, data = entry
+            if expires > time.monotonic():
+                self.local.move_to_end(key)
+                self.stats["local_hits"] += 1
+                ROUTE_CACHE_LOOKUPS.inc("local_hit")
+                return data
+
+            del self.local[key]
+
+        try:
+            data = await self.shared.aget(key)
+        except Exception as e:
+            print("Route cache read error:", e)
+            data = None
+
+        if data is None:
+            self.stats["misses"] += 1
+            ROUTE_CACHE_LOOKUPS.inc("miss")
+            return None
+
+        # Locally this may outlive the shared entry by up to ttl
+        self.remember(key, data, time.monotonic() + self.ttl)
+        self.stats["shared_hits"] += 1
+        ROUTE_CACHE_LOOKUPS.inc("shared_hit")
+        return data
+
+    async def set(self, key, data):
+        self.remember(key, data, time.monotonic() + self.ttl)
+
+        try:
+            await self.shared.aset(key, data, self.ttl)
+        except Exception as e:
+            print("Route cache write error:", e)
+
+    def snapshot(self):
+        lookups = (
+            self.stats["local_hits"]
+            + self.stats["shared_hits"]
+            + self.stats["misses"]
+        )
+        hits = self.stats["local_hits"] + self.stats["shared_hits"]
+
+        return {
+            **self.stats,
+            "local_size": len(self.local),
+            "hit_ratio": round(hits / lookups, 4) if lookups else None,
+        }
+
+
+route_cache = RouteCache(
+    ttl=settings.ROUTE_CACHE_TTL,
+    local_size=settings.ROUTE_CACHE_LOCAL_SIZE
+)
@@ -3,4 +3,8 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'^ws/tracking/$', consumers.TrackingConsumer.as_asgi()),
+    re_path(
+        r'^ws/tracking/(?P<session_id>\d+)/view/$',
+        consumers.TrackingViewerConsumer.as_asgi()
+    ),
 ]
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""Douglas-Peucker simplification of session tracks for the map.
+
+Instead of running Douglas-Peucker once per tolerance, each point gets
+a weight: the largest tolerance at which DP would still keep it. Any
+level of detail is then just ``weights > tolerance``, so the weights
+are worked out once and shared by every zoom level.
+
+Tracks are split into fixed blocks of BLOCK_SIZE points, each
+simplified on its own (block endpoints are always kept). Points are
+only ever appended, so a full block never changes and its weights are
+cached for good; a live session only recomputes its last, partial block.
+"""
+
+import math
+
+import numpy as np
+from django.core.cache import cache
+
+from .models import POINT_FIELDS
+
+
+BLOCK_SIZE = 1024
+
+# Segments at most this long are scanned in plain Python
+SMALL_SEGMENT = 32
+
+# Meters per pixel at zoom 0 on the equator (Web Mercator tiles)
+METERS_PER_PIXEL = 156543.03392
+
+# Leaflet's tile layer goes up to zoom 19
+MAX_ZOOM = 19
+
+# Tolerance of the coarse level embedded in the map page
+INITIAL_ZOOM = 12
+
+METERS_PER_DEGREE = 111320
+
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def project(lat, lng):
+    """Equirectangular projection to meters around the track's start."""
+    scale = np.cos(np.radians(lat[0])) if len(lat) else 1.0
+    return lng * METERS_PER_DEGREE * scale, lat * METERS_PER_DEGREE
+
+
+def zoom_tolerance(zoom, lat):
+    """Size of one screen pixel in meters at this zoom and latitude."""
+    return METERS_PER_PIXEL * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def dp_weights(x, y):
+    """Douglas-Peucker weight of every point of a polyline."""
+    n = len(x)
+    weights = np.zeros(n)
+    if n == 0:
+        return weights
+
+    weights[0] = weights[-1] = np.inf
+    xl = x.tolist()
+    yl = y.tolist()
+    stack = [(0, n - 1, np.inf)]
+
+    while stack:
+        first, last, ceiling = stack.pop()
+        if last - first < 2:
+            continue
+
+        x0, y0 = xl[first], yl[first]
+        dx = xl[last] - x0
+        dy = yl[last] - y0
+        norm = math.hypot(dx, dy)
+
+        if last - first > SMALL_SEGMENT:
+            xs = x[first + 1:last] - x0
+            ys = y[first + 1:last] - y0
+
+            if norm:
+                distance = np.abs(dy * xs - dx * ys) / norm
+            else:
+                distance = np.hypot(xs, ys)
+
+            k = int(np.argmax(distance))
+            index = first + 1 + k
+            best = float(distance[k])
+        else:
+            # NumPy call overhead dominates on short segments
+            index = first + 1
+            best = -1.0
+
+            for i in range(first + 1, last):
+                if norm:
+                    d = abs(dy * (xl[i] - x0) - dx * (yl[i] - y0)) / norm
+                else:
+                    d = math.hypot(xl[i] - x0, yl[i] - y0)
+
+                if d > best:
+                    best = d
+                    index = i
+
+        # A point can't outlive the split that exposed it
+        weight = min(best, ceiling)
+        weights[index] = weight
+
+        stack.append((first, index, weight))
+        stack.append((index, last, weight))
+
+    return weights
+
+
+def track_weights(session, lat, lng):
+    """Weights for a whole track, using cached blocks where possible."""
+    n = len(lat)
+    x, y = project(lat, lng)
+    ended = session.ended_at is not None
+
+    weights = np.empty(n, dtype=np.float32)
+
+    for start in range(0, n, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n)
+
+        # A partial block of a live session will still grow
+        cacheable = ended or stop - start == BLOCK_SIZE
+        key = f"track_lod:{session.id}:{start // BLOCK_SIZE}:{stop - start}"
+
+        cached = cache.get(key) if cacheable else None
+        if cached is not None:
+            weights[start:stop] = np.frombuffer(cached, dtype=np.float32)
+            continue
+
+        block = dp_weights(x[start:stop], y[start:stop])
+        weights[start:stop] = block
+
+        if cacheable:
+            cache.set(key, weights[start:stop].tobytes(), CACHE_TIMEOUT)
+
+    return weights
+
+
+def simplify_track(session, tolerance):
+    """Points of the session kept at this tolerance (meters), in order."""
+    track = session.get_track()
+    rows = list(track.rows().values(*POINT_FIELDS))
+
+    lat = np.array([row["lat"] for row in rows], dtype=np.float64)
+    lng = np.array([row["lng"] for row in rows], dtype=np.float64)
+
+    if track.packed:
+        columns = track.packed.columns()
+        lat = np.concatenate([columns["lat"], lat])
+        lng = np.concatenate([columns["lng"], lng])
+
+    if not len(lat):
+        return []
+
+    keep = np.flatnonzero(track_weights(session, lat, lng) > tolerance)
+
+    split = np.searchsorted(keep, track.packed_count)
+    points = []
+
+    if track.packed:
+        points += track.packed.points_at(keep[:split])
+
+    points += [rows[i - track.packed_count] for i in keep[split:].tolist()]
+
+    return points
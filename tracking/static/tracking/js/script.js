@@ -18,6 +18,25 @@ let socket = null;
 
 let locationBuffer = [];
 let offlineBuffer = [];
+
+// Every point gets the next sequence number; sent points stay in
+// unacked until the server acks them as stored, and are resent on
+// reconnect (the server drops any it has already seen)
+let nextSeq = 1;
+let unacked = [];
+const MAX_UNACKED = 500;
+
+// Large offline buffers go up over HTTP in gzipped NDJSON chunks
+// instead of one huge WebSocket frame
+const MAX_OFFLINE = 20000;
+const UPLOAD_THRESHOLD = 100;
+const UPLOAD_CHUNK = 2000;
+let uploading = false;
+
+// Set from the server's throttle message: frames sent before this time
+// are dropped, so points wait in the offline buffer until then
+let throttledUntil = 0;
+
 let lastSentTime = 0;
 let isOnline = navigator.onLine;
 let reconnectAttempts = 0;
@@ -150,6 +169,51 @@ async function getRoute(from, to) {
   }
 }
 
+// Binary batches (see tracking/protocol.py) when the server agrees to
+// the subprotocol, JSON otherwise
+const BINARY_PROTOCOL = "locatracker.bin.v1";
+const BINARY_MODES = { walk: 0, bike: 1, car: 2 };
+
+const FLAG_SEQ = 0x01;
+
+function encodeBatch(locations) {
+  // 24-byte records: the sequence number follows the timestamp
+  const buffer = new ArrayBuffer(8 + locations.length * 24);
+  const view = new DataView(buffer);
+
+  view.setUint8(0, 1);
+  view.setUint8(1, FLAG_SEQ);
+  view.setUint16(2, locations.length, true);
+  view.setUint32(4, sessionId, true);
+
+  locations.forEach((loc, i) => {
+    const offset = 8 + i * 24;
+    view.setInt32(offset, Math.round(loc.lat * 1e6), true);
+    view.setInt32(offset + 4, Math.round(loc.lng * 1e6), true);
+    view.setBigInt64(offset + 8, BigInt(Date.parse(loc.timestamp)), true);
+    view.setUint32(offset + 16, loc.cseq, true);
+    view.setUint8(offset + 20, BINARY_MODES[loc.mode] ?? BINARY_MODES.bike);
+    view.setUint16(offset + 22, Math.min(Math.round(loc.accuracy || 0), 0xFFFF), true);
+  });
+
+  return buffer;
+}
+
+function sendBatch(locations, retry = false) {
+  if (!retry) {
+    unacked = unacked.concat(locations).slice(-MAX_UNACKED);
+  }
+
+  if (socket.protocol === BINARY_PROTOCOL) {
+    socket.send(encodeBatch(locations));
+  } else {
+    socket.send(JSON.stringify({
+      session_id: sessionId,
+      locations: locations
+    }));
+  }
+}
+
 function createSocket() {
   return new Promise((resolve, reject) => {
  
@@ -157,7 +221,7 @@ function createSocket() {
     const wsUrl = `${protocol}://${window.location.host}/ws/tracking/`;
 
     showStatus("Connecting to server...", 'info');
-    socket = new WebSocket(wsUrl);
+    socket = new WebSocket(wsUrl, [BINARY_PROTOCOL]);
 
     const connectionTimeout = setTimeout(() => {
       socket.close();
@@ -169,16 +233,23 @@ function createSocket() {
         clearTimeout(connectionTimeout);
         reconnectAttempts = 0;
         showStatus("WebSocket Connected", 'info', 2000);
-        if (offlineBuffer.length > 0) {
-            socket.send(JSON.stringify({
-                session_id: sessionId,
-                locations: offlineBuffer
-            }));
-            offlineBuffer = [];
-        }
+        flushOffline();
         resolve();
     };
 
+    socket.onmessage = (event) => {
+      if (typeof event.data !== "string") return;
+
+      const data = JSON.parse(event.data);
+      if (data.type === "ack" && data.session_id === sessionId) {
+        unacked = unacked.filter(loc => loc.cseq > data.seq);
+      }
+      if (data.type === "throttle") {
+        if (data.coalesced) console.log(`Server thinned ${data.coalesced} points`);
+        if (data.retry_after > 0) backOff(data.retry_after);
+      }
+    };
+
     socket.onerror = (err) => {
       clearTimeout(connectionTimeout);
       showStatus("WebSocket Error: " + (err.message || err), 'error', 8000);
@@ -203,16 +274,89 @@ function createSocket() {
 }
 
 
+function backOff(seconds) {
+  const wait = Math.ceil(seconds * 1000);
+  throttledUntil = Date.now() + wait;
+
+  // Unacked points were dropped; resend them, then anything buffered
+  setTimeout(() => {
+    if (socket?.readyState === WebSocket.OPEN && Date.now() >= throttledUntil) {
+      flushOffline();
+    }
+  }, wait);
+}
+
+// The server drops anything at or below the highest sequence number it
+// has seen, so points must reach it in order: unacked first, then offline
+function flushOffline() {
+  if (offlineBuffer.length > UPLOAD_THRESHOLD) {
+    const first = offlineBuffer[0].cseq;
+    offlineBuffer = unacked.filter(loc => loc.cseq < first).concat(offlineBuffer);
+    unacked = [];
+    uploadOffline();
+    return;
+  }
+
+  if (unacked.length > 0) {
+    sendBatch(unacked, true);
+  }
+  if (offlineBuffer.length > 0) {
+    sendBatch(offlineBuffer);
+    offlineBuffer = [];
+  }
+}
+
+async function gzipBody(text) {
+  if (!window.CompressionStream) return { body: text, encoding: null };
+
+  const stream = new Blob([text]).stream().pipeThrough(new CompressionStream("gzip"));
+  return { body: await new Response(stream).blob(), encoding: "gzip" };
+}
+
+async function uploadOffline() {
+  if (uploading || !sessionId) return;
+  uploading = true;
+
+  try {
+    while (offlineBuffer.length > 0) {
+      const chunk = offlineBuffer.slice(0, UPLOAD_CHUNK);
+      const { body, encoding } = await gzipBody(
+        chunk.map(loc => JSON.stringify(loc)).join("\n")
+      );
+
+      const headers = {
+        "Content-Type": "application/x-ndjson",
+        "X-CSRFToken": csrfToken
+      };
+      if (encoding) headers["Content-Encoding"] = encoding;
+
+      const res = await fetch(`/tracking/${sessionId}/points/`, {
+        method: "POST",
+        headers: headers,
+        body: body
+      });
+      const data = await res.json();
+      if (data.seq === undefined) break;
+
+      // Everything up to seq is stored, by this request or an earlier one
+      const before = offlineBuffer.length;
+      offlineBuffer = offlineBuffer.filter(loc => loc.cseq > data.seq);
+
+      if (!res.ok || offlineBuffer.length === before) break;
+    }
+  } catch (err) {
+    console.error("Offline upload failed:", err);
+  } finally {
+    uploading = false;
+  }
+}
+
 window.addEventListener('online', () => {
   isOnline = true;
   showStatus('Back online - syncing offline data', 'info', 4000);
   // Send offline buffer first when back online
-  if (offlineBuffer.length > 0 && socket?.readyState === WebSocket.OPEN) {
-    socket.send(JSON.stringify({
-      session_id: sessionId,
-      locations: offlineBuffer
-    }));
-    offlineBuffer = [];
+  if (socket?.readyState === WebSocket.OPEN) {
+    flushOffline();
   }
 });
 
@@ -233,30 +377,39 @@ function sendLocation(lat, lng, accuracy) {
         lng: lng,
         mode: trackingMode,
         accuracy: accuracy,
-        timestamp: new Date().toISOString()
+        timestamp: new Date().toISOString(),
+        cseq: nextSeq++
     };
 
-    if (isOnline && socket && socket.readyState === WebSocket.OPEN) {
+    // Live sending waits until the offline backlog is uploaded
+    const backlog = uploading || offlineBuffer.length > 0 || Date.now() < throttledUntil;
+
+    if (isOnline && !backlog && socket && socket.readyState === WebSocket.OPEN) {
         locationBuffer.push(locationData);
 
         const shouldSend = locationBuffer.length >= MAX_BUFFER_SIZE ||
                           (Date.now() - lastSentTime) > 20000; 
 
         if (shouldSend) {
-            socket.send(JSON.stringify({
-                session_id: sessionId,
-                locations: locationBuffer
-            }));
+            sendBatch(locationBuffer);
             locationBuffer = [];
             lastSentTime = Date.now();
         }
     } else {
-        // Store in offline buffer
-        offlineBuffer.push(locationData);
-        if (offlineBuffer.length > 50) {
-            offlineBuffer = offlineBuffer.slice(-25); 
+        // Store in offline buffer, behind anything not sent yet
+        offlineBuffer.push(...locationBuffer, locationData);
+        locationBuffer = [];
+        if (offlineBuffer.length > MAX_OFFLINE) {
+            offlineBuffer = offlineBuffer.slice(-MAX_OFFLINE);
+        }
+
+        const throttled = Date.now() < throttledUntil;
+        if (isOnline && !uploading && !throttled && socket?.readyState === WebSocket.OPEN) {
+            // Back online with a backlog left over: send it, in order
+            flushOffline();
+        } else {
+            console.log(`Offline: buffered ${offlineBuffer.length} locations`);
         }
-        console.log(`Offline: buffered ${offlineBuffer.length} locations`);
     }
 }
 
@@ -371,6 +524,8 @@ startBtn.onclick = async () => {
 
     if (data.session_id) {
       sessionId = data.session_id;
+      nextSeq = 1;
+      unacked = [];
     } else {
       showStatus("Session creation failed", 'error', 6000);
       startBtn.disabled = false;
@@ -446,10 +601,7 @@ stopBtn.onclick = async () => {
   animationToken++;
   if (watchId !== null) navigator.geolocation.clearWatch(watchId);
   if (locationBuffer.length > 0 && socket?.readyState === WebSocket.OPEN) {
-    socket.send(JSON.stringify({
-        session_id: sessionId,
-        locations: locationBuffer
-    }));
+    sendBatch(locationBuffer);
     locationBuffer = [];
 }
   if (socket) socket.close();
@@ -1,3 +1,1141 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DataError
+from django.db.models import F, QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .batch import PointBatch
+from .codec import PackedTrack, encode_track
+from .consumers import (
+    DROPPED_CLOSE_CODE,
+    SessionState,
+    TrackingConsumer,
+    fetch_state,
+    notify_session_stopped,
+)
+from .export import CSV_COLUMNS
+from .ingest import PendingSession, apply_batch, write_pending
+from .management.commands.recompute_totals import recompute_chunk
+from .mapcache import MAX_AGE as MAP_MAX_AGE, SETTLE_TIME
+from .metrics import render as render_metrics
+from .models import DailyStats, TrackingPoint, TrackingSession, stopped_total_time
+from .profiler import private_dir
+from .protocol import (
+    BINARY_SUBPROTOCOL,
+    COORD_SCALE as FRAME_COORD_SCALE,
+    FrameError,
+    decode_frame,
+    encode_frame,
+)
+from .routecache import route_cache
+from .routing import websocket_urlpatterns
+from .throttle import IngestThrottle, TokenBucket
+from .upload import SessionEnded, ingest_points
+
+
+START = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+IN_MEMORY_LAYER = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def make_points(count, offset=0, mode="bike"):
+    """Client dicts about 35 m and a second apart, so all are accepted."""
+    return [
+        {
+            "lat": 28.6 + (offset + i) * 0.0003,
+            "lng": 77.2,
+            "mode": mode,
+            "timestamp": (START + timedelta(seconds=offset + i)).isoformat(),
+            "cseq": offset + i + 1,
+        }
+        for i in range(count)
+    ]
+
+
+def pending_batch(state, points):
+    batch = PointBatch.from_dicts(points)
+    pending = PendingSession(state.id)
+    pending.add(state, apply_batch(state, batch, batch.select(state)))
+    return pending
+
+
+def store(session, points):
+    """Accept and write points the way a WebSocket flush does."""
+    state = fetch_state(session.id, session.user)
+    write_pending([pending_batch(state, points)])
+    session.refresh_from_db()
+
+
+def noisy_points(count, seed):
+    """Client dicts with jitter, duplicates, stops and clock steps back,
+    so every filter rejects some."""
+    rng = random.Random(seed)
+    lat, lng = 28.6, 77.2
+    seconds = 0
+    points = []
+
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.1:
+            pass
+        elif roll < 0.4:
+            lat += rng.uniform(-0.00005, 0.00005)
+        else:
+            lat += rng.uniform(0.0001, 0.0004)
+            lng += rng.uniform(-0.0002, 0.0002)
+
+        seconds += rng.choice([1, 2, 5, -3, 400]) if rng.random() < 0.2 else 1
+        points.append({
+            "lat": round(lat, 6),
+            "lng": round(lng, 6),
+            "mode": rng.choice(["walk", "bike", "car"]),
+            "timestamp": (START + timedelta(seconds=seconds)).isoformat(),
+        })
+
+    return points
+
+
+def empty_state():
+    return SessionState(
+        id=1,
+        total_distance=0,
+        total_time=0,
+        point_count=0,
+        last_lat=None,
+        last_lng=None,
+        last_timestamp=None,
+        client_seq=0
+    )
+
+
+# ---------------- BATCH FILTERING ----------------
+
+class BatchEquivalenceTests(TestCase):
+    """The batch path keeps exactly the points process_point keeps."""
+
+    def check(self, points, split):
+        consumer = TrackingConsumer()
+
+        scalar_state = empty_state()
+        expected = [
+            point for point in (
+                consumer.process_point(
+                    scalar_state, p["lat"], p["lng"], p["mode"], p["timestamp"]
+                )
+                for p in points
+            )
+            if point is not None
+        ]
+
+        # In two frames, so the second starts from an anchor
+        batch_state = empty_state()
+        actual = []
+        for frame in (points[:split], points[split:]):
+            batch = PointBatch.from_dicts(frame)
+            actual += apply_batch(batch_state, batch, batch.select(batch_state))
+
+        self.assertGreater(len(expected), 0)
+        self.assertLess(len(expected), len(points))
+        self.assertEqual(
+            [(p.seq, p.lat, p.lng, p.mode, p.timestamp) for p in actual],
+            [(p.seq, p.lat, p.lng, p.mode, p.timestamp) for p in expected]
+        )
+        for a, e in zip(actual, expected):
+            self.assertAlmostEqual(a.distance_increment, e.distance_increment, places=6)
+            self.assertAlmostEqual(a.time_increment, e.time_increment, places=6)
+
+        self.assertAlmostEqual(batch_state.total_distance, scalar_state.total_distance, places=4)
+        self.assertAlmostEqual(batch_state.total_time, scalar_state.total_time, places=4)
+
+    def test_small_frames(self):
+        for seed in range(20):
+            self.check(noisy_points(20, seed), split=10)
+
+    def test_large_frames(self):
+        for seed in range(5):
+            self.check(noisy_points(600, seed), split=300)
+
+    def test_non_finite_and_off_globe_points_are_dropped(self):
+        for count, split in ((20, 10), (600, 300)):
+            points = noisy_points(count, seed=3)
+            for i, (lat, lng) in zip(
+                range(3, count, 7),
+                [("nan", 77.2), (1e999, 77.2), (28.6, "-inf"), (91, 77.2), (28.6, 180.5)] * count
+            ):
+                points[i] = {**points[i], "lat": lat, "lng": lng}
+
+            self.check(points, split)
+
+
+# ---------------- PACKED TRACKS ----------------
+
+class CodecTests(TestCase):
+
+    def test_round_trip_within_documented_precision(self):
+        lat = [28.61234567, 28.61239999]
+        lng = [77.20000001, 77.20004444]
+        ts_ms = [1767225600000, 1767225601000]
+        track = PackedTrack(encode_track(lat, lng, ts_ms, ["bike", "car"], [0, 5.123456789], [0, 1]))
+
+        points = track.points()
+        self.assertEqual([p["mode"] for p in points], ["bike", "car"])
+        for point, expected_lat, expected_lng in zip(points, lat, lng):
+            self.assertAlmostEqual(point["lat"], expected_lat, delta=1e-7)
+            self.assertAlmostEqual(point["lng"], expected_lng, delta=1e-7)
+        self.assertAlmostEqual(points[1]["distance_increment"], 5.123456789, places=5)
+
+    def test_oversized_mode_name_is_a_value_error(self):
+        with self.assertRaises(ValueError):
+            encode_track([1], [1], [0], ["x" * 256], [0], [0])
+
+
+# ---------------- THROTTLE ----------------
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class ThrottleTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("tracking.throttle.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTests(ThrottleTestCase):
+
+    def test_refills_at_rate_up_to_the_burst(self):
+        bucket = TokenBucket(rate=2, capacity=10)
+        self.assertEqual(bucket.available(self.clock.now), 10)
+
+        bucket.take(10)
+        self.assertEqual(bucket.available(self.clock.now), 0)
+        self.assertEqual(bucket.wait(), 0.5)
+
+        self.clock.now += 1.5
+        self.assertEqual(bucket.available(self.clock.now), 3)
+
+        self.clock.now += 100
+        self.assertEqual(bucket.available(self.clock.now), 10)
+
+
+@override_settings(INGEST_THROTTLE={
+    "connection": {"frames": (100, 100), "points": (1000, 1000)},
+    "user": {"frames": (1, 3), "points": (10, 10)},
+})
+class IngestThrottleTests(ThrottleTestCase):
+
+    def test_user_frame_bucket_is_shared_by_connections(self):
+        first, second = IngestThrottle(user_id=1), IngestThrottle(user_id=1)
+
+        self.assertIsNone(first.frame())
+        self.assertIsNone(first.frame())
+        self.assertIsNone(second.frame())
+
+        self.assertEqual(second.frame(), 1)
+        self.assertEqual(first.frame(), 1)
+
+        # Blocked for the window, then let through once a token is back
+        self.clock.now += 0.5
+        self.assertAlmostEqual(second.frame(), 0.5)
+        self.clock.now += 0.5
+        self.assertIsNone(second.frame())
+
+        # Other users are not affected
+        self.assertIsNone(IngestThrottle(user_id=2).frame())
+
+    def test_user_point_bucket_is_shared_by_connections(self):
+        first, second = IngestThrottle(user_id=1), IngestThrottle(user_id=1)
+
+        self.assertEqual(first.points(8), 8)
+        self.assertEqual(second.points(5), 2)
+
+        # None left refuses the frame until a point token is back
+        self.assertEqual(second.points(5), 0)
+        self.assertAlmostEqual(second.retry_after(), 0.1)
+
+        self.clock.now += 0.5
+        self.assertEqual(first.points(20), 5)
+
+
+# ---------------- INGEST ----------------
+
+class WritePendingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="ingest")
+        self.first = TrackingSession.objects.create(user=self.user)
+        self.second = TrackingSession.objects.create(user=self.user)
+
+    def test_stale_tail_is_renumbered_and_others_written(self):
+        first_state = fetch_state(self.first.id, self.user)
+        second_state = fetch_state(self.second.id, self.user)
+
+        # Another writer appends to the first session behind its back
+        TrackingPoint.objects.create(
+            session=self.first, seq=1, lat=1, lng=1, timestamp=START
+        )
+        TrackingSession.objects.filter(id=self.first.id).update(point_count=1)
+
+        stale = pending_batch(first_state, make_points(3))
+        fresh = pending_batch(second_state, make_points(2))
+
+        self.assertEqual(write_pending([stale, fresh]), {})
+        self.assertTrue(stale.renumbered)
+
+        self.assertEqual(
+            list(self.first.points.order_by("seq").values_list("seq", flat=True)),
+            [1, 2, 3, 4]
+        )
+        self.assertEqual(self.second.points.count(), 2)
+
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.point_count, 4)
+        self.assertEqual(self.first.client_seq, 3)
+
+    def test_session_gone_drops_only_its_points(self):
+        first_state = fetch_state(self.first.id, self.user)
+        second_state = fetch_state(self.second.id, self.user)
+
+        gone = pending_batch(first_state, make_points(3))
+        kept = pending_batch(second_state, make_points(2))
+        self.first.delete()
+
+        dropped = write_pending([gone, kept])
+
+        self.assertEqual(list(dropped), [first_state.id])
+        self.assertFalse(TrackingPoint.objects.filter(session_id=first_state.id).exists())
+        self.assertEqual(self.second.points.count(), 2)
+
+    def test_unknown_modes_never_reach_the_buffer(self):
+        points = make_points(3)
+        points[1]["mode"] = "x" * 40
+        points[2]["mode"] = ["car"]
+
+        batch = PointBatch.from_dicts(points)
+
+        self.assertEqual(len(batch), 1)
+        self.assertEqual(batch.modes, ["bike"])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, INGEST_FLUSH_INTERVAL_MS=10)
+class IngestAckTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="acks")
+        self.session = TrackingSession.objects.create(user=self.user)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(TrackingConsumer.as_asgi(), "/ws/tracking/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def send(self, communicator, points):
+        await communicator.send_to(text_data=json.dumps({
+            "session_id": self.session.id,
+            "locations": points,
+        }))
+
+    async def test_ack_after_points_are_stored(self):
+        communicator = await self.connect()
+        await self.send(communicator, make_points(3))
+
+        ack = json.loads(await communicator.receive_from(timeout=5))
+        self.assertEqual(ack, {"type": "ack", "session_id": self.session.id, "seq": 3})
+        self.assertEqual(await self.session.points.acount(), 3)
+
+        await communicator.disconnect()
+
+    async def test_dropped_points_are_never_acked(self):
+        communicator = await self.connect()
+
+        with mock.patch("tracking.ingest.write_session", side_effect=DataError("too long")):
+            await self.send(communicator, make_points(3))
+            self.assertTrue(await communicator.receive_nothing(timeout=0.5))
+
+        # Not taken on top of the dropped points: the client reconnects
+        # and resends from what is stored
+        await self.send(communicator, make_points(2, offset=3))
+        output = await communicator.receive_output(timeout=5)
+        self.assertEqual(output, {"type": "websocket.close", "code": DROPPED_CLOSE_CODE})
+
+        await self.session.arefresh_from_db()
+        self.assertEqual(self.session.client_seq, 0)
+        self.assertEqual(await self.session.points.acount(), 0)
+
+        communicator = await self.connect()
+        await self.send(communicator, make_points(5))
+
+        ack = json.loads(await communicator.receive_from(timeout=5))
+        self.assertEqual(ack["seq"], 5)
+        self.assertEqual(await self.session.points.acount(), 5)
+
+        await communicator.disconnect()
+
+
+class StopTrackingTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="stopper")
+        self.session = TrackingSession.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse("stop_tracking", args=[self.session.id])
+
+    def test_flush_during_stop_is_kept(self):
+        def flush_meanwhile(*args):
+            # Another worker's flush of one more point
+            TrackingSession.objects.filter(id=self.session.id).update(
+                point_count=F("point_count") + 1,
+                total_distance=F("total_distance") + 50,
+                client_seq=F("client_seq") + 1
+            )
+            return stopped_total_time(*args)
+
+        with mock.patch("tracking.views.stopped_total_time", side_effect=flush_meanwhile):
+            response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.session.refresh_from_db()
+        self.assertEqual(
+            (self.session.point_count, self.session.total_distance, self.session.client_seq),
+            (1, 50, 1)
+        )
+        self.assertIsNotNone(self.session.ended_at)
+
+    def test_repeated_stop_counts_once(self):
+        self.client.post(self.url)
+        self.session.refresh_from_db()
+        ended_at = self.session.ended_at
+
+        self.client.post(self.url)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.ended_at, ended_at)
+        self.assertEqual(DailyStats.objects.get(user=self.user).session_count, 1)
+
+
+# ---------------- SESSION MAP ----------------
+
+class SessionMapTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="mapper")
+        self.session = TrackingSession.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse("session_map", args=[self.session.id])
+
+    def get(self, **params):
+        headers = params.pop("headers", {})
+        return self.client.get(
+            self.url, params, HTTP_X_REQUESTED_WITH="XMLHttpRequest", **headers
+        )
+
+
+class SessionMapCacheTests(SessionMapTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store(self.session, make_points(10))
+
+    def test_live_session_revalidates(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        again = self.get(headers={"HTTP_IF_NONE_MATCH": response["ETag"]})
+        self.assertEqual(again.status_code, 304)
+
+    def test_settled_session_is_cached(self):
+        TrackingSession.objects.filter(id=self.session.id).update(
+            ended_at=timezone.now() - SETTLE_TIME * 2
+        )
+
+        response = self.get(headers={"HTTP_ACCEPT_ENCODING": "gzip"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f"max-age={MAP_MAX_AGE}", response["Cache-Control"])
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))["locations"]), 10)
+
+        again = self.get(headers={"HTTP_IF_NONE_MATCH": response["ETag"]})
+        self.assertEqual(again.status_code, 304)
+
+        # Other clients get the stored copy, plain if they can't take gzip
+        with mock.patch("tracking.views.render_session_map") as render:
+            plain = self.get()
+        render.assert_not_called()
+        self.assertEqual(len(plain.json()["locations"]), 10)
+
+    def test_etag_follows_point_count(self):
+        etag = self.get()["ETag"]
+
+        store(self.session, make_points(2, offset=10))
+
+        response = self.get(headers={"HTTP_IF_NONE_MATCH": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class SessionMapSinceTests(SessionMapTestCase):
+
+    def setUp(self):
+        super().setUp()
+        store(self.session, make_points(100))
+
+    def test_points_after_the_cursor(self):
+        body = self.get(since=90).json()
+
+        self.assertTrue(body["changed"])
+        self.assertEqual(body["seq"], 100)
+        self.assertEqual([p["seq"] for p in body["locations"]], list(range(91, 101)))
+
+    def test_nothing_new(self):
+        body = self.get(since=100).json()
+
+        self.assertEqual(body, {
+            "session_id": self.session.id,
+            "changed": False,
+            "seq": 100,
+            "ended_at": None,
+        })
+        self.assertFalse(self.get(since=500).json()["changed"])
+
+    def test_bad_cursors(self):
+        self.assertEqual(self.get(since="abc").status_code, 400)
+        self.assertEqual(self.get(since="1.5").status_code, 400)
+
+        # Below zero is the start of the track
+        self.assertEqual(len(self.get(since=-5).json()["locations"]), 100)
+
+
+class SessionMapZoomTests(SessionMapTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Zigzag of about 35 m steps, 20 m side to side
+        points = make_points(200)
+        for i, point in enumerate(points):
+            point["lng"] += 0.0002 * math.sin(i)
+        store(self.session, points)
+
+    def seqs(self, **params):
+        response = self.get(**params)
+        self.assertEqual(response.status_code, 200)
+        return [p["seq"] for p in response.json()["locations"]]
+
+    def test_lower_zoom_keeps_fewer_points_and_the_ends(self):
+        counts = []
+        for zoom in (19, 16, 14, 12, 5):
+            seqs = self.seqs(zoom=zoom)
+            self.assertEqual((seqs[0], seqs[-1]), (1, 200))
+            self.assertEqual(seqs, sorted(seqs))
+            counts.append(len(seqs))
+
+        # Strictly fewer per level, down to just the ends
+        self.assertEqual(counts, sorted(set(counts), reverse=True))
+        self.assertGreater(counts[0], 190)
+        self.assertEqual(counts[-1], 2)
+
+    def test_bad_levels(self):
+        self.assertEqual(self.get(zoom="abc").status_code, 400)
+        self.assertEqual(self.get(tolerance="nan").status_code, 400)
+        self.assertEqual(self.get(tolerance=-1).status_code, 400)
+
+        # Out of range zooms are clamped
+        self.assertEqual(self.seqs(zoom=99), self.seqs(zoom=19))
+        self.assertEqual(self.seqs(zoom=-3), self.seqs(zoom=0))
+
+
+# ---------------- BULK UPLOAD ----------------
+
+def ndjson(points):
+    return "\n".join(json.dumps(point) for point in points).encode()
+
+
+def csv_body(points):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=["lat", "lng", "timestamp", "mode", "cseq"])
+    writer.writeheader()
+    writer.writerows(points)
+    return out.getvalue().encode()
+
+
+class UploadPointsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="uploader")
+        self.session = TrackingSession.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.url = reverse("upload_points", args=[self.session.id])
+
+    def upload(self, body, content_type="application/x-ndjson", **headers):
+        return self.client.generic("POST", self.url, body, content_type=content_type, **headers)
+
+    def test_gzipped_ndjson(self):
+        response = self.upload(gzip.compress(ndjson(make_points(25))), HTTP_CONTENT_ENCODING="gzip")
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["received"], body["accepted"], body["seq"]), (25, 25, 25))
+        self.assertEqual(self.session.points.count(), 25)
+
+    def test_overlapping_csv_resumes_after_stored_seq(self):
+        self.upload(csv_body(make_points(10)), content_type="text/csv")
+
+        response = self.upload(csv_body(make_points(30)), content_type="text/csv")
+
+        body = response.json()
+        self.assertEqual((body["received"], body["accepted"], body["seq"]), (30, 20, 30))
+        self.assertEqual(
+            list(self.session.points.order_by("seq").values_list("seq", flat=True)),
+            list(range(1, 31))
+        )
+        self.assertEqual(self.client.get(self.url).json()["seq"], 30)
+
+    def test_unreadable_bodies_are_a_400(self):
+        for body, headers in (
+            (b"not gzip at all", {"HTTP_CONTENT_ENCODING": "gzip"}),
+            (gzip.compress(ndjson(make_points(3)))[:-8], {"HTTP_CONTENT_ENCODING": "gzip"}),
+            (b'{"lat": 1, "lng": 1}\n\xff\xfe\n', {}),
+        ):
+            response = self.upload(body, **headers)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("error", response.json())
+
+    def test_non_finite_points_are_dropped(self):
+        points = make_points(5) + [{"lat": "nan", "lng": 1, "cseq": 999}]
+
+        response = self.upload(ndjson(points))
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["received"], body["accepted"], body["seq"]), (6, 5, 5))
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.point_count, 5)
+        self.assertTrue(math.isfinite(self.session.total_distance))
+
+    def test_storage_errors_are_a_400(self):
+        with mock.patch("tracking.views.ingest_points", side_effect=DataError("value too long")):
+            response = self.upload(ndjson(make_points(3)))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("value too long", response.json()["error"])
+
+    def test_ended_session_is_a_409(self):
+        TrackingSession.objects.filter(id=self.session.id).update(ended_at=START)
+
+        response = self.upload(ndjson(make_points(3)))
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.session.points.count(), 0)
+
+        # Stopped while an upload was already running
+        with self.assertRaises(SessionEnded):
+            ingest_points(self.session.id, make_points(3))
+
+
+def frame_points(count, offset=0):
+    return [
+        {**point, "ts_ms": int(datetime.fromisoformat(point["timestamp"]).timestamp() * 1000)}
+        for point in make_points(count, offset)
+    ]
+
+
+class FrameCodecTests(TestCase):
+
+    def test_round_trip(self):
+        points = frame_points(3)
+        session_id, records = decode_frame(encode_frame(42, points))
+
+        self.assertEqual(session_id, 42)
+        self.assertEqual(records["seq"].tolist(), [1, 2, 3])
+        self.assertEqual(records["ts_ms"].tolist(), [p["ts_ms"] for p in points])
+        self.assertEqual(
+            (records["lat"] / FRAME_COORD_SCALE).tolist(),
+            [round(p["lat"], 6) for p in points]
+        )
+
+    def test_malformed_frames(self):
+        frame = encode_frame(42, frame_points(3))
+
+        for data in (frame[:5], frame[:-1], frame + b"\0", b"\x09" + frame[1:]):
+            with self.assertRaises(FrameError):
+                decode_frame(data)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, INGEST_FLUSH_INTERVAL_MS=10)
+class BinaryFrameTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="binary")
+        self.session = TrackingSession.objects.create(user=self.user)
+
+    async def test_packed_frame_is_stored_and_acked(self):
+        communicator = WebsocketCommunicator(
+            TrackingConsumer.as_asgi(), "/ws/tracking/", subprotocols=[BINARY_SUBPROTOCOL]
+        )
+        communicator.scope["user"] = self.user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, BINARY_SUBPROTOCOL)
+
+        frame = encode_frame(self.session.id, frame_points(4))
+
+        # A truncated frame is ignored and the connection stays usable
+        await communicator.send_to(bytes_data=frame[:-3])
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+
+        await communicator.send_to(bytes_data=frame)
+        ack = json.loads(await communicator.receive_from(timeout=5))
+        self.assertEqual(ack, {"type": "ack", "session_id": self.session.id, "seq": 4})
+
+        rows = [
+            row async for row in self.session.points.order_by("seq").values_list("seq", "lat", "mode")
+        ]
+        self.assertEqual(rows, [(i + 1, round(28.6 + i * 0.0003, 6), "bike") for i in range(4)])
+
+        await communicator.disconnect()
+
+
+# ---------------- EXPORT ----------------
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="exporter")
+        self.session = TrackingSession.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+        # Ten points packed, five more flushed as rows afterwards
+        store(self.session, make_points(10))
+        self.assertTrue(self.session.compact())
+        store(self.session, make_points(5, offset=10))
+
+    def export(self, fmt, **params):
+        response = self.client.get(
+            reverse("export_session", args=[self.session.id, fmt]), params
+        )
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content)
+
+    def test_gpx(self):
+        response, body = self.export("gpx")
+
+        self.assertEqual(response["Content-Type"], "application/gpx+xml")
+        self.assertEqual(
+            response["Content-Disposition"],
+            f'attachment; filename="track_{self.session.id}.gpx"'
+        )
+        text = body.decode()
+        self.assertTrue(text.startswith('<?xml version="1.0" encoding="UTF-8"?>\n<gpx '))
+        self.assertEqual(text.count("<trkpt "), 15)
+
+    def test_geojson(self):
+        response, body = self.export("geojson")
+
+        self.assertEqual(response["Content-Type"], "application/geo+json")
+        features = json.loads(body)["features"]
+        self.assertEqual([f["properties"]["seq"] for f in features], list(range(1, 16)))
+
+    def test_csv(self):
+        response, body = self.export("csv")
+
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(io.StringIO(body.decode())))
+        self.assertEqual(tuple(rows[0]), CSV_COLUMNS)
+        self.assertEqual([int(row[1]) for row in rows[1:]], list(range(1, 16)))
+
+    def test_gzip(self):
+        for fmt in ("gpx", "geojson", "csv"):
+            _, plain = self.export(fmt)
+            response, body = self.export(fmt, gzip=1)
+
+            self.assertEqual(response["Content-Type"], "application/gzip")
+            self.assertTrue(response["Content-Disposition"].endswith('.gz"'))
+            self.assertEqual(gzip.decompress(body), plain)
+
+
+# ---------------- LIVE VIEWER ----------------
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, INGEST_FLUSH_INTERVAL_MS=10)
+class ViewerConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="owner")
+        self.session = TrackingSession.objects.create(user=self.user)
+
+    async def connect(self, path, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_viewer_sees_stored_points_and_the_end(self):
+        viewer, connected = await self.connect(f"/ws/tracking/{self.session.id}/view/", self.user)
+        self.assertTrue(connected)
+
+        tracker, _ = await self.connect("/ws/tracking/", self.user)
+        await tracker.send_to(text_data=json.dumps({
+            "session_id": self.session.id,
+            "locations": make_points(3),
+        }))
+
+        message = json.loads(await viewer.receive_from(timeout=5))
+        self.assertEqual(message["type"], "points")
+        self.assertEqual(message["seq"], 3)
+        self.assertEqual(len(message["locations"]), 3)
+
+        await sync_to_async(notify_session_stopped)(self.session.id)
+        self.assertEqual(json.loads(await viewer.receive_from(timeout=5)), {"type": "ended"})
+
+        await tracker.disconnect()
+        await viewer.disconnect()
+
+    async def test_other_users_cannot_view(self):
+        stranger = await User.objects.acreate(username="stranger")
+
+        viewer, connected = await self.connect(f"/ws/tracking/{self.session.id}/view/", stranger)
+
+        self.assertFalse(connected)
+        await viewer.disconnect()
+
+
+# ---------------- ROUTE PROXY ----------------
+
+class StubOrsHandler(BaseHTTPRequestHandler):
+    """Answers every directions call with an empty route, slowly enough
+    for concurrent requests to overlap."""
+
+    calls = 0
+
+    def do_POST(self):
+        type(self).calls += 1
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(0.2)
+
+        body = json.dumps({"type": "FeatureCollection", "features": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GetRouteTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOrsHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        StubOrsHandler.calls = 0
+        route_cache.local.clear()
+        route_cache.shared.clear()
+
+        self.async_client.force_login(User.objects.create(username="router"))
+
+        host, port = self.server.server_address
+        settings = override_settings(ORS_BASE_URL=f"http://{host}:{port}")
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    async def test_concurrent_requests_share_one_upstream_call(self):
+        # Within one grid cell of each other, so they share a key
+        bodies = [
+            json.dumps({"coordinates": [[77.2 + i * 1e-5, 28.6], [77.3, 28.7]]})
+            for i in range(5)
+        ]
+
+        responses = await asyncio.gather(*[
+            self.async_client.post(reverse("get_route"), body, content_type="application/json")
+            for body in bodies
+        ])
+
+        self.assertEqual([r.status_code for r in responses], [200] * 5)
+        self.assertEqual(StubOrsHandler.calls, 1)
+
+        # And later ones are served from the cache
+        response = await self.async_client.post(
+            reverse("get_route"), bodies[0], content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StubOrsHandler.calls, 1)
+
+    async def test_non_finite_coordinates_are_rejected(self):
+        for body in (
+            '{"coordinates": [[Infinity, 28.6], [77.3, 28.7]]}',
+            '{"coordinates": [[77.2, NaN], [77.3, 28.7]]}',
+            '{"coordinates": [[77.2, 1e400], [77.3, 28.7]]}',
+        ):
+            response = await self.async_client.post(
+                reverse("get_route"), body, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(StubOrsHandler.calls, 0)
+
+
+# ---------------- DAILY STATS ----------------
+
+class DailyStatsTests(TestCase):
+
+    def test_row_created_by_a_concurrent_stop_is_added_to(self):
+        user = User.objects.create(username="stats")
+        session = TrackingSession.objects.create(user=user, total_distance=100, total_time=60)
+        update = QuerySet.update
+        raced = []
+
+        def racing_update(queryset, **fields):
+            if raced:
+                return update(queryset, **fields)
+
+            # The other session's row lands right after our update missed
+            raced.append(DailyStats.objects.create(
+                user=user,
+                day=timezone.localdate(session.started_at),
+                mode=session.mode,
+                distance=50,
+                time=30,
+                session_count=1
+            ))
+            return 0
+
+        with mock.patch.object(QuerySet, "update", racing_update):
+            DailyStats.add_session(session)
+
+        row = DailyStats.objects.get(user=user)
+        self.assertEqual((row.distance, row.time, row.session_count), (150, 90, 2))
+
+
+# ---------------- IMPORT ----------------
+
+def gpx_track(name, kind, points):
+    trkpts = "".join(
+        f'<trkpt lat="{p["lat"]}" lon="{p["lng"]}"><time>{p["timestamp"]}</time></trkpt>'
+        for p in points
+    )
+    return f"<trk><name>{name}</name><type>{kind}</type><trkseg>{trkpts}</trkseg></trk>"
+
+
+class ImportTracksTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="importer")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        # 30 good points, an off-globe one and a duplicate
+        ride = make_points(30)
+        ride.insert(10, {**ride[10], "lat": 95})
+        ride.insert(20, dict(ride[19]))
+        walk = make_points(20, offset=100)
+
+        with open(os.path.join(self.directory, "trips.gpx"), "w") as f:
+            f.write(
+                '<?xml version="1.0"?><gpx xmlns="http://www.topografix.com/GPX/1/1">'
+                + gpx_track("Ride", "cycling", ride)
+                + gpx_track("Walk", "walking", walk)
+                + "</gpx>"
+            )
+
+        drive = make_points(25, offset=200, mode="car")
+        drive[5]["lat"] = "x"
+        with open(os.path.join(self.directory, "drive.csv"), "w") as f:
+            f.write(csv_body(drive).decode())
+
+    def test_imports_ended_sessions_with_stats(self):
+        out = io.StringIO()
+        call_command("import_tracks", self.directory, user="importer", workers=1, stdout=out)
+
+        self.assertIn("Successfully imported 3 sessions with 74 points", out.getvalue())
+        self.assertIn("Read 77 points from 2 files (2 unreadable, 1 duplicate", out.getvalue())
+
+        sessions = {s.mode: s for s in TrackingSession.objects.filter(user=self.user)}
+        self.assertEqual(
+            {mode: s.point_count for mode, s in sessions.items()},
+            {"bike": 30, "walk": 20, "car": 24}
+        )
+
+        for session in sessions.values():
+            points = session.get_track()
+            self.assertEqual(points.rows().count(), session.point_count)
+            # started_at is moved back from the import time to the first point
+            self.assertEqual(session.started_at, points[0]["timestamp"])
+            self.assertEqual(session.ended_at, points[-1]["timestamp"])
+
+        stats = DailyStats.objects.filter(user=self.user)
+        self.assertEqual(sum(row.session_count for row in stats), 3)
+        self.assertAlmostEqual(
+            sum(row.distance for row in stats),
+            sum(s.total_distance for s in sessions.values())
+        )
+
+    def test_dry_run_writes_nothing(self):
+        out = io.StringIO()
+        call_command(
+            "import_tracks", self.directory, user="importer", workers=1, dry_run=True, stdout=out
+        )
+
+        self.assertIn("Dry run: Would import 3 sessions with 74 points", out.getvalue())
+        self.assertFalse(TrackingSession.objects.exists())
+        self.assertFalse(DailyStats.objects.exists())
+
+
+# ---------------- RECOMPUTE ----------------
+
+class RecomputeTotalsTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create(username="recompute")
+        self.session = TrackingSession.objects.create(user=user)
+
+        state = fetch_state(self.session.id, user)
+        write_pending([pending_batch(state, noisy_points(200, seed=1))])
+
+        self.session.refresh_from_db()
+        self.session.ended_at = self.session.last_timestamp
+        self.session.save()
+        self.assertTrue(self.session.compact())
+
+    def test_sessions_on_current_rules_are_left_alone(self):
+        self.assertEqual(recompute_chunk(self.session.id, self.session.id, False), [])
+
+    def test_sessions_on_other_rules_are_recomputed(self):
+        TrackingSession.objects.filter(id=self.session.id).update(rules_version="old")
+
+        [result] = recompute_chunk(self.session.id, self.session.id, False)
+
+        self.assertEqual(result[0], self.session.id)
+        self.assertEqual(result[5], self.session.point_count)
+
+
+# ---------------- METRICS ----------------
+
+def metric_value(text, series):
+    for line in text.splitlines():
+        name, _, value = line.rpartition(" ")
+        if name == series:
+            return float(value)
+    return 0
+
+
+class MetricsTests(TestCase):
+
+    def write_process(self, directory, pid, received, invalid):
+        with open(os.path.join(directory, f"{pid}.json"), "w") as f:
+            json.dump({
+                "locatracker_points_received_total": [[[], received]],
+                "locatracker_points_filtered_total": [[["invalid"], invalid]],
+            }, f)
+
+    def test_process_files_are_added_up(self):
+        own = render_metrics()
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_process(directory, 101, received=3, invalid=1)
+            self.write_process(directory, 102, received=4, invalid=2)
+            self.write_process(directory, 103, received=1000, invalid=1000)
+
+            # 103 has exited: left out, and its file removed
+            running = mock.patch("tracking.metrics.is_running", lambda pid: pid != 103)
+            with override_settings(METRICS_DIR=directory), running:
+                text = render_metrics()
+
+            self.assertEqual(sorted(os.listdir(directory)), ["101.json", "102.json"])
+
+        self.assertIn("# TYPE locatracker_points_received_total counter", text)
+        self.assertEqual(
+            metric_value(text, "locatracker_points_received_total"),
+            metric_value(own, "locatracker_points_received_total") + 7
+        )
+        series = 'locatracker_points_filtered_total{reason="invalid"}'
+        self.assertEqual(metric_value(text, series), metric_value(own, series) + 3)
+
+    def test_access(self):
+        url = reverse("metrics")
+
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(User.objects.create(username="staff", is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.client.logout()
+
+        with override_settings(METRICS_TOKEN="scrape-me"):
+            self.assertEqual(
+                self.client.get(url, HTTP_AUTHORIZATION="Bearer scrape-me").status_code, 200
+            )
+            self.assertEqual(
+                self.client.get(url, HTTP_AUTHORIZATION="Bearer guess").status_code, 403
+            )
+
+
+# ---------------- PROFILER ----------------
+
+class ProfileDirTests(TestCase):
+
+    def setUp(self):
+        parent = tempfile.TemporaryDirectory()
+        self.addCleanup(parent.cleanup)
+        self.path = os.path.join(parent.name, "profile")
+
+    def test_created_private(self):
+        with override_settings(PROFILE_DIR=self.path):
+            private_dir()
+
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o700)
+
+    def test_shared_directory_is_refused(self):
+        os.mkdir(self.path)
+        os.chmod(self.path, 0o777)
+
+        with override_settings(PROFILE_DIR=self.path), self.assertRaises(PermissionError):
+            private_dir()
@@ -0,0 +1,179 @@
+"""Token-bucket rate limits on ingest.
+
+Every TrackingConsumer connection has a frames/s and a points/s bucket,
+and so does its user, shared by all of that user's connections in this
+worker. A frame needs a frame token from both; its new points take
+point tokens from both.
+
+Over the frame limit, a connection's frames are dropped unprocessed
+until retry_after has passed, and the client is told to back off. Its
+points are still unacked, so it resends them, in order, once the window
+is over. Over the point limit, a batch is thinned to the points there
+are tokens for (keeping the last one), and the rest count as seen.
+
+Limits are per worker process; a user spread over several workers gets
+each worker's allowance.
+"""
+
+import time
+import weakref
+from collections import Counter
+
+from django.conf import settings
+
+
+class TokenBucket:
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def available(self, now):
+        self.refill(now)
+        return int(self.tokens)
+
+    def take(self, count):
+        self.tokens -= count
+
+    def wait(self, count=1):
+        """Seconds until count tokens are back (after a refill)."""
+        missing = count - self.tokens
+        return max(missing, 0) / self.rate
+
+
+class Limits:
+    """A frame bucket and a point bucket; a rate of 0 turns one off."""
+
+    def __init__(self, frames, points):
+        self.frames = bucket(*frames)
+        self.points = bucket(*points)
+
+
+def bucket(rate, burst):
+    if not rate:
+        return None
+    return TokenBucket(rate, max(burst, 1))
+
+
+# Live connections hold their user's Limits; it goes away with the last one
+_user_limits = weakref.WeakValueDictionary()
+
+# Throttle events in this process, for ingest_stats / monitoring
+counters = Counter()
+
+
+def user_limits(user_id):
+    limits = _user_limits.get(user_id)
+    if limits is None:
+        config = settings.INGEST_THROTTLE["user"]
+        limits = _user_limits[user_id] = Limits(config["frames"], config["points"])
+
+    return limits
+
+
+class IngestThrottle:
+    """Rate limits for one connection."""
+
+    def __init__(self, user_id):
+        config = settings.INGEST_THROTTLE["connection"]
+        self.scopes = (
+            ("connection", Limits(config["frames"], config["points"])),
+            ("user", user_limits(user_id)),
+        )
+
+        # Frames before this monotonic time are dropped
+        self.blocked_until = 0
+
+    def frame(self):
+        """None if the frame may be processed, else seconds to back off.
+
+        A refused frame starts a back-off window; the caller tells the
+        client once per window.
+        """
+        now = time.monotonic()
+        if now < self.blocked_until:
+            counters["frames_dropped"] += 1
+            return self.blocked_until - now
+
+        buckets = []
+        for scope, limits in self.scopes:
+            if limits.frames is None:
+                continue
+
+            if limits.frames.available(now) < 1:
+                counters[f"{scope}_frame_limited"] += 1
+                return self.block(now, limits.frames.wait())
+
+            buckets.append(limits.frames)
+
+        for frame_bucket in buckets:
+            frame_bucket.take(1)
+
+        return None
+
+    def points(self, count):
+        """How many of count new points may be kept (0 to count).
+
+        No tokens at all refuses the frame like the frame limit does.
+        """
+        now = time.monotonic()
+        granted = count
+        limited = None
+
+        for scope, limits in self.scopes:
+            if limits.points is None:
+                continue
+
+            available = limits.points.available(now)
+            if available < granted:
+                granted = max(available, 0)
+                limited = scope
+
+        if limited is not None:
+            counters[f"{limited}_point_limited"] += 1
+
+        if granted == 0 and count:
+            self.block(now, max(
+                limits.points.wait() for _, limits in self.scopes
+                if limits.points is not None
+            ))
+            return 0
+
+        for _, limits in self.scopes:
+            if limits.points is not None:
+                limits.points.take(granted)
+
+        counters["points_dropped"] += count - granted
+        return granted
+
+    def retry_after(self):
+        return max(self.blocked_until - time.monotonic(), 0)
+
+    def block(self, now, seconds):
+        self.blocked_until = now + seconds
+        counters["frames_dropped"] += 1
+        return seconds
+
+
+def throttle_stats():
+    return {
+        "frames_dropped": counters["frames_dropped"],
+        "points_dropped": counters["points_dropped"],
+        "connection_frame_limited": counters["connection_frame_limited"],
+        "user_frame_limited": counters["user_frame_limited"],
+        "connection_point_limited": counters["connection_point_limited"],
+        "user_point_limited": counters["user_point_limited"],
+        "messages_sent": counters["messages_sent"],
+        "users_tracked": len(_user_limits),
+    }
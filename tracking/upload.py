@@ -0,0 +1,158 @@
+"""Bulk point upload over HTTP (POST /tracking/<session_id>/points/).
+
+The body is NDJSON (one point object per line) or CSV with a header
+row, optionally gzip-compressed. It is read and parsed as a stream, a
+few thousand points at a time, so large offline buffers never sit in
+memory whole.
+
+Points carry the client sequence number (cseq) used by the WebSocket
+path. The session's client_seq is the resume token: a client that lost
+a response asks for it and uploads only what comes after.
+"""
+
+import csv
+import json
+import zlib
+
+from django.db import transaction
+
+from .batch import PointBatch
+from .consumers import SessionState
+from .ingest import PendingSession, apply_batch, write_pending
+from .models import TrackingSession
+
+
+READ_SIZE = 64 * 1024
+
+# Points parsed and written per transaction
+UPLOAD_BATCH_SIZE = 2000
+
+# Points handled per request; the client resumes with the rest
+UPLOAD_MAX_POINTS = 50000
+
+CSV_FIELDS = ("lat", "lng", "timestamp", "mode", "cseq")
+
+
+class UploadError(ValueError):
+    pass
+
+
+class SessionEnded(Exception):
+    """Points for a session that was already stopped: its totals, daily
+    stats and packed track are settled."""
+
+
+def iter_chunks(stream, gzipped):
+    """Raw body chunks, inflated if the body is gzip-compressed."""
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+
+        if inflater is None:
+            yield chunk
+            continue
+
+        try:
+            yield inflater.decompress(chunk)
+        except zlib.error as e:
+            raise UploadError(f"Bad gzip body: {e}")
+
+    if inflater is not None:
+        if not inflater.eof:
+            raise UploadError("Truncated gzip body")
+        yield inflater.flush()
+
+
+def iter_lines(chunks):
+    tail = b""
+
+    for chunk in chunks:
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            yield decode(line)
+
+    if tail:
+        yield decode(tail)
+
+
+def decode(line):
+    try:
+        return line.decode("utf-8")
+    except UnicodeDecodeError:
+        raise UploadError("Body is not UTF-8")
+
+
+def parse_ndjson(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            point = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+
+        yield point if isinstance(point, dict) else None
+
+
+def parse_csv(lines):
+    reader = csv.DictReader(lines)
+
+    if reader.fieldnames is None:
+        return
+
+    if not {"lat", "lng"} <= set(reader.fieldnames):
+        raise UploadError("CSV header needs at least lat and lng")
+
+    for row in reader:
+        point = {field: row[field] for field in CSV_FIELDS if row.get(field)}
+        yield point
+
+
+def read_points(stream, content_type, gzipped):
+    """Point dicts from the body; None for a line that could not be read."""
+    lines = iter_lines(iter_chunks(stream, gzipped))
+
+    if content_type == "text/csv":
+        return parse_csv(lines)
+
+    return parse_ndjson(lines)
+
+
+def ingest_points(session_id, points):
+    """Filter and store one batch of uploaded points.
+
+    The session row is locked while its tail is read and moved forward,
+    so the batch lands after whatever is already stored. Raises
+    SessionEnded once the session is stopped.
+    """
+    with transaction.atomic():
+        values = TrackingSession.objects.select_for_update().filter(
+            id=session_id
+        ).values(*SessionState.FIELDS, "ended_at").first()
+
+        if values.pop("ended_at") is not None:
+            raise SessionEnded()
+
+        state = SessionState(**values)
+        batch = PointBatch.from_dicts(points).unseen(state.client_seq)
+
+        seen = state.client_seq
+        accepted = apply_batch(state, batch, batch.select(state))
+
+        if accepted or state.client_seq > seen:
+            pending = PendingSession(session_id)
+            pending.add(state, accepted)
+            dropped = write_pending([pending])
+
+            # The row is locked, so the tail can't be stale; this is bad data
+            if session_id in dropped:
+                raise UploadError(f"Points could not be stored: {dropped[session_id]}")
+
+    return state, accepted
@@ -7,7 +7,11 @@ urlpatterns = [
     path('start/', views.start_tracking, name='start_tracking'),  
     path('stop/<int:session_id>/', views.stop_tracking, name='stop_tracking'), 
     path('get-route/', views.get_route, name='get_route'),
+    path('get-route/stats/', views.route_cache_stats, name='route_cache_stats'),
+    path('ingest/stats/', views.ingest_stats, name='ingest_stats'),
     path('session-map/<int:session_id>/', views.session_map, name='session_map'),
+    path('<int:session_id>/points/', views.upload_points, name='upload_points'),
+    path('<int:session_id>/export/<str:fmt>/', views.export_session, name='export_session'),
     path('admin/logout_on_tab_close/', views.logout_on_tab_close, name='logout_on_tab_close'),
     path("my-tracks/", views.my_tracks, name="my_tracks"),
 ]
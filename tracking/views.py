@@ -2,15 +2,44 @@ from django.shortcuts import render, redirect
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import get_object_or_404
-from .models import TrackingSession
+from .models import DailyStats, TrackingSession, stopped_total_time
+from .consumers import notify_session_changed, notify_session_stopped
+from .dbexecutor import get_db_executor
+from .export import FORMATS as EXPORT_FORMATS, export_response
+from .ingest import flush_session_now, get_ingest_stats
+from .metrics import SESSION_MAP_SECONDS, render as render_metrics
+from .mapcache import (
+    SUMMARY_FIELDS as MAP_SUMMARY_FIELDS, cache_response, cached_response,
+    is_settled, session_etag, set_cache_headers
+)
+from .ors import PROFILES as ORS_PROFILES, RouteError, get_ors_client
+from .routecache import route_cache, route_key, snap
+from .throttle import throttle_stats
+from .simplify import INITIAL_ZOOM, MAX_ZOOM, simplify_track, zoom_tolerance
+from .upload import (
+    UPLOAD_BATCH_SIZE,
+    UPLOAD_MAX_POINTS,
+    SessionEnded,
+    UploadError,
+    ingest_points,
+    read_points,
+)
 from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import logout
 from django.conf import settings
-import requests
+from django.db import DatabaseError, DataError, transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncWeek
+import httpx
+from datetime import timedelta
 import json
+import math
 import time
 
 
@@ -52,7 +81,7 @@ def start_tracking(request):
 
 
 @login_required
-def get_route(request):
+async def get_route(request):
     """Proxy endpoint for OpenRouteService API to hide API key"""
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
@@ -65,79 +94,116 @@ def get_route(request):
         if not coordinates or len(coordinates) != 2:
             return JsonResponse({'error': 'Invalid coordinates'}, status=400)
 
-        # Create cache key for route
-        cache_key = f"route_{profile}_{coordinates[0][0]}_{coordinates[0][1]}_{coordinates[1][0]}_{coordinates[1][1]}"
+        if profile not in ORS_PROFILES:
+            return JsonResponse({'error': 'Invalid profile'}, status=400)
 
-        # Simple in-memory cache with timestamp
-        if hasattr(get_route, '_cache') and cache_key in get_route._cache:
-            cached_data = get_route._cache[cache_key]
-            if time.time() - cached_data['timestamp'] < 3600:  # Cache for 1 hour
-                return JsonResponse(cached_data['data'])
-
-        # Call ORS API with server-side key
-        ors_url = f"https://api.openrouteservice.org/v2/directions/{profile}/geojson"
-        headers = {
-            "Authorization": settings.ORS_API_KEY,
-            "Content-Type": "application/json"
-        }
-        payload = {"coordinates": coordinates}
-
-        response = requests.post(ors_url, json=payload, headers=headers, timeout=10)
+        try:
+            coordinates, cells = snap(coordinates, settings.ROUTE_CACHE_GRID)
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'Invalid coordinates'}, status=400)
 
-        if response.status_code == 200:
-            route_data = response.json()
+        # Nearby requests share a key (and a cached route)
+        cache_key = route_key(profile, cells)
 
-            # Cache the result
-            if not hasattr(get_route, '_cache'):
-                get_route._cache = {}
-            get_route._cache[cache_key] = {
-                'data': route_data,
-                'timestamp': time.time()
-            }
+        route_data = await route_cache.get(cache_key)
 
-            # Limit cache size
-            if len(get_route._cache) > 100:
-                oldest_key = min(get_route._cache.keys(),
-                               key=lambda k: get_route._cache[k]['timestamp'])
-                del get_route._cache[oldest_key]
+        if route_data is None:
+            # Call ORS API with server-side key; identical requests in
+            # flight share one upstream call, which fills the cache
+            route_data = await get_ors_client().directions(
+                cache_key, profile, coordinates, store=route_cache.set
+            )
 
-            return JsonResponse(route_data)
-        else:
-            return JsonResponse({'error': 'Routing service error'}, status=response.status_code)
+        return JsonResponse(route_data)
 
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
-    except requests.RequestException:
+    except RouteError as e:
+        return JsonResponse({'error': 'Routing service error'}, status=e.status)
+    except httpx.HTTPError:
         return JsonResponse({'error': 'Service unavailable'}, status=503)
 
 
+@staff_member_required
+def route_cache_stats(request):
+    """Route cache counters of the worker that serves this request."""
+    return JsonResponse(route_cache.snapshot())
+
+
+def metrics(request):
+    """Prometheus metrics of this host's workers.
+
+    Scrapers send METRICS_TOKEN as a bearer token; without one set,
+    only staff can read them.
+    """
+    if settings.METRICS_TOKEN:
+        allowed = constant_time_compare(
+            request.headers.get("Authorization", ""),
+            f"Bearer {settings.METRICS_TOKEN}"
+        )
+    else:
+        allowed = request.user.is_staff
+
+    if not allowed:
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    return HttpResponse(
+        render_metrics(),
+        content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@staff_member_required
+def ingest_stats(request):
+    """Ingest buffer, database executor and throttle counters of this
+    worker."""
+    return JsonResponse({
+        "buffer": get_ingest_stats(),
+        "db_executor": get_db_executor().stats(),
+        "throttle": throttle_stats(),
+    })
+
+
 @login_required
 def stop_tracking(request, session_id):
     try:
         session = TrackingSession.objects.get(id=session_id, user=request.user)
 
-        now = timezone.now()
+        flush_session_now(session.id)
+
+        # Locked so a concurrent flush's F() increments land before or
+        # after, and only the columns stopping owns are written
+        with transaction.atomic():
+            session = TrackingSession.objects.select_for_update().get(id=session.id)
 
-        # Calculate total session duration (from start to stop)
-        if session.started_at:
-            total_session_time = (now - session.started_at).total_seconds()
-            # Only update total_time if it's less than session duration
-            # (handles cases where tracking was paused/stopped)
-            if total_session_time > session.total_time:
-                session.total_time = total_session_time
+            # A repeated stop must not count the session twice
+            first_stop = session.ended_at is None
 
-        # Ensure final time calculation from last location
-        if session.last_timestamp and session.last_timestamp < now:
-            final_gap = (now - session.last_timestamp).total_seconds()
-            # Only add if it's a reasonable gap (less than 10 minutes)
-            if final_gap > 0 and final_gap < 600:
-                session.total_time += final_gap
+            if first_stop:
+                session.ended_at = timezone.now()
+                session.total_time = stopped_total_time(
+                    session.total_time,
+                    session.started_at,
+                    session.last_timestamp,
+                    session.ended_at
+                )
+                session.save(update_fields=["total_time", "ended_at"])
 
-        session.ended_at = now
-        session.save()
+        notify_session_stopped(session.id)
+
+        # Ended sessions keep their points in the packed track column
+        session.compact()
+
+        if first_stop:
+            try:
+                DailyStats.add_session(session)
+            except DatabaseError as e:
+                # rollup_stats rebuilds the rows from the sessions
+                print("Daily stats update failed:", e)
 
         return JsonResponse({
             "status": "stopped",
+            "total_points": session.point_count,
             "total_distance_km": round(session.total_distance / 1000, 2),
             "total_time_hours": round(session.total_time / 3600, 2),
             "average_speed_kmh": round((session.total_distance / 1000) / (session.total_time / 3600), 2) if session.total_time > 0 else 0
@@ -151,23 +217,77 @@ def stop_tracking(request, session_id):
 # ---------------- Admin Map View ----------------
 @login_required
 def session_map(request, session_id):
-    session = get_object_or_404(TrackingSession, id=session_id)
+    start = time.perf_counter()
+    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+    # Live polling: only points after the client's cursor
+    if is_ajax and 'since' in request.GET:
+        return session_map_since(request, session_id)
+
+    summary = TrackingSession.objects.filter(id=session_id).values(
+        *MAP_SUMMARY_FIELDS
+    ).first()
+
+    if summary is None:
+        raise Http404("Session not found")
 
     # Security: Only allow users to view their own sessions (or admins)
-    if not request.user.is_superuser and session.user != request.user:
+    if not request.user.is_superuser and summary["user_id"] != request.user.id:
         return JsonResponse({"error": "Unauthorized"}, status=403)
 
+    try:
+        tolerance = lod_tolerance(request.GET, summary["last_lat"] or 0)
+    except ValueError:
+        return JsonResponse({"error": "Invalid zoom or tolerance"}, status=400)
+
+    # The page starts from a coarse level and asks for more on zoom
+    if not is_ajax and tolerance is None:
+        tolerance = zoom_tolerance(INITIAL_ZOOM, summary["last_lat"] or 0)
+
+    # Ended sessions are answered from the browser's or the shared cache
+    variant = ("json" if is_ajax else "html", tolerance)
+    etag = session_etag(session_id, summary, variant)
+    settled = is_settled(summary["ended_at"])
+
+    response = get_conditional_response(request, etag=etag)
+    result = "not_modified"
+
+    if response is None and settled:
+        response = cached_response(request, etag)
+        result = "cached"
+
+    if response is None:
+        session = TrackingSession.objects.select_related("user").get(id=session_id)
+        response = render_session_map(request, session, tolerance, is_ajax)
+        result = "rendered"
+
+        if settled:
+            response = cache_response(request, etag, response)
+
+    SESSION_MAP_SECONDS.observe(time.perf_counter() - start, variant[0], result)
+    return set_cache_headers(response, etag, settled)
+
+
+def render_session_map(request, session, tolerance, is_ajax):
+    if tolerance is None:
+        locations = list(session.get_track())
+    else:
+        locations = simplify_track(session, tolerance)
+
     # Get start location (first location if available)
     start_lat = None
     start_lng = None
-    if session.locations and len(session.locations) > 0:
-        start_lat = session.locations[0].get('lat')
-        start_lng = session.locations[0].get('lng')
+    if locations:
+        start_lat = locations[0]['lat']
+        start_lng = locations[0]['lng']
 
-    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+    if is_ajax:
         return JsonResponse({
             "session_id": session.id,
-            "locations": session.locations,
+            "seq": session.point_count,
+            "locations": locations,
+            "total_points": session.point_count,
+            "tolerance": tolerance,
             "user": session.user.username,
             "total_distance": session.total_distance,
             "total_time": session.total_time,
@@ -178,26 +298,282 @@ def session_map(request, session_id):
 
     return render(request, "tracking/session_map.html", {
         "session": session,
-        "locations": session.locations,
+        "locations": json.dumps(locations, cls=DjangoJSONEncoder),
         "start_lat": start_lat,
-        "start_lng": start_lng
+        "start_lng": start_lng,
+        "lod_zoom": INITIAL_ZOOM
+    })
+
+
+def lod_tolerance(params, lat):
+    """Simplification tolerance in meters from ?tolerance= or ?zoom=.
+
+    None means full detail.
+    """
+    if 'tolerance' in params:
+        tolerance = float(params['tolerance'])
+        if not math.isfinite(tolerance) or tolerance < 0:
+            raise ValueError("Tolerance must be a non-negative number")
+        return tolerance
+
+    if 'zoom' in params:
+        zoom = min(max(int(params['zoom']), 0), MAX_ZOOM)
+        return zoom_tolerance(zoom, lat)
+
+    return None
+
+
+def session_map_since(request, session_id):
+    try:
+        since = max(int(request.GET['since']), 0)
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+
+    # Counters only; the track itself is read just when there is news
+    summary = TrackingSession.objects.filter(id=session_id).values(
+        "user_id", "point_count", "ended_at"
+    ).first()
+
+    if summary is None:
+        return JsonResponse({"error": "Session not found"}, status=404)
+
+    if not request.user.is_superuser and summary["user_id"] != request.user.id:
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    ended_at = summary["ended_at"].isoformat() if summary["ended_at"] else None
+
+    if since >= summary["point_count"]:
+        return JsonResponse({
+            "session_id": session_id,
+            "changed": False,
+            "seq": summary["point_count"],
+            "ended_at": ended_at
+        })
+
+    session = TrackingSession.objects.get(id=session_id)
+
+    return JsonResponse({
+        "session_id": session.id,
+        "changed": True,
+        "seq": session.point_count,
+        "locations": session.get_track()[since:],
+        "total_distance": session.total_distance,
+        "total_time": session.total_time,
+        "ended_at": session.ended_at.isoformat() if session.ended_at else None
     })
     
 
+
+# ---------------- Bulk Upload ----------------
+@login_required
+def upload_points(request, session_id):
+    """Stream NDJSON or CSV points (optionally gzipped) into a session.
+
+    GET returns the resume token: the highest client seq stored.
+    """
+    summary = TrackingSession.objects.filter(
+        id=session_id,
+        user=request.user
+    ).values("client_seq", "point_count", "ended_at").first()
+
+    if summary is None:
+        return JsonResponse({"error": "Session not found"}, status=404)
+
+    if request.method == "GET":
+        return JsonResponse({
+            "session_id": session_id,
+            "seq": summary["client_seq"],
+            "point_count": summary["point_count"]
+        })
+
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid method"}, status=405)
+
+    if summary["ended_at"] is not None:
+        return JsonResponse({"error": "Session has ended"}, status=409)
+
+    gzipped = request.headers.get("Content-Encoding", "").lower() == "gzip"
+
+    # Points buffered by this worker's WebSocket consumers go first
+    flush_session_now(session_id)
+
+    progress = {
+        "session_id": session_id,
+        "seq": summary["client_seq"],
+        "point_count": summary["point_count"],
+        "received": 0,
+        "accepted": 0,
+        "skipped": 0,
+        "complete": True,
+    }
+
+    def store(chunk):
+        try:
+            state, points = ingest_points(session_id, chunk)
+        except UploadError:
+            raise
+        except (ValueError, DataError) as e:
+            raise UploadError(f"Points could not be stored: {e}")
+        notify_session_changed(state, points)
+
+        progress["seq"] = state.client_seq
+        progress["point_count"] = state.point_count
+        progress["accepted"] += len(points)
+
+    chunk = []
+
+    try:
+        for point in read_points(request, request.content_type, gzipped):
+            if point is None:
+                progress["skipped"] += 1
+                continue
+
+            chunk.append(point)
+            progress["received"] += 1
+
+            if len(chunk) >= UPLOAD_BATCH_SIZE:
+                store(chunk)
+                chunk = []
+
+            if progress["received"] >= UPLOAD_MAX_POINTS:
+                # The client resumes from seq with another request
+                progress["complete"] = False
+                break
+
+        if chunk:
+            store(chunk)
+
+    except UploadError as e:
+        # Earlier batches are stored; seq tells the client where to resume
+        return JsonResponse({**progress, "complete": False, "error": str(e)}, status=400)
+    except SessionEnded:
+        # Stopped while this upload ran
+        return JsonResponse(
+            {**progress, "complete": False, "error": "Session has ended"},
+            status=409
+        )
+
+    return JsonResponse(progress)
+
+
+# ---------------- Export ----------------
+
+@login_required
+def export_session(request, session_id, fmt):
+    """Stream a session's points as GPX, GeoJSON or CSV (?gzip=1 to
+    compress on the fly)."""
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({"error": "Unknown export format"}, status=404)
+
+    session = get_object_or_404(
+        TrackingSession.objects.select_related("user").defer("track"),
+        id=session_id
+    )
+
+    if not request.user.is_superuser and session.user != request.user:
+        return JsonResponse({"error": "Unauthorized"}, status=403)
+
+    return export_response(
+        request,
+        [session],
+        fmt,
+        f"track_{session.id}",
+        gzipped=request.GET.get("gzip") == "1"
+    )
+
+
 @login_required
 def my_tracks(request):
     sessions = TrackingSession.objects.filter(
         user=request.user,
         ended_at__isnull=False
-    ).order_by('-started_at')
+    ).defer('track').order_by('-started_at')
 
     for s in sessions:
         s.distance_km = round(s.total_distance / 1000, 2)
         s.time_hours = round(s.total_time / 3600, 2)
 
     return render(request, "tracking/my_tracks.html", {
-        "sessions": sessions
+        "sessions": sessions,
+        **tracks_summary(request.user)
     })
+
+
+# Days and weeks shown in the my_tracks charts
+CHART_DAYS = 30
+CHART_WEEKS = 12
+
+
+def tracks_summary(user):
+    """Totals and chart bars for my_tracks, read from DailyStats only."""
+    stats = DailyStats.objects.filter(user=user)
+    today = timezone.localdate()
+
+    totals = stats.aggregate(
+        distance=Sum("distance"),
+        time=Sum("time"),
+        sessions=Sum("session_count")
+    )
+
+    modes = [
+        {
+            "mode": row["mode"],
+            "distance_km": round(row["distance"] / 1000, 2),
+            "time_hours": round(row["time"] / 3600, 2),
+            "sessions": row["sessions"],
+        }
+        for row in stats.values("mode").annotate(
+            distance=Sum("distance"),
+            time=Sum("time"),
+            sessions=Sum("session_count")
+        ).order_by("-distance")
+    ]
+
+    first_day = today - timedelta(days=CHART_DAYS - 1)
+    daily = dict(
+        stats.filter(day__gte=first_day).values("day").annotate(
+            distance=Sum("distance")
+        ).values_list("day", "distance")
+    )
+
+    this_week = today - timedelta(days=today.weekday())
+    first_week = this_week - timedelta(weeks=CHART_WEEKS - 1)
+    weekly = dict(
+        stats.filter(day__gte=first_week).annotate(
+            week=TruncWeek("day")
+        ).values("week").annotate(
+            distance=Sum("distance")
+        ).values_list("week", "distance")
+    )
+
+    return {
+        "total_distance_km": round((totals["distance"] or 0) / 1000, 2),
+        "total_time_hours": round((totals["time"] or 0) / 3600, 2),
+        "total_sessions": totals["sessions"] or 0,
+        "mode_totals": modes,
+        "daily_chart": chart_bars([
+            (day, daily.get(day, 0))
+            for day in (first_day + timedelta(days=i) for i in range(CHART_DAYS))
+        ]),
+        "weekly_chart": chart_bars([
+            (week, weekly.get(week, 0))
+            for week in (first_week + timedelta(weeks=i) for i in range(CHART_WEEKS))
+        ]),
+    }
+
+
+def chart_bars(values):
+    """[(date, meters)] as bars with a height in percent of the largest."""
+    peak = max((meters for _, meters in values), default=0)
+
+    return [
+        {
+            "date": date,
+            "distance_km": round(meters / 1000, 2),
+            "height": round(meters / peak * 100) if peak else 0,
+        }
+        for date, meters in values
+    ]
     
 @csrf_exempt
 def logout_on_tab_close(request):